@@ -48,6 +48,128 @@ class Settings(BaseSettings):
     OD_CLIENT_SECRET: str = ""
     OD_REDIRECT_URI: str = "http://localhost/"
 
+    # webproxy upstream connection pool of every host
+    PROXY_MAX_CONNECTIONS_PER_HOST: int = 100
+    PROXY_MAX_KEEPALIVE_PER_HOST: int = 20
+    PROXY_KEEPALIVE_EXPIRY: float = 30
+    # multiplex the requests of a host on one connection, need `httpx[http2]`
+    PROXY_HTTP2: bool = True
+    PROXY_TIMEOUT: float = 8
+    PROXY_CONNECT_TIMEOUT: float = 3
+    PROXY_MAX_HOSTS: int = 256
+
+    # dns cache of upstream hostname, seconds. the ttl is used when resolver not tell it
+    # install `aiodns` to resolve asynchronously with the record ttl
+    PROXY_DNS_CACHE: bool = True
+    PROXY_DNS_TTL: float = 300
+    PROXY_DNS_NEGATIVE_TTL: float = 30
+    PROXY_DNS_CACHE_SIZE: int = 4096
+
+    # upstream circuit breaker, consecutive failures to open it, seconds before a probe
+    PROXY_BREAKER: bool = True
+    PROXY_BREAKER_FAILURES: int = 5
+    PROXY_BREAKER_RECOVERY: float = 30
+    # send a GET once more if it is slower than this latency percentile of the host
+    # 0 means no hedged request
+    PROXY_HEDGE_PERCENTILE: float = 0
+    PROXY_HEDGE_MIN_DELAY: float = 0.05
+
+    # admission control of /proxy/ and /file/, running requests in total and per host
+    # the others wait in the queue, shed with 503 when it is full or after the timeout
+    PROXY_ADMISSION: bool = True
+    PROXY_MAX_ACTIVE: int = 512
+    PROXY_MAX_ACTIVE_PER_HOST: int = 100
+    PROXY_ADMISSION_QUEUE: int = 1024
+    PROXY_ADMISSION_TIMEOUT: float = 5
+
+    # request body up to this size is read in memory before forwarding
+    PROXY_BODY_MEMORY_LIMIT: int = 1024 * 1024
+    # response bodies buffered in memory by all requests together (cache writing,
+    # compressed copies, shared responses, segments ahead of the client),
+    # the rest spill to disk, are streamed or wait for the client
+    PROXY_MEMORY_BUDGET: int = 256 * 1024 * 1024
+
+    # webproxy response cache
+    PROXY_CACHE: bool = True
+    PROXY_CACHE_MEMORY_SIZE: int = 64 * 1024 * 1024
+    PROXY_CACHE_MEMORY_OBJECT_SIZE: int = 1024 * 1024
+    PROXY_CACHE_DISK_SIZE: int = 1024 * 1024 * 1024
+    PROXY_CACHE_DISK_OBJECT_SIZE: int = 256 * 1024 * 1024
+    # each worker process keep its files in its own directory under it,
+    # empty means system temp directory
+    PROXY_CACHE_DIR: str = ""
+    # seconds an expired response is still served, while it is refreshed in background
+    # or when upstream fails. used if the response has a lifetime but not the
+    # `stale-while-revalidate`/`stale-if-error` directives
+    PROXY_STALE_WHILE_REVALIDATE: float = 30
+    PROXY_STALE_IF_ERROR: float = 300
+    PROXY_REVALIDATE_CONCURRENCY: int = 8
+
+    # share one upstream response between identical concurrent requests
+    PROXY_SINGLE_FLIGHT: bool = True
+    PROXY_SINGLE_FLIGHT_BUFFER: int = 4 * 1024 * 1024
+    # seconds, a client lag longer than it is dropped
+    PROXY_SINGLE_FLIGHT_LAG_TIMEOUT: float = 10
+
+    # redirect hops cache, seconds of permanent redirect
+    PROXY_REDIRECT_CACHE: bool = True
+    PROXY_REDIRECT_TTL: float = 24 * 60 * 60
+    PROXY_REDIRECT_CACHE_SIZE: int = 10000
+
+    # /file/ bandwidth limit, bytes per second, 0 means unlimited
+    PROXY_BANDWIDTH_GLOBAL: int = 0
+    PROXY_BANDWIDTH_PER_IP: int = 0
+    PROXY_BANDWIDTH_PER_HOST: int = 0
+
+    # /file/ range request block store
+    PROXY_RANGE_CACHE: bool = True
+    PROXY_RANGE_BLOCK_SIZE: int = 1024 * 1024
+    PROXY_RANGE_CACHE_SIZE: int = 2 * 1024 * 1024 * 1024
+    # a smaller range is proxied as it is, not worth fetching whole blocks
+    PROXY_RANGE_MIN_FETCH: int = 64 * 1024
+    # parent of the block directory of each worker process, like PROXY_CACHE_DIR
+    PROXY_RANGE_CACHE_DIR: str = ""
+
+    # /file/ download big file by concurrent range requests, if upstream accept ranges
+    # segments downloading at once (0 disable it), size of each, smallest file to split
+    PROXY_SEGMENTS: int = 0
+    PROXY_SEGMENT_SIZE: int = 4 * 1024 * 1024
+    PROXY_SEGMENT_MIN_SIZE: int = 16 * 1024 * 1024
+
+    # /proxy/ page preload: `link` header and 103 Early Hints (if ASGI server support it)
+    # of the critical subresources found in the last response of the page
+    PROXY_EARLY_HINTS: bool = True
+    PROXY_PRELOAD_HINTS: int = 8
+    # warm the cache with the subresources while the page is streaming
+    PROXY_PREFETCH: bool = False
+    PROXY_PREFETCH_CONCURRENCY: int = 4
+
+    # /file/ is served by a raw ASGI app before the middlewares of FastAPI,
+    # without X-Process-Time and compression (the proxied body is sent as it is)
+    FAST_FILE_ROUTE: bool = True
+
+    # compress text like responses with the best coding the client accept (br/zstd/gzip)
+    # the levels are tuned for on-the-fly compression
+    COMPRESSION: bool = True
+    COMPRESSION_MINIMUM_SIZE: int = 200
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_LEVEL: int = 4
+    COMPRESSION_ZSTD_LEVEL: int = 3
+    # compressed bodies of the cached webproxy responses, each is compressed once
+    PROXY_ENCODED_CACHE_SIZE: int = 64 * 1024 * 1024
+
+    # transcode jpeg/png of /proxy/ (not /file/) to the first format the client accept
+    # encoded in worker processes, the results are cached by url, validator and format
+    PROXY_IMAGE_TRANSCODE: bool = False
+    PROXY_IMAGE_FORMATS: List[str] = ["avif", "webp"]
+    PROXY_IMAGE_MAX_SIZE: int = 8 * 1024 * 1024
+    PROXY_IMAGE_WORKERS: int = 2
+    PROXY_IMAGE_CACHE_SIZE: int = 64 * 1024 * 1024
+
+    # /ws/ websocket tunnel, max frame size and received frames buffered per connection
+    PROXY_WS_MAX_MESSAGE: int = 4 * 1024 * 1024
+    PROXY_WS_MAX_QUEUE: int = 16
+
     # Not record setting
     NOT_RECORD_PATH: List[str] = [
         "/favicon.ico",
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   admission.py
+@Time    :   2024/06/03 20:37:19
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   admission control, global and per upstream host concurrency with queue
+"""
+
+import time
+import asyncio
+from collections import deque
+from typing import Any, Callable, Deque, Dict
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+class AdmissionRejected(Exception):
+    """the request is shed, the proxy is overloaded"""
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(f"proxy is overloaded: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    __slots__ = ("host", "future", "queued_at")
+
+    def __init__(self, host: str, future: "asyncio.Future[None]") -> None:
+        self.host = host
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class AdmissionController(object):
+    """Bound the running proxy requests, in total and per upstream host.
+
+    A request over the limit wait in a FIFO queue, a waiter of a busy host
+    never block the waiters of the other hosts. It is shed when the queue
+    is full, or when it has waited `queue_timeout` seconds, the client get
+    a fast 503 instead of a slow answer.
+    """
+
+    def __init__(
+        self,
+        max_active: int = 512,
+        max_active_per_host: int = 100,
+        max_queue: int = 1024,
+        queue_timeout: float = 5,
+    ) -> None:
+        self.max_active = max_active
+        self.max_active_per_host = max_active_per_host
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._hosts: Dict[str, int] = {}
+        self._queue: Deque[_Waiter] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.max_queue_depth = 0
+        self.shed_full = 0
+        self.shed_timeout = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+
+    def _has_room(self, host: str) -> bool:
+        return (
+            self._active < self.max_active
+            and self._hosts.get(host, 0) < self.max_active_per_host
+        )
+
+    def _take(self, host: str) -> None:
+        self._active += 1
+        self._hosts[host] = self._hosts.get(host, 0) + 1
+        self.admitted += 1
+
+    def _release(self, host: str) -> None:
+        self._active -= 1
+        count = self._hosts[host] - 1
+        if count:
+            self._hosts[host] = count
+        else:
+            del self._hosts[host]
+        self._wake()
+
+    def _wake(self) -> None:
+        """hand the free slots to the first waiters which can use them"""
+        now = time.monotonic()
+        for waiter in list(self._queue):
+            if self._active >= self.max_active:
+                break
+            if not self._has_room(waiter.host):
+                continue
+            self._queue.remove(waiter)
+            self._take(waiter.host)
+            self._waits += 1
+            self._wait_seconds += now - waiter.queued_at
+            waiter.future.set_result(None)
+
+    def _releaser(self, host: str) -> Callable[[], None]:
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._release(host)
+
+        return release
+
+    async def acquire(self, host: str) -> Callable[[], None]:
+        """wait for a slot, return the function to give it back
+
+        raise `AdmissionRejected` if the request is shed.
+        """
+        if self._has_room(host):
+            self._take(host)
+            return self._releaser(host)
+        if len(self._queue) >= self.max_queue:
+            self.shed_full += 1
+            raise AdmissionRejected("queue is full", self.queue_timeout)
+
+        waiter = _Waiter(host, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        try:
+            await asyncio.wait({waiter.future}, timeout=self.queue_timeout)
+        except BaseException:
+            # the client is gone, the slot may be given already
+            self._abandon(waiter)
+            raise
+        if not waiter.future.done():
+            self._abandon(waiter)
+            self.shed_timeout += 1
+            raise AdmissionRejected(
+                f"waited {self.queue_timeout}s in queue", self.queue_timeout
+            )
+        return self._releaser(host)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        if waiter.future.done():
+            self._release(waiter.host)
+            return
+        self._queue.remove(waiter)
+        waiter.future.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "queued": len(self._queue),
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "waited": self.queued,
+            "shed_full": self.shed_full,
+            "shed_timeout": self.shed_timeout,
+            "wait_ms_avg": (
+                round(self._wait_seconds / self._waits * 1000, 3)
+                if self._waits
+                else 0.0
+            ),
+            "hosts": dict(self._hosts),
+        }
+
+
+class AdmittedResponse(Response):
+    """Hold the admission slot until `response` is sent, or failed to.
+
+    The headers are shared with the wrapped response, they can still be
+    changed before sending.
+    """
+
+    def __init__(self, response: Response, release: Callable[[], None]) -> None:
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+        if self.background is not None:
+            await self.background()
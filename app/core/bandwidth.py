@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   bandwidth.py
+@Time    :   2024/05/21 20:48:33
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   token bucket bandwidth shaping with fair share between streams
+"""
+
+import time
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from starlette.responses import Response
+from starlette.types import Message, Receive, Scope, Send
+
+# allow a short burst above the rate, in seconds of rate
+_BURST_SECONDS = 0.25
+_MIN_BURST = 64 * 1024
+
+# a big body message is paced by slices of it
+_SLICE_SIZE = _MIN_BURST
+
+# the server send the whole file by itself, it can not be paced
+_UNPACED_EXTENSIONS = ("http.response.zerocopysend", "http.response.pathsend")
+
+
+class TokenBucket(object):
+    """bytes per second token bucket, reservation may go into debt
+
+    A chunk larger than the burst is sent after waiting for its debt.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.burst = max(rate * _BURST_SECONDS, _MIN_BURST)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate: float) -> None:
+        self.rate = rate
+        self.burst = max(rate * _BURST_SECONDS, _MIN_BURST)
+
+    def reserve(self, size: int, now: float) -> float:
+        """take `size` tokens, return the seconds to wait before sending"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class _Aggregate(object):
+    """streams of one client ip or one upstream host"""
+
+    __slots__ = ("bucket", "flows", "bytes")
+
+    def __init__(self, rate: float) -> None:
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.flows = 0
+        self.bytes = 0
+
+
+class _Flow(object):
+    __slots__ = ("ip", "host", "bucket", "bytes")
+
+    def __init__(self, ip: str, host: str) -> None:
+        self.ip = ip
+        self.host = host
+        self.bucket: Optional[TokenBucket] = None
+        self.bytes = 0
+
+
+class BandwidthScheduler(object):
+    """Shape streams with global, per client ip and per upstream host rates.
+
+    Fair share: every stream is paced at most at an equal share of each
+    limit it belongs to, e.g. `per_ip_rate / streams of the ip`, so one big
+    transfer can not take the whole bandwidth from the others.
+
+    Rates are bytes per second, 0 means unlimited.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 0,
+        per_ip_rate: float = 0,
+        per_host_rate: float = 0,
+    ) -> None:
+        self.global_rate = global_rate
+        self.per_ip_rate = per_ip_rate
+        self.per_host_rate = per_host_rate
+        self._global = _Aggregate(global_rate)
+        self._ips: Dict[str, _Aggregate] = {}
+        self._hosts: Dict[str, _Aggregate] = {}
+        self.total_bytes = 0
+        self.delayed_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.global_rate > 0 or self.per_ip_rate > 0 or self.per_host_rate > 0
+
+    def _open(self, ip: str, host: str) -> _Flow:
+        flow = _Flow(ip, host)
+        self._global.flows += 1
+        for groups, key, rate in (
+            (self._ips, ip, self.per_ip_rate),
+            (self._hosts, host, self.per_host_rate),
+        ):
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Aggregate(rate)
+            group.flows += 1
+        return flow
+
+    def _close(self, flow: _Flow) -> None:
+        self._global.flows -= 1
+        for groups, key in ((self._ips, flow.ip), (self._hosts, flow.host)):
+            group = groups[key]
+            group.flows -= 1
+            if group.flows <= 0:
+                del groups[key]
+
+    def _reserve(self, flow: _Flow, size: int) -> float:
+        now = time.monotonic()
+        aggregates: List[_Aggregate] = [
+            self._global,
+            self._ips[flow.ip],
+            self._hosts[flow.host],
+        ]
+
+        # equal share of every limit the stream belongs to
+        share = min(
+            (a.bucket.rate / a.flows for a in aggregates if a.bucket is not None),
+            default=0.0,
+        )
+        delay = 0.0
+        if share > 0:
+            if flow.bucket is None:
+                flow.bucket = TokenBucket(share)
+            else:
+                flow.bucket.set_rate(share)
+            delay = flow.bucket.reserve(size, now)
+
+        for aggregate in aggregates:
+            aggregate.bytes += size
+            if aggregate.bucket is not None:
+                delay = max(delay, aggregate.bucket.reserve(size, now))
+        flow.bytes += size
+        self.total_bytes += size
+        self.delayed_seconds += delay
+        return delay
+
+    async def _pace(self, flow: _Flow, size: int) -> None:
+        """wait until the tokens of `size` bytes are ready"""
+        delay = self._reserve(flow, size)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def shape(self, response: Response, ip: str, host: str) -> "ShapedResponse":
+        """pace the body of the response, whatever its type"""
+        return ShapedResponse(self, response, ip, host)
+
+    def stats(self) -> Dict[str, Any]:
+        """live counters, only the active ips and hosts are listed"""
+        return {
+            "active_flows": self._global.flows,
+            "total_bytes": self.total_bytes,
+            "delayed_seconds": round(self.delayed_seconds, 3),
+            "ips": {
+                k: {"flows": v.flows, "bytes": v.bytes} for k, v in self._ips.items()
+            },
+            "hosts": {
+                k: {"flows": v.flows, "bytes": v.bytes} for k, v in self._hosts.items()
+            },
+        }
+
+
+class ShapedResponse(Response):
+    """Pace the body of `response` in the send path.
+
+    Streaming, file and in memory bodies are all paced, every body message
+    is sent by slices when their tokens are ready. The zero-copy extensions
+    are hidden from the response, so a file is sent by chunks too. The
+    headers are shared with the wrapped response.
+    """
+
+    def __init__(
+        self, scheduler: BandwidthScheduler, response: Response, ip: str, host: str
+    ) -> None:
+        self.scheduler = scheduler
+        self.response = response
+        self.ip = ip
+        self.host = host
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        if any(name in extensions for name in _UNPACED_EXTENSIONS):
+            scope = dict(scope)
+            scope["extensions"] = {
+                k: v for k, v in extensions.items() if k not in _UNPACED_EXTENSIONS
+            }
+        flow = self.scheduler._open(self.ip, self.host)
+
+        async def paced_send(message: Message) -> None:
+            body = message.get("body", b"")
+            if message["type"] != "http.response.body" or not body:
+                await send(message)
+                return
+            more_body = message.get("more_body", False)
+            for start in range(0, len(body), _SLICE_SIZE):
+                data = body[start : start + _SLICE_SIZE]
+                await self.scheduler._pace(flow, len(data))
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": data,
+                        "more_body": more_body or start + _SLICE_SIZE < len(body),
+                    }
+                )
+
+        try:
+            await self.response(scope, receive, paced_send)
+        finally:
+            self.scheduler._close(flow)
+        if self.background is not None:
+            await self.background()
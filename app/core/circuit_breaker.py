@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   circuit_breaker.py
+@Time    :   2024/05/29 20:42:15
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   upstream health, circuit breaker and hedged requests
+"""
+
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+import httpx
+from loguru import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# the upstream is in trouble, other status is the answer of the request itself
+FAILURE_STATUS = frozenset((500, 502, 503, 504))
+# latency samples of a host before its percentile is trusted
+_MIN_SAMPLES = 20
+
+Send = Callable[[], Awaitable[httpx.Response]]
+
+
+class UpstreamUnavailable(Exception):
+    """the circuit of the host is open, the request is not sent"""
+
+    def __init__(self, host: str, retry_after: float) -> None:
+        super().__init__(f"{host} is unavailable, retry after {retry_after:.0f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class _Health(object):
+    __slots__ = ("state", "failures", "opened_at", "probes", "latencies")
+
+    def __init__(self, window: int) -> None:
+        self.state = CLOSED
+        # consecutive failures
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+
+class CircuitBreaker(object):
+    """Health of every upstream host.
+
+    - `failure_threshold` consecutive failures (transport error or 5xx)
+        open the circuit, requests fail fast without touching the upstream.
+    - After `recovery_time` seconds it is half open, `half_open_probes`
+        requests are let through. A success close it, a failure open it again.
+    - With hedging, a bodyless request which is slower than the latency
+        percentile of the host is sent once more, the first answer win.
+        At most `max_hedge_ratio` of the requests are hedged.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_time: float = 30,
+        half_open_probes: int = 1,
+        latency_window: int = 200,
+        max_hedge_ratio: float = 0.1,
+        max_hosts: int = 4096,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_probes = half_open_probes
+        self.latency_window = latency_window
+        self.max_hedge_ratio = max_hedge_ratio
+        self.max_hosts = max_hosts
+        self._hosts: "OrderedDict[str, _Health]" = OrderedDict()
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _health(self, host: str) -> _Health:
+        health = self._hosts.get(host)
+        if health is None:
+            health = self._hosts[host] = _Health(self.latency_window)
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        return health
+
+    def _retry_after(self, health: _Health) -> float:
+        return max(0.0, health.opened_at + self.recovery_time - time.monotonic())
+
+    def check(self, host: str) -> None:
+        """raise `UpstreamUnavailable` while the circuit is open, send nothing"""
+        health = self._hosts.get(host)
+        if health is None or health.state == CLOSED:
+            return
+        if health.state == OPEN and self._retry_after(health) > 0:
+            self.rejected += 1
+            raise UpstreamUnavailable(host, self._retry_after(health))
+        if health.state == HALF_OPEN and health.probes >= self.half_open_probes:
+            self.rejected += 1
+            raise UpstreamUnavailable(host, 1)
+
+    def _acquire(self, host: str) -> bool:
+        """return True if the request is a probe of the half open circuit"""
+        health = self._health(host)
+        self.check(host)
+        if health.state == OPEN:
+            health.state = HALF_OPEN
+            logger.info(f"circuit of {host} is half open")
+        if health.state == HALF_OPEN:
+            health.probes += 1
+            return True
+        return False
+
+    def _success(self, host: str, probe: bool, latency: float) -> None:
+        health = self._health(host)
+        health.failures = 0
+        health.latencies.append(latency)
+        if probe:
+            health.probes -= 1
+        if health.state != CLOSED:
+            health.state = CLOSED
+            health.probes = 0
+            logger.info(f"circuit of {host} is closed")
+
+    def _failure(self, host: str, probe: bool, error: str) -> None:
+        self.failures += 1
+        health = self._health(host)
+        health.failures += 1
+        if probe:
+            health.probes -= 1
+        if health.state == HALF_OPEN or (
+            health.state == CLOSED and health.failures >= self.failure_threshold
+        ):
+            health.state = OPEN
+            health.opened_at = time.monotonic()
+            logger.warning(
+                f"circuit of {host} is open for {self.recovery_time}s: {error}"
+            )
+
+    def _release(self, host: str, probe: bool) -> None:
+        """the request is cancelled, nothing is learnt"""
+        if probe:
+            self._health(host).probes -= 1
+
+    def latency_percentile(self, host: str, percent: float) -> Optional[float]:
+        """seconds to response headers, None before enough samples"""
+        health = self._hosts.get(host)
+        if health is None or len(health.latencies) < _MIN_SAMPLES:
+            return None
+        values = sorted(health.latencies)
+        index = min(len(values) - 1, int(len(values) * percent / 100))
+        return values[index]
+
+    def _hedge_delay(
+        self, host: str, percent: float, min_delay: float
+    ) -> Optional[float]:
+        if self.hedged >= self.requests * self.max_hedge_ratio:
+            return None
+        latency = self.latency_percentile(host, percent)
+        if latency is None:
+            return None
+        return max(min_delay, latency)
+
+    async def call(
+        self,
+        host: str,
+        send: Send,
+        hedge_percentile: Optional[float] = None,
+        min_hedge_delay: float = 0.05,
+    ) -> httpx.Response:
+        """send through the circuit of `host`
+
+        `hedge_percentile` is only given for idempotent request without body,
+        it may be sent twice.
+        """
+        probe = self._acquire(host)
+        self.requests += 1
+        delay = None
+        if hedge_percentile is not None and not probe:
+            delay = self._hedge_delay(host, hedge_percentile, min_hedge_delay)
+        start = time.monotonic()
+        try:
+            if delay is None:
+                response = await send()
+            else:
+                response = await self._hedged(send, delay)
+        except httpx.TransportError as e:
+            self._failure(host, probe, f"{type(e).__name__}: {e}")
+            raise
+        except BaseException:
+            self._release(host, probe)
+            raise
+        if response.status_code in FAILURE_STATUS:
+            self._failure(host, probe, f"status {response.status_code}")
+        else:
+            self._success(host, probe, time.monotonic() - start)
+        return response
+
+    async def _hedged(self, send: Send, delay: float) -> httpx.Response:
+        """first answer of the request and its copy sent after `delay`"""
+        pending: Set["asyncio.Future[httpx.Response]"] = {asyncio.ensure_future(send())}
+        hedge: Optional["asyncio.Future[httpx.Response]"] = None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=delay if hedge is None else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is not None:
+                    # both may have answered in the same round
+                    for task in done:
+                        if task is not winner and task.exception() is None:
+                            await task.result().aclose()
+                    if winner is hedge:
+                        self.hedge_wins += 1
+                    return winner.result()
+                for task in done:
+                    error = task.exception()
+                if hedge is None and pending:
+                    # slower than usual, race a copy of the request
+                    self.hedged += 1
+                    hedge = asyncio.ensure_future(send())
+                    pending.add(hedge)
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            await self._close_losers(pending)
+
+    @staticmethod
+    async def _close_losers(tasks: Set["asyncio.Future[httpx.Response]"]) -> None:
+        """the cancelled request may have got its response already"""
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, httpx.Response):
+                await result.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hosts": {
+                host: health.state
+                for host, health in self._hosts.items()
+                if health.state != CLOSED
+            },
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
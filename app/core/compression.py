@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   compression.py
+@Time    :   2024/06/01 15:26:40
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   accept-encoding negotiation, compress middleware and encoded body cache
+"""
+
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.content_coding import (
+    ContentEncoder,
+    get_encoder,
+    is_compressible,
+    negotiate_encoding,
+)
+from app.core.memory_budget import MemoryBudget
+
+# the body is not the whole representation, or there is no body
+_SKIP_STATUS = (204, 206, 304)
+
+
+def should_compress(headers: Headers, status_code: int, minimum_size: int) -> bool:
+    """response headers allow to add a content-encoding"""
+    if status_code in _SKIP_STATUS or status_code < 200:
+        return False
+    if "content-encoding" in headers or "content-range" in headers:
+        return False
+    if not is_compressible(headers.get("content-type")):
+        return False
+    length = headers.get("content-length")
+    return not (length is not None and length.isdigit() and int(length) < minimum_size)
+
+
+def add_vary_accept_encoding(headers: MutableHeaders) -> None:
+    if "accept-encoding" not in headers.get("vary", "").lower():
+        headers.add_vary_header("accept-encoding")
+
+
+def set_encoding_headers(headers: MutableHeaders, encoding: str) -> None:
+    """the length is unknown, and the bytes differ from the identity ones"""
+    headers["content-encoding"] = encoding
+    if "content-length" in headers:
+        del headers["content-length"]
+    add_vary_accept_encoding(headers)
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        headers["etag"] = "W/" + etag
+
+
+class EncodedCache(object):
+    """Compressed bodies of the stored responses, lru sized in bytes.
+
+    The key identify the stored body and the transform of it, each encoding
+    of a body is compressed once.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 64 * 1024 * 1024,
+        max_object_size: int = 4 * 1024 * 1024,
+        memory_budget: Optional[MemoryBudget] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        # the bodies being encoded, the stored ones are sized by `max_size`
+        self.memory_budget = memory_budget
+        self._bodies: "OrderedDict[str, bytes]" = OrderedDict()
+        self._used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        body = self._bodies.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self._bodies.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: str, body: bytes) -> None:
+        if len(body) > self.max_object_size:
+            return
+        old = self._bodies.pop(key, None)
+        if old is not None:
+            self._used -= len(old)
+        self._bodies[key] = body
+        self._used += len(body)
+        while self._used > self.max_size:
+            _, old = self._bodies.popitem(last=False)
+            self._used -= len(old)
+
+    async def encode(
+        self, key: str, stream: AsyncIterator[bytes], encoder: ContentEncoder
+    ) -> AsyncIterator[bytes]:
+        """encode the stream, and keep the result if it is complete and small
+
+        The result is not kept if the memory budget is used up.
+        """
+        parts: Optional[List[bytes]] = []
+        size = 0
+        try:
+            async for chunk in stream:
+                if not chunk:
+                    continue
+                data = encoder.compress(chunk)
+                if parts is not None:
+                    if size + len(data) <= self.max_object_size and self._reserve(
+                        len(data)
+                    ):
+                        parts.append(data)
+                        size += len(data)
+                    else:
+                        parts = None
+                        self._release(size)
+                        size = 0
+                yield data
+            data = encoder.finish()
+            if parts is not None and size + len(data) <= self.max_object_size:
+                parts.append(data)
+                self.put(key, b"".join(parts))
+            yield data
+        finally:
+            self._release(size)
+
+    def _reserve(self, size: int) -> bool:
+        return self.memory_budget is None or self.memory_budget.reserve(size)
+
+    def _release(self, size: int) -> None:
+        if size and self.memory_budget is not None:
+            self.memory_budget.release(size)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._bodies),
+            "bytes": self._used,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class CompressionMiddleware(object):
+    """Compress the response with the best coding the client accept (br/zstd/gzip).
+
+    Replace `GZipMiddleware`: a response which is already encoded, is a
+    range, or is not text like (images, video, archives) is sent untouched.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 200,
+        levels: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = levels
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(
+            self.app, encoding, self.minimum_size, self.levels
+        )
+        await responder(scope, receive, send)
+
+
+class _CompressionResponder(object):
+    def __init__(
+        self,
+        app: ASGIApp,
+        encoding: str,
+        minimum_size: int,
+        levels: Optional[Dict[str, int]],
+    ) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.levels = levels
+        self.send: Send
+        self.start: Optional[Message] = None
+        # None until the first body message decide it
+        self.encoder: Optional[ContentEncoder] = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    async def send_with_compression(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            if should_compress(headers, message["status"], self.minimum_size):
+                # wait for the first body, a small one is not worth it
+                self.start = message
+            else:
+                self.passthrough = True
+                await self.send(message)
+            return
+        if self.passthrough or self.start is None:
+            # e.g. early hints before the start
+            await self.send(message)
+            return
+        if message_type != "http.response.body":
+            # zero-copy or path send, the body is not seen by us
+            self.passthrough = True
+            await self.send(self.start)
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.encoder is None:
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.encoder = get_encoder(self.encoding, self.levels)
+            headers = MutableHeaders(raw=list(self.start["headers"]))
+            set_encoding_headers(headers, self.encoding)
+            self.start["headers"] = headers.raw
+            await self.send(self.start)
+
+        data = self.encoder.compress(body) if body else b""
+        if not more_body:
+            data += self.encoder.finish()
+        await self.send(
+            {"type": "http.response.body", "body": data, "more_body": more_body}
+        )
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   content_coding.py
+@Time    :   2024/05/07 20:03:11
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   incremental decoders and encoders of http content-encoding
+"""
+
+import zlib
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional
+
+# optional dependency, same package as `httpx[brotli]` / `httpx[zstd]`
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    try:
+        import brotlicffi as brotli  # type: ignore
+    except ImportError:
+        brotli = None  # type: ignore
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+
+class ContentDecoder(object):
+    """decode a body piece by piece"""
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class DeflateDecoder(ContentDecoder):
+    # NOTE: some server send raw deflate stream without zlib header
+    def __init__(self) -> None:
+        self.first_attempt = True
+        self.decompressor = zlib.decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        was_first_attempt = self.first_attempt
+        self.first_attempt = False
+        try:
+            return self.decompressor.decompress(data)
+        except zlib.error:
+            if was_first_attempt:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decompress(data)
+            raise
+
+    def flush(self) -> bytes:
+        return self.decompressor.flush()
+
+
+class GZipDecoder(ContentDecoder):
+    def __init__(self) -> None:
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        return self.decompressor.flush()
+
+
+class BrotliDecoder(ContentDecoder):
+    def __init__(self) -> None:
+        self.decompressor = brotli.Decompressor()
+        # `brotli` use `process`, `brotlicffi` use `decompress`
+        if hasattr(self.decompressor, "decompress"):
+            self._decompress = self.decompressor.decompress
+        else:
+            self._decompress = self.decompressor.process
+
+    def decompress(self, data: bytes) -> bytes:
+        if not data:
+            return b""
+        return self._decompress(data)
+
+
+class ZStandardDecoder(ContentDecoder):
+    def __init__(self) -> None:
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        # a zstd body can be several frames
+        while data:
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        return b"".join(output)
+
+
+class MultiDecoder(ContentDecoder):
+    """`content-encoding: gzip, br` means gzip first and then br"""
+
+    def __init__(self, children: List[ContentDecoder]) -> None:
+        # decode in reverse order
+        self.children = list(reversed(children))
+
+    def decompress(self, data: bytes) -> bytes:
+        for child in self.children:
+            data = child.decompress(data)
+        return data
+
+    def flush(self) -> bytes:
+        data = b""
+        for child in self.children:
+            data = child.decompress(data) + child.flush()
+        return data
+
+
+SUPPORTED_DECODERS = {
+    "identity": ContentDecoder,
+    "gzip": GZipDecoder,
+    "x-gzip": GZipDecoder,
+    "deflate": DeflateDecoder,
+}
+if brotli is not None:
+    SUPPORTED_DECODERS["br"] = BrotliDecoder
+if zstandard is not None:
+    SUPPORTED_DECODERS["zstd"] = ZStandardDecoder
+
+
+def parse_content_encoding(value: str) -> List[str]:
+    """`gzip, br` -> ["gzip", "br"]"""
+    return [v.strip().lower() for v in value.split(",") if v.strip()]
+
+
+def get_decoder(content_encoding: str) -> Optional[ContentDecoder]:
+    """build decoder of the content-encoding header value, None if not supported"""
+    decoders = []
+    for encoding in parse_content_encoding(content_encoding):
+        decoder_cls = SUPPORTED_DECODERS.get(encoding)
+        if decoder_cls is None:
+            return None
+        decoders.append(decoder_cls())
+
+    if not decoders:
+        return ContentDecoder()
+    if len(decoders) == 1:
+        return decoders[0]
+    return MultiDecoder(decoders)
+
+
+def filter_accept_encoding(value: str) -> str:
+    """keep only the codings we can decode in `accept-encoding` request header
+
+    So we can always decode the upstream body when rewrite is needed.
+    """
+    accepted = []
+    for item in value.split(","):
+        coding = item.split(";", 1)[0].strip().lower()
+        if coding in SUPPORTED_DECODERS:
+            accepted.append(item.strip())
+    return ", ".join(accepted) or "identity"
+
+
+async def decode_stream(
+    stream: AsyncIterator[bytes], decoder: ContentDecoder
+) -> AsyncIterator[bytes]:
+    """decode the raw body stream"""
+    async for chunk in stream:
+        data = decoder.decompress(chunk)
+        if data:
+            yield data
+    data = decoder.flush()
+    if data:
+        yield data
+
+
+class ContentEncoder(ABC):
+    """encode a body piece by piece, every piece can be decoded once it is sent"""
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """encoded `data`, flushed so the client can decode it now"""
+
+    @abstractmethod
+    def finish(self) -> bytes:
+        """the end of the encoded body"""
+
+
+class GZipEncoder(ContentEncoder):
+    def __init__(self, level: int = 6) -> None:
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder(ContentEncoder):
+    def __init__(self, level: int = 4) -> None:
+        self.compressor = brotli.Compressor(quality=level)
+        # `brotli` use `process`, `brotlicffi` use `compress`
+        if hasattr(self.compressor, "process"):
+            self._compress = self.compressor.process
+        else:
+            self._compress = self.compressor.compress
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress(data) + self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZStandardEncoder(ContentEncoder):
+    def __init__(self, level: int = 3) -> None:
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+# preferred first when the client accept them equally
+SUPPORTED_ENCODERS = {"gzip": GZipEncoder}
+if zstandard is not None:
+    SUPPORTED_ENCODERS = {"zstd": ZStandardEncoder, **SUPPORTED_ENCODERS}
+if brotli is not None:
+    SUPPORTED_ENCODERS = {"br": BrotliEncoder, **SUPPORTED_ENCODERS}
+
+# text like types, media and archives are already compressed
+_COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/x-javascript",
+    "application/ecmascript",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/rss+xml",
+    "application/atom+xml",
+    "application/manifest+json",
+    "application/ld+json",
+    "application/wasm",
+    "application/x-font-ttf",
+    "application/vnd.ms-fontobject",
+    "font/ttf",
+    "font/otf",
+    "image/svg+xml",
+    "image/x-icon",
+    "image/vnd.microsoft.icon",
+    "image/bmp",
+)
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type.startswith(_COMPRESSIBLE_TYPES) or media_type.endswith(
+        ("+json", "+xml")
+    )
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """the best coding of `accept-encoding` we can encode, None means identity
+
+    https://www.rfc-editor.org/rfc/rfc9110#section-12.5.3
+    """
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding] = weight
+
+    best: Optional[str] = None
+    best_weight = 0.0
+    for coding in SUPPORTED_ENCODERS:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def get_encoder(
+    encoding: str, levels: Optional[Dict[str, int]] = None
+) -> ContentEncoder:
+    encoder_cls = SUPPORTED_ENCODERS[encoding]
+    if levels and encoding in levels:
+        return encoder_cls(levels[encoding])
+    return encoder_cls()
+
+
+async def encode_stream(
+    stream: AsyncIterator[bytes], encoder: ContentEncoder
+) -> AsyncIterator[bytes]:
+    """encode the body stream, each chunk is flushed so the client can render it"""
+    async for chunk in stream:
+        if chunk:
+            yield encoder.compress(chunk)
+    yield encoder.finish()
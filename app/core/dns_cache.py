@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   dns_cache.py
+@Time    :   2024/05/26 14:18:51
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   async dns cache and happy eyeballs connect for the upstream pools
+"""
+
+import time
+import socket
+import asyncio
+import ipaddress
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import httpcore
+from loguru import logger
+
+# optional dependency, real async resolver with the record ttl
+try:
+    import aiodns
+except ImportError:  # pragma: no cover
+    aiodns = None
+
+# RFC 8305 connection attempt delay
+_ATTEMPT_DELAY = 0.25
+# refresh a hot entry in background when this part of the ttl is left
+_REFRESH_RATIO = 0.2
+# lookups of an entry before it is hot
+_HOT_HITS = 2
+
+
+class DNSResolveError(Exception):
+    """the host has no address, cached as negative entry"""
+
+
+class _Entry(object):
+    __slots__ = ("addresses", "expire_at", "ttl", "hits", "error")
+
+    def __init__(
+        self, addresses: List[str], ttl: float, error: Optional[str] = None
+    ) -> None:
+        self.addresses = addresses
+        self.ttl = ttl
+        self.expire_at = time.monotonic() + ttl
+        self.hits = 0
+        self.error = error
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def interleave_families(addresses: List[str], first_ipv6: bool = True) -> List[str]:
+    """RFC 8305 order: alternate ipv6 and ipv4, begin with the preferred family"""
+    v6 = [a for a in addresses if ":" in a]
+    v4 = [a for a in addresses if ":" not in a]
+    first, second = (v6, v4) if first_ipv6 else (v4, v6)
+    ordered: List[str] = []
+    for i in range(max(len(first), len(second))):
+        ordered.extend(group[i] for group in (first, second) if i < len(group))
+    return ordered
+
+
+class DNSCache(object):
+    """Resolve hostname once per ttl, shared by every upstream pool.
+
+    - The record ttl is used with `aiodns`, otherwise `default_ttl`
+        (`getaddrinfo` can not tell the ttl), clamped to `[min_ttl, max_ttl]`.
+    - Failed lookup is cached `negative_ttl` seconds.
+    - Hot hostname is resolved again in background before it expire,
+        so the request never wait for the resolver.
+    - Concurrent lookups of one hostname share one query.
+    """
+
+    def __init__(
+        self,
+        default_ttl: float = 300,
+        min_ttl: float = 10,
+        max_ttl: float = 3600,
+        negative_ttl: float = 30,
+        max_entries: int = 4096,
+    ) -> None:
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._pending: Dict[str, "asyncio.Future[_Entry]"] = {}
+        self._refreshing: Set[str] = set()
+        # family of the last success connection, preferred by the next one
+        self._prefer_ipv6: Dict[str, bool] = {}
+        self._resolver: Any = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def _clamp(self, ttl: float) -> float:
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    async def _query_aiodns(self, host: str) -> Tuple[List[str], float]:
+        if self._resolver is None:
+            self._resolver = aiodns.DNSResolver()
+        results = await asyncio.gather(
+            self._resolver.query(host, "AAAA"),
+            self._resolver.query(host, "A"),
+            return_exceptions=True,
+        )
+        addresses: List[str] = []
+        ttls: List[float] = []
+        for result in results:
+            if isinstance(result, BaseException):
+                continue
+            for record in result:
+                addresses.append(record.host)
+                ttls.append(record.ttl)
+        if not addresses:
+            # e.g. /etc/hosts name, let the system resolver answer
+            return await self._query_system(host)
+        return addresses, min(ttls)
+
+    async def _query_system(self, host: str) -> Tuple[List[str], float]:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses: List[str] = []
+        for _, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses, self.default_ttl
+
+    async def _query(self, host: str) -> _Entry:
+        try:
+            if aiodns is not None:
+                addresses, ttl = await self._query_aiodns(host)
+            else:
+                addresses, ttl = await self._query_system(host)
+        except Exception as e:
+            return _Entry([], self.negative_ttl, error=f"{type(e).__name__}: {e}")
+        if not addresses:
+            return _Entry([], self.negative_ttl, error="no address")
+        return _Entry(addresses, self._clamp(ttl))
+
+    def _store(self, host: str, entry: _Entry) -> None:
+        current = self._entries.get(host)
+        if (
+            entry.error is not None
+            and current is not None
+            and current.error is None
+            and current.expire_at > time.monotonic()
+        ):
+            # failed background refresh, keep the good addresses until expired
+            return
+        self._entries[host] = entry
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._prefer_ipv6.pop(evicted, None)
+
+    async def _resolve_shared(self, host: str) -> _Entry:
+        future = self._pending.get(host)
+        if future is None:
+            future = asyncio.ensure_future(self._query(host))
+            self._pending[host] = future
+
+            def done(f: "asyncio.Future[_Entry]") -> None:
+                self._pending.pop(host, None)
+                if not f.cancelled():
+                    self._store(host, f.result())
+
+            future.add_done_callback(done)
+        # the query go on and is stored even if this caller is cancelled
+        return await asyncio.shield(future)
+
+    async def _refresh(self, host: str) -> None:
+        try:
+            entry = await self._resolve_shared(host)
+            if entry.error is not None:
+                logger.warning(f"dns refresh {host} fail: {entry.error}")
+        finally:
+            self._refreshing.discard(host)
+
+    async def resolve(self, host: str) -> List[str]:
+        """addresses of the host in happy eyeballs order"""
+        if _is_ip(host):
+            return [host]
+        now = time.monotonic()
+        entry = self._entries.get(host)
+        if entry is None or entry.expire_at <= now:
+            self.misses += 1
+            entry = await self._resolve_shared(host)
+        else:
+            self.hits += 1
+            entry.hits += 1
+            self._entries.move_to_end(host)
+            if (
+                entry.error is None
+                and entry.hits >= _HOT_HITS
+                and entry.expire_at - now <= entry.ttl * _REFRESH_RATIO
+                and host not in self._refreshing
+            ):
+                self._refreshing.add(host)
+                self.refreshes += 1
+                asyncio.ensure_future(self._refresh(host))
+
+        if entry.error is not None:
+            raise DNSResolveError(f"{host}: {entry.error}")
+        return interleave_families(entry.addresses, self._prefer_ipv6.get(host, True))
+
+    def connected(self, host: str, address: str) -> None:
+        self._prefer_ipv6[host] = ":" in address
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """httpcore network backend, resolve with `DNSCache` and connect the
+    addresses with happy eyeballs (RFC 8305).
+
+    TLS server name is still the hostname, httpcore pass it by itself.
+    """
+
+    def __init__(
+        self,
+        dns_cache: DNSCache,
+        backend: Optional[httpcore.AsyncNetworkBackend] = None,
+        attempt_delay: float = _ATTEMPT_DELAY,
+    ) -> None:
+        self.dns_cache = dns_cache
+        self.backend = backend or httpcore.AnyIOBackend()
+        self.attempt_delay = attempt_delay
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float] = None,
+        local_address: Optional[str] = None,
+        socket_options: Optional[Iterable[Any]] = None,
+    ) -> httpcore.AsyncNetworkStream:
+        try:
+            addresses = await asyncio.wait_for(self.dns_cache.resolve(host), timeout)
+        except (DNSResolveError, asyncio.TimeoutError) as e:
+            raise httpcore.ConnectError(str(e) or f"resolve {host} timeout") from e
+        if socket_options is not None:
+            # reused by every attempt
+            socket_options = list(socket_options)
+
+        errors: List[BaseException] = []
+        pending: Set["asyncio.Future[Tuple[str, httpcore.AsyncNetworkStream]]"] = set()
+
+        async def attempt(address: str) -> Tuple[str, httpcore.AsyncNetworkStream]:
+            stream = await self.backend.connect_tcp(
+                address,
+                port,
+                timeout=timeout,
+                local_address=local_address,
+                socket_options=socket_options,
+            )
+            return address, stream
+
+        try:
+            for address in addresses:
+                pending.add(asyncio.ensure_future(attempt(address)))
+                winner = await self._first_success(pending, errors, self.attempt_delay)
+                if winner is not None:
+                    break
+            else:
+                winner = None
+                while pending and winner is None:
+                    winner = await self._first_success(pending, errors, None)
+        finally:
+            for task in pending:
+                task.cancel()
+            await self._close_losers(pending)
+
+        if winner is None:
+            raise errors[-1] if errors else httpcore.ConnectError(host)
+        address, stream = winner
+        self.dns_cache.connected(host, address)
+        return stream
+
+    @staticmethod
+    async def _first_success(
+        pending: Set["asyncio.Future[Tuple[str, httpcore.AsyncNetworkStream]]"],
+        errors: List[BaseException],
+        timeout: Optional[float],
+    ) -> Optional[Tuple[str, httpcore.AsyncNetworkStream]]:
+        if not pending:
+            return None
+        done, _ = await asyncio.wait(
+            pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        winner = None
+        for task in done:
+            pending.discard(task)
+            error = task.exception()
+            if error is not None:
+                errors.append(error)
+            elif winner is None:
+                winner = task.result()
+            else:
+                await task.result()[1].aclose()
+        return winner
+
+    @staticmethod
+    async def _close_losers(
+        tasks: Set["asyncio.Future[Tuple[str, httpcore.AsyncNetworkStream]]"],
+    ) -> None:
+        """the cancelled attempt may be connected already"""
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, tuple):
+                await result[1].aclose()
+
+    async def connect_unix_socket(
+        self,
+        path: str,
+        timeout: Optional[float] = None,
+        socket_options: Optional[Iterable[Any]] = None,
+    ) -> httpcore.AsyncNetworkStream:
+        return await self.backend.connect_unix_socket(
+            path, timeout=timeout, socket_options=socket_options
+        )
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   early_hints.py
+@Time    :   2024/05/27 21:05:44
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   remember the critical subresources of pages, preload hints and cache warming
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+# (absolute upstream url, preload `as` destination)
+Resource = Tuple[str, str]
+ResourceCallback = Callable[[str, str], None]
+
+# https://developer.mozilla.org/en-US/docs/Web/HTML/Attributes/rel/preload
+# fonts are always fetched in cors mode, the preload must match it
+_CROSSORIGIN_DESTINATIONS = ("font", "fetch")
+
+
+def preload_link(url: str, destination: str) -> str:
+    """value of `link` header, `url` is already mapped to the proxy"""
+    link = f"<{url}>; rel=preload; as={destination}"
+    if destination in _CROSSORIGIN_DESTINATIONS:
+        link += "; crossorigin"
+    return link
+
+
+class PreloadHints(object):
+    """page url -> critical subresources found in its last response
+
+    The resources are known only after the document is parsed, so the hints
+    are served to the next request of the page, before upstream answer.
+    """
+
+    def __init__(self, max_pages: int = 1024, max_resources: int = 8) -> None:
+        self.max_pages = max_pages
+        self.max_resources = max_resources
+        self._pages: "OrderedDict[str, List[Resource]]" = OrderedDict()
+        self.hinted = 0
+
+    def get(self, page_url: str) -> List[Resource]:
+        resources = self._pages.get(page_url)
+        if not resources:
+            return []
+        self._pages.move_to_end(page_url)
+        self.hinted += 1
+        return list(resources)
+
+    def collector(
+        self, page_url: str, on_new: Optional[ResourceCallback] = None
+    ) -> ResourceCallback:
+        """callback of the html rewriter, the first resource replace the old hints"""
+        resources: List[Resource] = []
+        seen: Set[str] = set()
+
+        def collect(url: str, destination: str) -> None:
+            if url in seen or len(resources) >= self.max_resources:
+                return
+            seen.add(url)
+            if not resources:
+                self._pages[page_url] = resources
+                self._pages.move_to_end(page_url)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+            resources.append((url, destination))
+            if on_new is not None:
+                on_new(url, destination)
+
+        return collect
+
+    def stats(self) -> Dict[str, int]:
+        return {"pages": len(self._pages), "hinted": self.hinted}
+
+
+class Prefetcher(object):
+    """run the cache warming fetches in background, bounded and deduplicated"""
+
+    def __init__(self, concurrency: int = 4, max_pending: int = 256) -> None:
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        # created in the running loop, python 3.9 bind it to the loop at creation
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: Set[str] = set()
+        self.prefetched = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def schedule(self, url: str, fetch: Callable[[], Awaitable[Any]]) -> None:
+        if url in self._pending or len(self._pending) >= self.max_pending:
+            self.skipped += 1
+            return
+        self._pending.add(url)
+        asyncio.ensure_future(self._run(url, fetch))
+
+    async def _run(self, url: str, fetch: Callable[[], Awaitable[Any]]) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._semaphore:
+                await fetch()
+            self.prefetched += 1
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"background fetch {url} fail: {e!r}")
+        finally:
+            self._pending.discard(url)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "prefetched": self.prefetched,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
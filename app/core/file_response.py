@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   file_response.py
+@Time    :   2024/05/30 21:17:08
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   zero-copy response of a slice of local file
+"""
+
+import os
+from typing import BinaryIO, Optional
+
+import anyio
+from starlette.background import BackgroundTask
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# https://asgi.readthedocs.io/en/latest/extensions.html#zero-copy-send
+_ZERO_COPY_SEND = "http.response.zerocopysend"
+
+# one thread hop per chunk when the server can not send the file itself
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def open_file(path: Optional[str]) -> Optional[BinaryIO]:
+    """open before the response is built, the cache may delete the file meanwhile
+
+    None if the file is already gone.
+    """
+    if path is None:
+        return None
+    try:
+        return open(path, "rb", buffering=0)
+    except FileNotFoundError:
+        return None
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class FileSliceResponse(Response):
+    """Send `count` bytes of an opened file from `offset`, the file is closed after.
+
+    The file is handed to the server with the ASGI zero-copy send extension
+    (the server `sendfile` it), otherwise it is read with `pread` in worker
+    thread by big chunks.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        offset: int,
+        count: int,
+        status_code: int,
+        headers: MutableHeaders,
+        background: Optional[BackgroundTask] = None,
+    ) -> None:
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.status_code = status_code
+        self.background = background
+        # NOTE: take the raw headers directly, duplicate headers are kept
+        self.raw_headers = headers.raw
+        self.headers["content-length"] = str(count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            if scope.get("method", "GET").upper() == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+            elif _ZERO_COPY_SEND in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": _ZERO_COPY_SEND,
+                        "file": self.file,
+                        "offset": self.offset,
+                        "count": self.count,
+                        "more_body": False,
+                    }
+                )
+            else:
+                async with anyio.create_task_group() as task_group:
+
+                    async def send_file() -> None:
+                        await self._send_chunks(send)
+                        task_group.cancel_scope.cancel()
+
+                    task_group.start_soon(send_file)
+                    # stop reading the file when the client is gone
+                    while True:
+                        message = await receive()
+                        if message["type"] == "http.disconnect":
+                            task_group.cancel_scope.cancel()
+                            break
+        finally:
+            self.file.close()
+
+        if self.background is not None:
+            await self.background()
+
+    async def read(self) -> bytes:
+        """the whole slice instead of sending it, the file is closed"""
+        try:
+            return await anyio.to_thread.run_sync(
+                _pread, self.file.fileno(), self.count, self.offset
+            )
+        finally:
+            self.file.close()
+
+    async def _send_chunks(self, send: Send) -> None:
+        fd = self.file.fileno()
+        offset = self.offset
+        end = self.offset + self.count
+        while offset < end:
+            size = min(_READ_CHUNK_SIZE, end - offset)
+            data = await anyio.to_thread.run_sync(_pread, fd, size, offset)
+            if not data:
+                raise OSError(f"file is truncated at {offset}")
+            offset += len(data)
+            await send(
+                {"type": "http.response.body", "body": data, "more_body": offset < end}
+            )
+        if self.count == 0:
+            await send({"type": "http.response.body", "body": b""})
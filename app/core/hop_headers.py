@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   hop_headers.py
+@Time    :   2024/05/24 19:42:10
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   single pass hop-by-hop filter on raw (bytes, bytes) headers
+"""
+
+from typing import Iterable, List, Set, Tuple
+
+RawHeaders = List[Tuple[bytes, bytes]]
+
+# https://datatracker.ietf.org/doc/html/rfc7230#section-6.1
+# proxy-* are for the proxy itself, never forwarded
+HOP_BY_HOP_HEADERS = frozenset(
+    (
+        b"connection",
+        b"keep-alive",
+        b"proxy-connection",
+        b"proxy-authenticate",
+        b"proxy-authorization",
+        b"te",
+        b"trailer",
+        b"transfer-encoding",
+        b"upgrade",
+    )
+)
+
+# connection options which are not header name
+_CONNECTION_OPTIONS = frozenset((b"close", b"keep-alive"))
+
+
+def _connection_tokens(value: bytes, tokens: Set[bytes]) -> bool:
+    """add the header names listed in `connection` to `tokens`, return whether `close`"""
+    close = False
+    for token in value.lower().split(b","):
+        token = token.strip()
+        if token == b"close":
+            close = True
+        elif token and token not in _CONNECTION_OPTIONS:
+            tokens.add(token)
+    return close
+
+
+def filter_request_headers(
+    raw: Iterable[Tuple[bytes, bytes]], host: bytes
+) -> Tuple[bool, RawHeaders]:
+    """Client request headers to upstream, ASGI header names are lowercase.
+
+    - Hop-by-hop headers and the headers named by `connection` are removed,
+        httpx manage the upstream connection by itself.
+    - `host` is replaced.
+    - Empty `cookie` is added if it is missing,
+        avoid httpx.AsyncClient add the cookie of its jar.
+
+    Returns:
+        (whether client require close, new raw headers)
+    """
+    headers: RawHeaders = []
+    tokens: Set[bytes] = set()
+    require_close = False
+    has_cookie = False
+    for name, value in raw:
+        if name in HOP_BY_HOP_HEADERS:
+            if name == b"connection" and _connection_tokens(value, tokens):
+                require_close = True
+            continue
+        if name == b"host":
+            continue
+        if name == b"cookie":
+            has_cookie = True
+        headers.append((name, value))
+
+    if tokens:
+        # rare, a second pass only when `connection` list extra headers
+        headers = [(k, v) for k, v in headers if k not in tokens]
+    headers.append((b"host", host))
+    if not has_cookie:
+        headers.append((b"cookie", b""))
+    return require_close, headers
+
+
+def filter_response_headers(
+    raw: Iterable[Tuple[bytes, bytes]], require_close: bool
+) -> RawHeaders:
+    """Upstream response headers to client, names are lowercased (httpx keep the case).
+
+    Hop-by-hop headers are removed, `connection: close` is added if client require it,
+    uvicorn close the connection after the response.
+    """
+    headers: RawHeaders = []
+    tokens: Set[bytes] = set()
+    for name, value in raw:
+        name = name.lower()
+        if name in HOP_BY_HOP_HEADERS:
+            if name == b"connection":
+                _connection_tokens(value, tokens)
+            continue
+        headers.append((name, value))
+
+    if tokens:
+        headers = [(k, v) for k, v in headers if k not in tokens]
+    if require_close:
+        headers.append((b"connection", b"close"))
+    return headers
+
+
+def encode_headers(headers: Iterable[Tuple[str, str]]) -> RawHeaders:
+    """str headers (e.g. stored in cache) to raw headers"""
+    return [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
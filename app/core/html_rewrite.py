@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   html_rewrite.py
+@Time    :   2024/05/06 21:12:40
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   incremental html tokenizer which rewrite url attributes chunk by chunk
+"""
+
+import re
+from html import unescape
+from urllib.parse import urljoin
+from typing import Callable, Dict, List, Optional
+
+from app.core.url_rewrite import (
+    StreamingTextRewriter,
+    UrlMapper,
+    css_stream_rewriter,
+    join_url,
+    js_stream_rewriter,
+    rewrite_css,
+    rewrite_srcset,
+)
+
+# `<tagname ...>` NOTE: quoted value may contain `>`
+_TAG_RE = re.compile(r"""<[a-zA-Z/!][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""")
+_TAG_NAME_RE = re.compile(r"<\s*([a-zA-Z][^\s/>]*)")
+_ATTR_RE = re.compile(
+    r"""(?P<prefix>[\s"'](?:xlink:)?(?P<name>src|href|content|srcset|imagesrcset"""
+    r"""|data-src|data-srcset|action|formaction|poster|background|data|style|integrity)"""
+    r"""\s*=\s*)(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^\s"'>]+))""",
+    re.I,
+)
+_BASE_HREF_RE = re.compile(
+    r"""[\s"']href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I
+)
+_ANY_ATTR_RE = re.compile(
+    r"""[\s"']([a-zA-Z_:][-\w:.]*)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))"""
+)
+_SCRIPT_TYPE_RE = re.compile(r"""[\s"']type\s*=\s*["']?([^"'\s>]*)""", re.I)
+
+_SRCSET_ATTRS = ("srcset", "imagesrcset", "data-srcset")
+# <meta http-equiv="refresh" content="0; url=/path">
+_REFRESH_RE = re.compile(r"^(\s*\d+\s*;\s*url\s*=\s*)(.*)$", re.I | re.S)
+
+# elements whose content is raw text, must not parse tag in it
+_RAWTEXT_ELEMENTS = ("script", "style", "textarea", "title")
+
+_STATE_TEXT = 0
+_STATE_COMMENT = 1
+_STATE_RAWTEXT = 2
+
+
+def _is_js_type(script_type: str) -> bool:
+    script_type = script_type.lower()
+    return (
+        not script_type
+        or script_type == "module"
+        or "javascript" in script_type
+        or "ecmascript" in script_type
+    )
+
+
+class StreamingHTMLRewriter(object):
+    """Rewrite the url of a html document chunk by chunk.
+
+    - url attributes (`src`, `href`, `srcset`, `action`, `poster`, meta `content`...)
+    - inline `style` attribute and `<style>` with the css rewriter
+    - absolute url string in `<script>` with the js rewriter
+    - `<base href>` change the base url of the following url
+
+    Only complete tags are rewritten, incomplete tail of a chunk is kept
+    until the next `feed`, so memory is bounded by `max_tag_size`.
+    Text and comments are forwarded untouched.
+
+    With a custom `url_mapper`, the `integrity` attribute is removed,
+    the rewritten stylesheet and script can not match the hash.
+
+    `on_resource(url, destination)` is called with the absolute url of
+    critical subresources: stylesheet, script and `<link rel=preload>`.
+
+    NOTE: feed `latin-1` decoded text to stay charset agnostic,
+    every byte round trip, and html syntax chars are all ascii.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        url_mapper: Optional[UrlMapper] = None,
+        max_tag_size: int = 64 * 1024,
+        on_resource: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        self.base_url = base_url
+        self.on_resource = on_resource
+        self.url_mapper: UrlMapper = url_mapper or join_url
+        self.drop_integrity = url_mapper is not None
+        self.max_tag_size = max_tag_size
+        self._buffer = ""
+        self._state = _STATE_TEXT
+        self._rawtext_end: Optional["re.Pattern[str]"] = None
+        self._rawtext_end_len = 0
+        # css or js rewriter of the current raw text element
+        self._inner: Optional[StreamingTextRewriter] = None
+
+    def feed(self, chunk: str) -> str:
+        """feed a piece of document, return the rewritten part which can be sent"""
+        buf = self._buffer + chunk if self._buffer else chunk
+        out: List[str] = []
+        pos = 0
+        length = len(buf)
+
+        while pos < length:
+            if self._state == _STATE_COMMENT:
+                end = buf.find("-->", pos)
+                if end == -1:
+                    # keep the tail which may be the beginning of `-->`
+                    keep = max(pos, length - 2)
+                    out.append(buf[pos:keep])
+                    pos = keep
+                    break
+                out.append(buf[pos : end + 3])
+                pos = end + 3
+                self._state = _STATE_TEXT
+                continue
+
+            if self._state == _STATE_RAWTEXT:
+                assert self._rawtext_end is not None
+                match = self._rawtext_end.search(buf, pos)
+                if match is None:
+                    keep = max(pos, length - self._rawtext_end_len + 1)
+                    out.append(self._feed_inner(buf[pos:keep]))
+                    pos = keep
+                    break
+                out.append(self._feed_inner(buf[pos : match.start()]))
+                if self._inner is not None:
+                    out.append(self._inner.flush())
+                    self._inner = None
+                pos = match.start()
+                self._state = _STATE_TEXT
+                continue
+
+            start = buf.find("<", pos)
+            if start == -1:
+                out.append(buf[pos:])
+                pos = length
+                break
+            out.append(buf[pos:start])
+            pos = start
+
+            rest = length - pos
+            if rest < 4 and "<!--".startswith(buf[pos:]):
+                # maybe a comment, wait more data
+                break
+            if buf.startswith("<!--", pos):
+                out.append("<!--")
+                pos += 4
+                self._state = _STATE_COMMENT
+                continue
+
+            match = _TAG_RE.match(buf, pos)
+            if match is None:
+                if rest < self.max_tag_size and (rest == 1 or _maybe_tag(buf, pos)):
+                    # incomplete tag, wait more data
+                    break
+                # not a tag or too large, forward as text
+                out.append("<")
+                pos += 1
+                continue
+
+            tag = match.group()
+            out.append(self.rewrite_tag(tag))
+            pos = match.end()
+
+            name_match = _TAG_NAME_RE.match(tag)
+            if name_match and not tag.endswith("/>"):
+                name = name_match.group(1).lower()
+                if name in _RAWTEXT_ELEMENTS:
+                    self._enter_rawtext(name, tag)
+
+        self._buffer = buf[pos:]
+        return "".join(out)
+
+    def flush(self) -> str:
+        """end of document, return everything still buffered"""
+        rest, self._buffer = self._buffer, ""
+        if self._state == _STATE_RAWTEXT and self._inner is not None:
+            rest = self._inner.feed(rest) + self._inner.flush()
+            self._inner = None
+        return rest
+
+    def _enter_rawtext(self, name: str, tag: str) -> None:
+        self._state = _STATE_RAWTEXT
+        self._rawtext_end = re.compile("</" + name, re.I)
+        self._rawtext_end_len = len(name) + 2
+        if name == "style":
+            self._inner = css_stream_rewriter(self.base_url, self.url_mapper)
+        elif name == "script":
+            script_type = _SCRIPT_TYPE_RE.search(tag)
+            if _is_js_type(script_type.group(1) if script_type else ""):
+                self._inner = js_stream_rewriter(self.base_url, self.url_mapper)
+
+    def _feed_inner(self, text: str) -> str:
+        if self._inner is None or not text:
+            return text
+        return self._inner.feed(text)
+
+    def rewrite_tag(self, tag: str) -> str:
+        """rewrite url attributes in a complete tag"""
+        if tag.startswith("</"):
+            return tag
+        name_match = _TAG_NAME_RE.match(tag)
+        tag_name = name_match.group(1).lower() if name_match else ""
+        if tag_name == "base":
+            self._update_base(tag)
+        elif self.on_resource is not None and tag_name in ("link", "script"):
+            self._find_resource(tag, tag_name)
+        return _ATTR_RE.sub(lambda m: self._rewrite_attr(m, tag_name), tag)
+
+    def _update_base(self, tag: str) -> None:
+        """the following relative url are joined with `<base href>`"""
+        match = _BASE_HREF_RE.search(tag)
+        if match is None:
+            return
+        href = next(g for g in match.groups() if g is not None)
+        self.base_url = urljoin(self.base_url, unescape(href).strip())
+
+    def _find_resource(self, tag: str, tag_name: str) -> None:
+        attrs: Dict[str, str] = {}
+        for match in _ANY_ATTR_RE.finditer(tag):
+            value = next(g for g in match.groups()[1:] if g is not None)
+            attrs.setdefault(match.group(1).lower(), unescape(value))
+
+        if tag_name == "script":
+            url, destination = attrs.get("src"), "script"
+        else:
+            rel = attrs.get("rel", "").lower().split()
+            url = attrs.get("href")
+            if "stylesheet" in rel:
+                destination = "style"
+            elif "preload" in rel and attrs.get("as"):
+                destination = attrs["as"].lower()
+            else:
+                return
+        if not url:
+            return
+        url = join_url(self.base_url, url)
+        if url.startswith(("http://", "https://")):
+            assert self.on_resource is not None
+            self.on_resource(url, destination)
+
+    def _rewrite_attr(self, match: "re.Match[str]", tag_name: str) -> str:
+        name = match.group("name").lower()
+        for quote, group in (('"', "dq"), ("'", "sq"), ("", "uq")):
+            value = match.group(group)
+            if value is not None:
+                break
+
+        if name == "integrity":
+            if not self.drop_integrity:
+                return match.group()
+            # keep the quote of the previous attribute
+            lead = match.group("prefix")[0]
+            return lead if lead in "\"'" else ""
+
+        # `&amp;` in attribute is `&` in url
+        text = unescape(value) if "&" in value else value
+        if name == "content":
+            new_text = self._rewrite_content(text, tag_name)
+        elif name in _SRCSET_ATTRS:
+            new_text = rewrite_srcset(self.base_url, text, self.url_mapper)
+        elif name == "style":
+            new_text = rewrite_css(self.base_url, text, self.url_mapper)
+        else:
+            new_text = self.url_mapper(self.base_url, text)
+
+        if new_text == text:
+            return match.group()
+        if not quote:
+            quote = '"'
+        new_value = new_text.replace("&", "&amp;").replace(quote, "&#%d;" % ord(quote))
+        # the document is latin-1 text, keep the unescaped non latin-1 char as reference
+        new_value = new_value.encode("latin-1", "xmlcharrefreplace").decode("latin-1")
+        return match.group("prefix") + quote + new_value + quote
+
+    def _rewrite_content(self, value: str, tag_name: str) -> str:
+        """`content` only carry url in <meta>, e.g. refresh and og:image"""
+        if tag_name != "meta":
+            return value
+        refresh = _REFRESH_RE.match(value)
+        if refresh:
+            return refresh.group(1) + self.url_mapper(self.base_url, refresh.group(2))
+        stripped = value.strip()
+        if stripped.startswith(("http://", "https://", "//", "/")):
+            return self.url_mapper(self.base_url, value)
+        return value
+
+
+def _maybe_tag(buf: str, pos: int) -> bool:
+    """`<` followed by letter, `/` or `!` can be an unfinished tag"""
+    nxt = buf[pos + 1]
+    return nxt.isalpha() or nxt in "/!"
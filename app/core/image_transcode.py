@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   image_transcode.py
+@Time    :   2024/06/09 16:05:33
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   transcode proxied images to avif/webp in a process pool, by accept
+"""
+
+import sys
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Dict, List, Optional, Sequence
+
+from PIL import Image, ImageOps, features
+
+# the images which are worth to transcode, gif may be animated
+TRANSCODABLE_TYPES = ("image/jpeg", "image/jpg", "image/png", "image/bmp")
+
+# pillow save format and the encoder options, tuned for on-the-fly encoding
+_FORMATS = {
+    "avif": ("AVIF", {"speed": 8}),
+    "webp": ("WEBP", {"method": 4}),
+}
+
+# (pixels up to, avif quality, webp quality), a large image hide more artifacts
+_QUALITY = (
+    (256 * 256, 70, 85),
+    (1024 * 1024, 60, 80),
+    (sys.maxsize, 50, 72),
+)
+
+# the saving of a tiny image does not pay the process hop
+_MIN_INPUT_SIZE = 1024
+
+
+def is_transcodable(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    return content_type.split(";")[0].strip().lower() in TRANSCODABLE_TYPES
+
+
+def _quality(image_format: str, pixels: int) -> int:
+    for limit, avif, webp in _QUALITY:
+        if pixels <= limit:
+            break
+    return avif if image_format == "avif" else webp
+
+
+def transcode_image(data: bytes, image_format: str, max_pixels: int) -> bytes:
+    """encode the image to `image_format`, run in the worker process"""
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    save_format, options = _FORMATS[image_format]
+    with Image.open(BytesIO(data)) as source:
+        icc_profile = source.info.get("icc_profile")
+        # the orientation of exif is lost with the exif
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        output = BytesIO()
+        image.save(
+            output,
+            save_format,
+            quality=_quality(image_format, image.width * image.height),
+            icc_profile=icc_profile,
+            **options,
+        )
+    return output.getvalue()
+
+
+class ImageTranscoder(object):
+    """Transcode images to the best format the client accept, in a process pool.
+
+    The results are kept in a lru sized in bytes, the key is given by the
+    caller (url + validator + format). A result not smaller than the
+    original is remembered as empty, the original is sent then.
+    """
+
+    def __init__(
+        self,
+        formats: Sequence[str] = ("avif", "webp"),
+        workers: int = 2,
+        max_input_size: int = 8 * 1024 * 1024,
+        cache_size: int = 64 * 1024 * 1024,
+        max_pixels: int = 40 * 1000 * 1000,
+    ) -> None:
+        # the formats this pillow can encode, in order of preference
+        self.formats: List[str] = [
+            f for f in formats if f in _FORMATS and features.check(f)
+        ]
+        self.workers = workers
+        self.max_input_size = max_input_size
+        self.cache_size = cache_size
+        self.max_pixels = max_pixels
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._results: "OrderedDict[str, bytes]" = OrderedDict()
+        self._used = 0
+        # key -> running transcoding, identical images are encoded once
+        self._running: Dict[str, "asyncio.Future[bytes]"] = {}
+        self.transcoded = 0
+        self.hits = 0
+        self.failed = 0
+        self.saved_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.formats)
+
+    def accepts_size(self, size: int) -> bool:
+        return _MIN_INPUT_SIZE <= size <= self.max_input_size
+
+    def negotiate(self, accept: Optional[str]) -> Optional[str]:
+        """the preferred format named by `accept`, wildcard is not enough"""
+        if not accept:
+            return None
+        accepted = set()
+        for item in accept.split(","):
+            media_type, _, params = item.partition(";")
+            weight = 1.0
+            for param in params.split(";"):
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "q":
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            if weight > 0:
+                accepted.add(media_type.strip().lower())
+        for image_format in self.formats:
+            if f"image/{image_format}" in accepted:
+                return image_format
+        return None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # fork a process which run the event loop and threads is not safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def _put(self, key: str, result: bytes) -> None:
+        self._results[key] = result
+        self._used += len(result)
+        while self._used > self.cache_size and self._results:
+            _, old = self._results.popitem(last=False)
+            self._used -= len(old)
+
+    async def transcode(self, key: str, data: bytes, image_format: str) -> bytes:
+        """the image in `image_format`, empty if it is not smaller or failed"""
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return result
+        task = self._running.get(key)
+        if task is None:
+            # finish even if the client is gone, the result is kept
+            task = asyncio.ensure_future(self._transcode(key, data, image_format))
+            self._running[key] = task
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
+
+    async def _transcode(self, key: str, data: bytes, image_format: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self._get_executor(),
+                transcode_image,
+                data,
+                image_format,
+                self.max_pixels,
+            )
+        except BrokenProcessPool:
+            # a worker is killed, e.g. out of memory, start a new pool next time
+            self.failed += 1
+            self._executor = None
+            return b""
+        except Exception:
+            # a broken image is not tried again
+            self.failed += 1
+            result = b""
+        finally:
+            self._running.pop(key, None)
+
+        if len(result) >= len(data):
+            result = b""
+        if result:
+            self.transcoded += 1
+            self.saved_bytes += len(data) - len(result)
+        self._put(key, result)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._results),
+            "bytes": self._used,
+            "running": len(self._running),
+            "transcoded": self.transcoded,
+            "hits": self.hits,
+            "failed": self.failed,
+            "saved_bytes": self.saved_bytes,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
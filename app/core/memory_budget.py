@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   memory_budget.py
+@Time    :   2024/06/07 19:52:41
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   global budget of the response bodies buffered in memory
+"""
+
+from typing import Dict
+
+
+class MemoryBudget(object):
+    """Bytes of the response bodies buffered in memory by all requests.
+
+    Every buffer reserve its bytes before keeping them, and fall back when
+    it is refused: the cache writer spill to a temp file, the encoded body
+    is not kept, the shared response wait for its readers.
+    """
+
+    def __init__(self, limit: int = 256 * 1024 * 1024) -> None:
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.refused = 0
+
+    def reserve(self, size: int, force: bool = False) -> bool:
+        """take `size` bytes, `force` take them even over the limit"""
+        if not force and self.used + size > self.limit:
+            self.refused += 1
+            return False
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        return True
+
+    def release(self, size: int) -> None:
+        self.used -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "limit": self.limit,
+            "used": self.used,
+            "peak": self.peak,
+            "refused": self.refused,
+        }
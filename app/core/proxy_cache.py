@@ -0,0 +1,686 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   proxy_cache.py
+@Time    :   2024/05/09 22:41:05
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   shared http cache of proxied responses, memory lru tier + disk tier
+ref: https://www.rfc-editor.org/rfc/rfc9111
+"""
+
+import os
+import time
+import shutil
+import itertools
+import tempfile
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+import httpx
+from starlette.datastructures import Headers as StarletteHeaders
+
+from app.core.memory_budget import MemoryBudget
+
+# only these status can be cached by default
+# https://www.rfc-editor.org/rfc/rfc9110#section-15.1
+_CACHEABLE_STATUS = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+# never store hop-by-hop header
+_HOP_BY_HOP_HEADERS = (
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+)
+
+# heuristic freshness: 10% of the time since last-modified, at most one day
+_HEURISTIC_FRACTION = 0.1
+_HEURISTIC_MAX = 24 * 60 * 60
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+# unique id of every stored body, the derived data of it is keyed by the id
+_SERIALS = itertools.count()
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    """`max-age=60, no-cache` -> {"max-age": "60", "no-cache": None}"""
+    directives: Dict[str, Optional[str]] = {}
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            name, _, arg = item.partition("=")
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[item.lower()] = None
+    return directives
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """http date to timestamp"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _seconds(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return None
+
+
+def _get_header(headers: List[Tuple[str, str]], name: str) -> Optional[str]:
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+def freshness(headers: List[Tuple[str, str]], now: float) -> Tuple[float, float]:
+    """(corrected age, freshness lifetime) from the lowercase response headers"""
+    cache_control = parse_cache_control(_get_header(headers, "cache-control") or "")
+
+    date = parse_http_date(_get_header(headers, "date")) or now
+    age = _seconds(_get_header(headers, "age")) or 0
+    corrected_age = max(0.0, now - date, float(age))
+
+    if "no-cache" in cache_control:
+        return corrected_age, 0.0
+
+    lifetime = _seconds(cache_control.get("s-maxage"))
+    if lifetime is None:
+        lifetime = _seconds(cache_control.get("max-age"))
+    if lifetime is not None:
+        return corrected_age, float(lifetime)
+
+    expires = _get_header(headers, "expires")
+    if expires is not None:
+        # invalid expires means already expired
+        expires_at = parse_http_date(expires)
+        return corrected_age, max(0.0, expires_at - date) if expires_at else 0.0
+
+    last_modified = parse_http_date(_get_header(headers, "last-modified"))
+    if last_modified is not None:
+        return corrected_age, min(
+            _HEURISTIC_MAX, max(0.0, date - last_modified) * _HEURISTIC_FRACTION
+        )
+    return corrected_age, 0.0
+
+
+def request_has_credentials(headers: StarletteHeaders) -> bool:
+    """the request may be answered for one user only
+
+    the empty cookie which the proxy add to every request is not one
+    """
+    return "authorization" in headers or bool(headers.get("cookie", "").strip())
+
+
+def shared_with_credentials(cache_control: Dict[str, Optional[str]]) -> bool:
+    """upstream allow to share the response of a request with credentials"""
+    return "public" in cache_control or "s-maxage" in cache_control
+
+
+def response_is_shareable(
+    headers: httpx.Headers, request_headers: StarletteHeaders
+) -> bool:
+    """the response can be stored by a shared cache and sent to other users"""
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    # we are a shared cache
+    if "no-store" in cache_control or "private" in cache_control:
+        return False
+    # e.g. the page of a logged in user
+    if request_has_credentials(request_headers) and not shared_with_credentials(
+        cache_control
+    ):
+        return False
+    # the cookie belongs to one user only
+    if "set-cookie" in headers:
+        return False
+    return headers.get("vary", "").strip() != "*"
+
+
+class CacheEntry(object):
+    """a stored upstream response, body in memory or in a file of disk tier"""
+
+    __slots__ = (
+        "key",
+        "url",
+        "status_code",
+        "headers",
+        "vary",
+        "stored_at",
+        "corrected_age",
+        "freshness_lifetime",
+        "body",
+        "path",
+        "size",
+        "serial",
+    )
+
+    def __init__(
+        self,
+        key: str,
+        url: str,
+        status_code: int,
+        headers: List[Tuple[str, str]],
+        vary: Dict[str, str],
+    ) -> None:
+        self.key = key
+        # the final url after redirect
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.vary = vary
+        self.stored_at = time.time()
+        self.corrected_age = 0.0
+        self.freshness_lifetime = 0.0
+        self.body: Optional[bytes] = None
+        self.path: Optional[str] = None
+        self.size = 0
+        self.serial = next(_SERIALS)
+        self.update_freshness(self.headers)
+
+    def get_header(self, name: str) -> Optional[str]:
+        return _get_header(self.headers, name)
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.get_header("etag")
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.get_header("last-modified")
+
+    @property
+    def cache_control(self) -> Dict[str, Optional[str]]:
+        return parse_cache_control(self.get_header("cache-control") or "")
+
+    def update_freshness(self, headers: List[Tuple[str, str]]) -> None:
+        """calculate age and freshness lifetime from response headers"""
+        self.stored_at = time.time()
+        self.headers = headers
+        self.corrected_age, self.freshness_lifetime = freshness(headers, self.stored_at)
+
+    def current_age(self) -> float:
+        return self.corrected_age + (time.time() - self.stored_at)
+
+    def is_fresh(self) -> bool:
+        return self.current_age() < self.freshness_lifetime
+
+    def stale_window(self, directive: str, default: float) -> float:
+        """seconds the entry can be served after it is expired
+
+        `directive` is `stale-while-revalidate` or `stale-if-error` of the
+        response, `default` is only used for a response with a lifetime.
+        """
+        cache_control = self.cache_control
+        if (
+            "no-cache" in cache_control
+            or "must-revalidate" in cache_control
+            or "proxy-revalidate" in cache_control
+        ):
+            return 0.0
+        seconds = _seconds(cache_control.get(directive))
+        if seconds is not None:
+            return float(seconds)
+        # s-maxage forbid the shared cache to serve stale on its own
+        if "s-maxage" in cache_control or self.freshness_lifetime <= 0:
+            return 0.0
+        return default
+
+    def has_validator(self) -> bool:
+        return self.etag is not None or self.last_modified is not None
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """headers to revalidate the entry with upstream"""
+        headers = {}
+        if self.etag is not None:
+            headers["if-none-match"] = self.etag
+        if self.last_modified is not None:
+            headers["if-modified-since"] = self.last_modified
+        return headers
+
+    def response_headers(self) -> List[Tuple[str, str]]:
+        """stored headers with the current `age`"""
+        headers = [(k, v) for k, v in self.headers if k != "age"]
+        headers.append(("age", str(int(self.current_age()))))
+        return headers
+
+    def not_modified_for(self, request_headers: StarletteHeaders) -> bool:
+        """whether client conditional request can be answered with 304"""
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = self.etag
+            if etag is None:
+                return False
+            if if_none_match.strip() == "*":
+                return True
+            weak = etag[2:] if etag.startswith("W/") else etag
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return any((t[2:] if t.startswith("W/") else t) == weak for t in tags)
+
+        if_modified_since = parse_http_date(request_headers.get("if-modified-since"))
+        last_modified = parse_http_date(self.last_modified)
+        if if_modified_since is not None and last_modified is not None:
+            return last_modified <= if_modified_since
+        return False
+
+    async def iter_body(
+        self, offset: int = 0, count: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """stored body or `count` bytes of it from `offset`, the file is read in
+        worker thread"""
+        end = self.size if count is None else offset + count
+        if self.body is not None:
+            yield self.body[offset:end]
+            return
+        if self.path is None:
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(offset)
+            while offset < end:
+                chunk = await f.read(min(_READ_CHUNK_SIZE, end - offset))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+
+
+def request_is_cacheable(method: str, headers: StarletteHeaders) -> bool:
+    """only plain GET without range and `no-store` can use the cache"""
+    if method != "GET" or "range" in headers:
+        return False
+    return "no-store" not in parse_cache_control(headers.get("cache-control", ""))
+
+
+def range_request_is_cacheable(method: str, headers: StarletteHeaders) -> bool:
+    """range GET can be sliced from the stored whole response, it is never stored"""
+    if method != "GET" or "range" not in headers:
+        return False
+    return "no-store" not in parse_cache_control(headers.get("cache-control", ""))
+
+
+def request_requires_revalidation(headers: StarletteHeaders) -> bool:
+    """client ask to revalidate even if the entry is fresh"""
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in cache_control or cache_control.get("max-age") == "0":
+        return True
+    return "no-cache" in headers.get("pragma", "").lower()
+
+
+class ResponseCache(object):
+    """Shared http cache honoring Cache-Control, Expires, validators and Vary.
+
+    Small bodies are kept in a memory lru sized in bytes, large ones are
+    written to files of the disk tier which is also a lru sized in bytes.
+    The files are in a directory of this process under `directory`, every
+    worker process has its own.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = 64 * 1024 * 1024,
+        memory_object_size: int = 1024 * 1024,
+        disk_size: int = 1024 * 1024 * 1024,
+        disk_object_size: int = 256 * 1024 * 1024,
+        directory: Optional[str] = None,
+        stale_while_revalidate: float = 0,
+        stale_if_error: float = 0,
+        memory_budget: Optional[MemoryBudget] = None,
+    ) -> None:
+        self.memory_size = memory_size
+        self.memory_object_size = memory_object_size
+        self.disk_size = disk_size
+        self.disk_object_size = disk_object_size
+        # the parent of the directory of this process
+        self.directory = directory or tempfile.gettempdir()
+        self._path: Optional[str] = None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        # the bodies being written, the stored ones are sized by `memory_size`
+        self.memory_budget = memory_budget
+
+        # variant key -> entry
+        self._memory: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._disk: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = 0
+        # primary key -> vary header names of the latest response
+        self._vary: Dict[str, Tuple[str, ...]] = {}
+        # primary key -> stored variants, the vary names go with the last one
+        self._variants: Dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    @staticmethod
+    def primary_key(method: str, url: str) -> str:
+        return method + " " + url
+
+    @staticmethod
+    def _primary_of(key: str) -> str:
+        # the url never contain a newline
+        return key.partition("\n")[0]
+
+    @staticmethod
+    def _variant_key(primary: str, vary: Dict[str, str]) -> str:
+        if not vary:
+            return primary
+        return primary + "\n" + "\n".join(f"{k}:{v}" for k, v in sorted(vary.items()))
+
+    def _vary_values(
+        self, names: Tuple[str, ...], request_headers: StarletteHeaders
+    ) -> Dict[str, str]:
+        return {name: request_headers.get(name, "") for name in names}
+
+    def lookup(
+        self, method: str, url: str, request_headers: StarletteHeaders
+    ) -> Optional[CacheEntry]:
+        """find the stored variant of the request, fresh or not
+
+        a request with credentials only get the entry upstream allow to share
+        """
+        primary = self.primary_key(method, url)
+        names = self._vary.get(primary)
+        if names is None:
+            self.misses += 1
+            return None
+
+        key = self._variant_key(primary, self._vary_values(names, request_headers))
+        credentials = request_has_credentials(request_headers)
+        for store in (self._memory, self._disk):
+            entry = store.get(key)
+            if entry is not None:
+                if credentials and not shared_with_credentials(entry.cache_control):
+                    break
+                store.move_to_end(key)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def can_serve_stale(self, entry: CacheEntry, on_error: bool = False) -> bool:
+        """the expired entry can be served while revalidating, or on upstream error"""
+        window = entry.stale_window(
+            "stale-while-revalidate", self.stale_while_revalidate
+        )
+        if on_error:
+            window = max(
+                window, entry.stale_window("stale-if-error", self.stale_if_error)
+            )
+        if window <= 0 or entry.current_age() >= entry.freshness_lifetime + window:
+            return False
+        self.stale_hits += 1
+        return True
+
+    def response_is_cacheable(
+        self, response: httpx.Response, request_headers: StarletteHeaders
+    ) -> bool:
+        if response.status_code not in _CACHEABLE_STATUS:
+            return False
+        # only store the final response of permanent redirect
+        if any(r.status_code not in (301, 308) for r in response.history):
+            return False
+        headers = response.headers
+        if not response_is_shareable(headers, request_headers):
+            return False
+        cache_control = parse_cache_control(headers.get("cache-control", ""))
+        if "content-range" in headers:
+            return False
+        # nothing can be reused without freshness or validator
+        return (
+            "max-age" in cache_control
+            or "s-maxage" in cache_control
+            or "expires" in headers
+            or "etag" in headers
+            or "last-modified" in headers
+        )
+
+    def create_writer(
+        self,
+        method: str,
+        url: str,
+        response: httpx.Response,
+        request_headers: StarletteHeaders,
+    ) -> "CacheWriter":
+        """store the response of the request while its body is streamed"""
+        headers = response.headers
+        vary_names = tuple(
+            sorted(
+                {
+                    v.strip().lower()
+                    for v in headers.get("vary", "").split(",")
+                    if v.strip()
+                }
+            )
+        )
+        stored_headers = [
+            (k.lower(), v)
+            for k, v in headers.multi_items()
+            if k.lower() not in _HOP_BY_HOP_HEADERS
+        ]
+        primary = self.primary_key(method, url)
+        vary = self._vary_values(vary_names, request_headers)
+        entry = CacheEntry(
+            key=self._variant_key(primary, vary),
+            url=str(response.url),
+            status_code=response.status_code,
+            headers=stored_headers,
+            vary=vary,
+        )
+        return CacheWriter(self, entry, primary, vary_names)
+
+    def freshen(self, entry: CacheEntry, headers: httpx.Headers) -> None:
+        """update the stored entry with the headers of a 304 response"""
+        updates = [
+            (k.lower(), v)
+            for k, v in headers.multi_items()
+            if k.lower() not in _HOP_BY_HOP_HEADERS
+            and k.lower() not in ("content-length", "content-encoding")
+        ]
+        names = {k for k, _ in updates}
+        entry.update_freshness(
+            [(k, v) for k, v in entry.headers if k not in names] + updates
+        )
+
+    def new_file(self) -> Tuple[int, str]:
+        if self._path is None:
+            # other workers may share the parent, never touch their files
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = tempfile.mkdtemp(prefix="webproxy_cache_", dir=self.directory)
+        return tempfile.mkstemp(dir=self._path, suffix=".body")
+
+    def close(self) -> None:
+        """remove the files of this process, on shutdown"""
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._path = None
+        self._memory.clear()
+        self._disk.clear()
+        self._memory_used = self._disk_used = 0
+        self._vary.clear()
+        self._variants.clear()
+
+    def insert(
+        self, primary: str, vary_names: Tuple[str, ...], entry: CacheEntry
+    ) -> None:
+        """insert a completed entry, evict least recently used ones"""
+        self.remove(entry.key)
+        self._vary[primary] = vary_names
+        self._variants[primary] = self._variants.get(primary, 0) + 1
+
+        if entry.path is None:
+            self._memory[entry.key] = entry
+            self._memory_used += entry.size
+            while self._memory_used > self.memory_size and self._memory:
+                _, old = self._memory.popitem(last=False)
+                self._memory_used -= old.size
+                self._forget(old)
+        else:
+            self._disk[entry.key] = entry
+            self._disk_used += entry.size
+            while self._disk_used > self.disk_size and self._disk:
+                _, old = self._disk.popitem(last=False)
+                self._disk_used -= old.size
+                self._unlink(old)
+                self._forget(old)
+
+    def remove(self, key: str) -> None:
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= old.size
+            self._forget(old)
+        old = self._disk.pop(key, None)
+        if old is not None:
+            self._disk_used -= old.size
+            self._unlink(old)
+            self._forget(old)
+
+    def _forget(self, entry: CacheEntry) -> None:
+        """an entry is gone, drop the vary names with the last variant"""
+        primary = self._primary_of(entry.key)
+        count = self._variants.get(primary, 0) - 1
+        if count > 0:
+            self._variants[primary] = count
+        else:
+            self._variants.pop(primary, None)
+            self._vary.pop(primary, None)
+
+    @staticmethod
+    def _unlink(entry: CacheEntry) -> None:
+        # NOTE: on posix the file is still readable by the running responses
+        if entry.path is not None:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_used,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_used,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+        }
+
+
+class CacheWriter(object):
+    """collect the body while it is streamed to the client
+
+    The body is kept in memory until it is larger than `memory_object_size`
+    or the memory budget is used up, then it spills to a file of the disk tier.
+    Larger than `disk_object_size` or not completed, nothing is stored.
+    """
+
+    def __init__(
+        self,
+        cache: ResponseCache,
+        entry: CacheEntry,
+        primary: str,
+        vary_names: Tuple[str, ...],
+    ) -> None:
+        self.cache = cache
+        self.entry = entry
+        self.primary = primary
+        self.vary_names = vary_names
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.file = None
+        self.path: Optional[str] = None
+        self.aborted = False
+        # bytes of `chunks` taken from the memory budget
+        self.reserved = 0
+
+    def _reserve(self, size: int) -> bool:
+        budget = self.cache.memory_budget
+        if budget is None:
+            return True
+        if not budget.reserve(size):
+            return False
+        self.reserved += size
+        return True
+
+    def _release(self) -> None:
+        if self.reserved and self.cache.memory_budget is not None:
+            self.cache.memory_budget.release(self.reserved)
+        self.reserved = 0
+
+    async def write(self, chunk: bytes) -> None:
+        if self.aborted:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.disk_object_size:
+            self.abort()
+            return
+
+        if self.file is None:
+            if self.size <= self.cache.memory_object_size and self._reserve(len(chunk)):
+                self.chunks.append(chunk)
+                return
+            fd, self.path = self.cache.new_file()
+            self.file = os.fdopen(fd, "wb")
+            pending, self.chunks = b"".join(self.chunks), []
+            self._release()
+            await anyio.to_thread.run_sync(self.file.write, pending)
+        await anyio.to_thread.run_sync(self.file.write, chunk)
+
+    async def commit(self) -> None:
+        if self.aborted:
+            return
+        entry = self.entry
+        entry.size = self.size
+        if self.file is not None:
+            await anyio.to_thread.run_sync(self.file.close)
+            entry.path = self.path
+        else:
+            entry.body = b"".join(self.chunks)
+        self.chunks = []
+        self._release()
+        self.cache.insert(self.primary, self.vary_names, entry)
+
+    def abort(self) -> None:
+        if self.aborted:
+            return
+        self.aborted = True
+        self.chunks = []
+        self._release()
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.path)  # type: ignore
+            except OSError:
+                pass
+            self.file = None
+
+
+async def tee_to_cache(
+    stream: AsyncIterator[bytes], writer: CacheWriter
+) -> AsyncIterator[bytes]:
+    """forward the body and store it, only a completed body is stored"""
+    try:
+        async for chunk in stream:
+            await writer.write(chunk)
+            yield chunk
+    except BaseException:
+        writer.abort()
+        raise
+    await writer.commit()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   range_cache.py
+@Time    :   2024/05/12 16:27:53
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   sparse chunk store of large files, serve range request from local blocks
+ref: https://www.rfc-editor.org/rfc/rfc9110#section-14
+"""
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import anyio
+import httpx
+from starlette.datastructures import Headers as StarletteHeaders
+
+from app.core.proxy_cache import (
+    freshness,
+    parse_cache_control,
+    request_has_credentials,
+    response_is_shareable,
+)
+
+_RANGE_RE = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", re.I)
+_CONTENT_RANGE_RE = re.compile(r"^\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$", re.I)
+
+# headers of the object which are sent with every range response
+_OBJECT_HEADERS = (
+    "content-type",
+    "etag",
+    "last-modified",
+    "cache-control",
+    "expires",
+    "content-disposition",
+)
+
+_READ_SIZE = 256 * 1024
+
+
+class ByteRange(NamedTuple):
+    """inclusive byte range"""
+
+    start: int
+    end: int
+
+
+class ContentRange(NamedTuple):
+    start: int
+    end: int
+    size: Optional[int]
+
+
+def parse_range(value: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """`bytes=0-99` -> (0, 99), `bytes=100-` -> (100, None), `bytes=-5` -> (None, 5)
+
+    multiple ranges or invalid value return None
+    """
+    match = _RANGE_RE.match(value)
+    if match is None:
+        return None
+    first, last = match.group(1), match.group(2)
+    if not first and not last:
+        return None
+    start = int(first) if first else None
+    end = int(last) if last else None
+    if start is not None and end is not None and end < start:
+        return None
+    return start, end
+
+
+def resolve_range(
+    spec: Tuple[Optional[int], Optional[int]], size: int
+) -> Optional[ByteRange]:
+    """resolve parsed range with the object size, None if not satisfiable"""
+    start, end = spec
+    if start is None:
+        # suffix range, the last N bytes
+        assert end is not None
+        if end == 0 or size == 0:
+            return None
+        return ByteRange(max(0, size - end), size - 1)
+    if start >= size:
+        return None
+    if end is None or end >= size:
+        end = size - 1
+    return ByteRange(start, end)
+
+
+def parse_content_range(value: Optional[str]) -> Optional[ContentRange]:
+    """`bytes 0-99/1000` -> ContentRange(0, 99, 1000)"""
+    if not value:
+        return None
+    match = _CONTENT_RANGE_RE.match(value)
+    if match is None:
+        return None
+    size = match.group(3)
+    return ContentRange(
+        int(match.group(1)), int(match.group(2)), None if size == "*" else int(size)
+    )
+
+
+def strong_validator(
+    etag: Optional[str], last_modified: Optional[str]
+) -> Optional[str]:
+    """only strong etag or last-modified can identify the same bytes"""
+    if etag and not etag.startswith("W/"):
+        return etag
+    return last_modified or None
+
+
+def object_headers(headers: httpx.Headers) -> List[Tuple[str, str]]:
+    """the headers describe the whole file, not the range"""
+    return [(k, v) for k, v in headers.items() if k in _OBJECT_HEADERS]
+
+
+def block_request_is_cacheable(headers: StarletteHeaders) -> bool:
+    """the blocks are shared by every client, a request with credentials may get
+    other bytes, it neither read nor store them"""
+    if request_has_credentials(headers):
+        return False
+    return "no-store" not in parse_cache_control(headers.get("cache-control", ""))
+
+
+class CachedObject(object):
+    """a large file stored as fixed-size blocks in one sparse file"""
+
+    __slots__ = (
+        "url",
+        "validator",
+        "size",
+        "headers",
+        "path",
+        "blocks",
+        "stored_at",
+        "corrected_age",
+        "freshness_lifetime",
+    )
+
+    def __init__(
+        self,
+        url: str,
+        validator: str,
+        size: int,
+        headers: List[Tuple[str, str]],
+        path: str,
+    ) -> None:
+        self.url = url
+        self.validator = validator
+        self.size = size
+        self.headers = headers
+        self.path = path
+        # index of the stored blocks
+        self.blocks: Set[int] = set()
+        self.stored_at = time.time()
+        self.corrected_age = 0.0
+        self.freshness_lifetime = 0.0
+
+    def is_fresh(self) -> bool:
+        age = self.corrected_age + (time.time() - self.stored_at)
+        return age < self.freshness_lifetime
+
+    def freshen(self, headers: httpx.Headers) -> None:
+        """update the freshness with a 304, or a response of the same file"""
+        updates = [(k.lower(), v) for k, v in headers.multi_items()]
+        names = {k for k, _ in updates}
+        merged = [(k, v) for k, v in self.headers if k not in names] + updates
+        self.headers = [(k, v) for k, v in merged if k in _OBJECT_HEADERS]
+        self.stored_at = time.time()
+        self.corrected_age, self.freshness_lifetime = freshness(merged, self.stored_at)
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """headers to revalidate the object with upstream"""
+        headers = {}
+        for name, value in self.headers:
+            if name == "etag":
+                headers["if-none-match"] = value
+            elif name == "last-modified":
+                headers["if-modified-since"] = value
+        return headers
+
+
+class ChunkStore(object):
+    """Sparse block store keyed by url + validator.
+
+    Overlapping ranges are served from stored blocks,
+    only the missing blocks need to be fetched from upstream.
+    The store is a lru of objects sized by the bytes of stored blocks.
+    Only the responses a shared cache can keep are stored, an expired object
+    must be revalidated before its blocks are served. The files are in a
+    directory of this process under `directory`.
+
+    A range smaller than `min_fetch_size` is not worth fetching whole blocks,
+    and the urls whose upstream ignore range are remembered for `no_range_ttl`,
+    both are proxied as they are.
+    """
+
+    def __init__(
+        self,
+        block_size: int = 1024 * 1024,
+        max_size: int = 2 * 1024 * 1024 * 1024,
+        directory: Optional[str] = None,
+        min_fetch_size: int = 64 * 1024,
+        no_range_ttl: float = 60 * 60,
+        max_no_range: int = 4096,
+    ) -> None:
+        self.block_size = block_size
+        self.max_size = max_size
+        # the parent of the directory of this process
+        self.directory = directory or tempfile.gettempdir()
+        self.min_fetch_size = min_fetch_size
+        self.no_range_ttl = no_range_ttl
+        self.max_no_range = max_no_range
+        self._path: Optional[str] = None
+        self._objects: "OrderedDict[str, CachedObject]" = OrderedDict()
+        self._used = 0
+        # url -> monotonic time until it is known to ignore range
+        self._no_range: "OrderedDict[str, float]" = OrderedDict()
+
+    def _ensure_directory(self) -> str:
+        if self._path is None:
+            # other workers may share the parent, never touch their files
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = tempfile.mkdtemp(prefix="webproxy_chunks_", dir=self.directory)
+        return self._path
+
+    def close(self) -> None:
+        """remove the files of this process, on shutdown"""
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._path = None
+        self._objects.clear()
+        self._used = 0
+
+    @staticmethod
+    def response_is_cacheable(
+        response: httpx.Response, request_headers: StarletteHeaders
+    ) -> bool:
+        """the range response of the file can be stored and sent to other users"""
+        headers = response.headers
+        if not response_is_shareable(headers, request_headers):
+            return False
+        # the blocks are keyed by url only, the encoding is always identity
+        vary = {v.strip().lower() for v in headers.get("vary", "").split(",")}
+        return vary <= {"", "accept-encoding"}
+
+    def range_unsupported(self, url: str) -> bool:
+        """upstream answered a range request of the url with the whole file"""
+        until = self._no_range.get(url)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self._no_range[url]
+            return False
+        return True
+
+    def mark_range_unsupported(self, url: str) -> None:
+        self.invalidate(url)
+        self._no_range[url] = time.monotonic() + self.no_range_ttl
+        self._no_range.move_to_end(url)
+        while len(self._no_range) > self.max_no_range:
+            self._no_range.popitem(last=False)
+
+    def get(self, url: str) -> Optional[CachedObject]:
+        obj = self._objects.get(url)
+        if obj is not None:
+            self._objects.move_to_end(url)
+        return obj
+
+    def put(
+        self, url: str, validator: str, size: int, headers: httpx.Headers
+    ) -> Optional[CachedObject]:
+        """register an object, the old version of the url is dropped"""
+        if size > self.max_size:
+            return None
+        old = self._objects.get(url)
+        if old is not None and old.validator == validator and old.size == size:
+            old.freshen(headers)
+            return old
+        self.invalidate(url)
+
+        name = hashlib.sha1(f"{url}\n{validator}".encode("utf-8")).hexdigest()
+        obj = CachedObject(
+            url=url,
+            validator=validator,
+            size=size,
+            headers=object_headers(headers),
+            path=os.path.join(self._ensure_directory(), name + ".blocks"),
+        )
+        obj.freshen(headers)
+        # only created here, a response writing blocks of an evicted object can
+        # not create it again
+        os.close(
+            os.open(
+                obj.path,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                0o600,
+            )
+        )
+        self._objects[url] = obj
+        return obj
+
+    def invalidate(self, url: str) -> None:
+        obj = self._objects.pop(url, None)
+        if obj is None:
+            return
+        self._used -= self._stored_bytes(obj)
+        # NOTE: on posix the opened file is still usable by the running responses
+        try:
+            os.remove(obj.path)
+        except OSError:
+            pass
+
+    def _stored_bytes(self, obj: CachedObject) -> int:
+        used = len(obj.blocks) * self.block_size
+        last = (obj.size - 1) // self.block_size
+        if last in obj.blocks:
+            used -= (last + 1) * self.block_size - obj.size
+        return used
+
+    def block_length(self, obj: CachedObject, index: int) -> int:
+        return min(self.block_size, obj.size - index * self.block_size)
+
+    def mark(self, obj: CachedObject, index: int) -> None:
+        """a block has been written"""
+        if index in obj.blocks or self._objects.get(obj.url) is not obj:
+            return
+        obj.blocks.add(index)
+        self._used += self.block_length(obj, index)
+        while self._used > self.max_size and len(self._objects) > 1:
+            url = next(iter(self._objects))
+            if url == obj.url:
+                break
+            self.invalidate(url)
+
+    def plan(
+        self, obj: CachedObject, byte_range: ByteRange
+    ) -> List[Tuple[bool, int, int]]:
+        """split the blocks of the range to runs: (stored, first block, last block)"""
+        first = byte_range.start // self.block_size
+        last = byte_range.end // self.block_size
+        runs: List[Tuple[bool, int, int]] = []
+        for index in range(first, last + 1):
+            stored = index in obj.blocks
+            if runs and runs[-1][0] == stored:
+                runs[-1] = (stored, runs[-1][1], index)
+            else:
+                runs.append((stored, index, index))
+        return runs
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "objects": len(self._objects),
+            "blocks": sum(len(o.blocks) for o in self._objects.values()),
+            "bytes": self._used,
+            "no_range_urls": len(self._no_range),
+        }
+
+
+def open_block_file(obj: CachedObject) -> Optional[int]:
+    """the block file of the object, None if it is evicted"""
+    try:
+        return os.open(obj.path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    except FileNotFoundError:
+        return None
+
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+        return
+    # windows: the fd is only used by one response, seek is safe
+    os.lseek(fd, offset, os.SEEK_SET)
+    os.write(fd, data)
+
+
+def _pread(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+async def write_block(fd: int, data: bytes, offset: int) -> None:
+    await anyio.to_thread.run_sync(_pwrite, fd, data, offset)
+
+
+async def read_blocks(fd: int, start: int, end: int) -> AsyncIterator[bytes]:
+    """read the inclusive byte range of stored blocks"""
+    offset = start
+    while offset <= end:
+        size = min(_READ_SIZE, end - offset + 1)
+        data = await anyio.to_thread.run_sync(_pread, fd, size, offset)
+        if not data:
+            raise OSError(f"block file is truncated at {offset}")
+        offset += len(data)
+        yield data
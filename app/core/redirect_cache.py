@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   redirect_cache.py
+@Time    :   2024/05/18 11:36:42
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   ttl cache of redirect hops, proxy can skip the known hops
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from app.core.proxy_cache import parse_cache_control, parse_http_date
+
+_PERMANENT_STATUS = (301, 308)
+_TEMPORARY_STATUS = (302, 303, 307)
+
+
+class RedirectResolver(object):
+    """Remember redirect hops: url -> location.
+
+    - 301/308 are permanent, kept for `permanent_ttl` unless
+        cache-control/expires tell another lifetime.
+    - 302/303/307 are temporary, only kept with explicit cache-control/expires.
+    - The hops are shared by every client, a redirect which may be chosen for
+        one user (private, vary, request with credentials) is never kept.
+    """
+
+    def __init__(
+        self,
+        permanent_ttl: float = 24 * 60 * 60,
+        max_entries: int = 10000,
+        max_hops: int = 10,
+    ) -> None:
+        self.permanent_ttl = permanent_ttl
+        self.max_entries = max_entries
+        self.max_hops = max_hops
+        # url -> (location, expire at)
+        self._hops: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.skipped = 0
+
+    def _lifetime(self, response: Any) -> Optional[float]:
+        """how long the redirect can be reused, None means not cacheable"""
+        headers = response.headers
+        cache_control = parse_cache_control(headers.get("cache-control", ""))
+        if (
+            "no-store" in cache_control
+            or "no-cache" in cache_control
+            or "private" in cache_control
+        ):
+            return None
+        # the location may depend on the request, or the redirect set a session
+        if "vary" in headers or "set-cookie" in headers:
+            return None
+        # NOTE: the proxy send an empty cookie to keep httpx from adding its own
+        request_headers = response.request.headers
+        if "authorization" in request_headers or request_headers.get("cookie"):
+            return None
+        max_age = cache_control.get("s-maxage") or cache_control.get("max-age")
+        if max_age is not None:
+            try:
+                return float(max_age) or None
+            except ValueError:
+                return None
+        expires = parse_http_date(response.headers.get("expires"))
+        if expires is not None:
+            date = parse_http_date(response.headers.get("date")) or time.time()
+            return (expires - date) or None
+        if response.status_code in _PERMANENT_STATUS:
+            return self.permanent_ttl
+        return None
+
+    def record(self, response: Any) -> None:
+        """remember the redirect chain of a followed response
+
+        `response` is httpx.Response or duck typed like it.
+        """
+        history = response.history
+        if not history:
+            return
+        now = time.time()
+        targets = [r.url for r in history[1:]] + [response.url]
+        for hop, location in zip(history, targets):
+            if hop.status_code not in _PERMANENT_STATUS + _TEMPORARY_STATUS:
+                continue
+            lifetime = self._lifetime(hop)
+            if lifetime is None or lifetime <= 0:
+                continue
+            key = str(hop.url)
+            self._hops[key] = (str(location), now + lifetime)
+            self._hops.move_to_end(key)
+        while len(self._hops) > self.max_entries:
+            self._hops.popitem(last=False)
+
+    def resolve(self, url: httpx.URL) -> httpx.URL:
+        """follow the known hops without any request"""
+        now = time.time()
+        seen = set()
+        current = str(url)
+        for _ in range(self.max_hops):
+            hop = self._hops.get(current)
+            if hop is None:
+                break
+            location, expire_at = hop
+            if expire_at <= now:
+                del self._hops[current]
+                break
+            if location in seen:
+                # redirect loop, let upstream answer
+                break
+            seen.add(current)
+            current = location
+        if not seen:
+            return url
+        self.skipped += len(seen)
+        return httpx.URL(current)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hops": len(self._hops), "skipped": self.skipped}
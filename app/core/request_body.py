@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   request_body.py
+@Time    :   2024/05/19 15:20:08
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   forward client request body with a known length
+"""
+
+import tempfile
+from typing import IO, AsyncIterator, List, Optional, Union
+
+import anyio
+from fastapi import Request
+from starlette.datastructures import MutableHeaders as StarletteMutableHeaders
+
+# not need content body method
+_NON_REQUEST_BODY_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+RequestContent = Union[bytes, AsyncIterator[bytes]]
+
+
+def _content_length(headers: StarletteMutableHeaders) -> Optional[int]:
+    value = headers.get("content-length")
+    if value is None:
+        return None
+    try:
+        length = int(value)
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+async def _iter_file(file: IO[bytes]) -> AsyncIterator[bytes]:
+    """read the spooled body in worker thread, the file is closed at the end"""
+    try:
+        await anyio.to_thread.run_sync(file.seek, 0)
+        while True:
+            chunk = await anyio.to_thread.run_sync(file.read, _READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file.close()
+
+
+async def prepare_request_body(
+    request: Request, headers: StarletteMutableHeaders, memory_limit: int
+) -> Optional[RequestContent]:
+    """Choose how to forward the client body, so upstream always get `content-length`.
+
+    Some servers reject `transfer-encoding: chunked` request,
+    which httpx use for an async iterator body without length.
+
+    - With `content-length`, small body is read in memory (can be replayed by redirect),
+        large body is streamed directly.
+    - Without it (client upload chunked), the body is spooled to memory,
+        and to a temp file beyond `memory_limit`, then sent with its length.
+
+    NOTE: `headers` will be changed.
+    """
+    if request.method in _NON_REQUEST_BODY_METHODS:
+        return None
+
+    # hop-by-hop, httpx decide it by itself
+    if "transfer-encoding" in headers:
+        del headers["transfer-encoding"]
+
+    length = _content_length(headers)
+    if length is not None:
+        if length <= memory_limit:
+            return await request.body()
+        # zero copy, the length is known
+        return request.stream()
+
+    chunks: List[bytes] = []
+    size = 0
+    file: Optional[IO[bytes]] = None
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if file is None and size > memory_limit:
+                file = tempfile.TemporaryFile()
+                pending, chunks = b"".join(chunks), []
+                await anyio.to_thread.run_sync(file.write, pending)
+            if file is not None:
+                await anyio.to_thread.run_sync(file.write, chunk)
+            else:
+                chunks.append(chunk)
+    except BaseException:
+        if file is not None:
+            file.close()
+        raise
+
+    headers["content-length"] = str(size)
+    if file is None:
+        return b"".join(chunks)
+    return _iter_file(file)
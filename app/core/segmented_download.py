@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   segmented_download.py
+@Time    :   2024/06/05 21:48:26
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   download big file by concurrent range requests, reassembled in order
+"""
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
+
+import httpx
+
+from app.core.memory_budget import MemoryBudget
+from app.core.range_cache import parse_content_range, strong_validator
+
+# open the range `start`-`end` (inclusive) of the file
+RangeOpener = Callable[[int, int], Awaitable[httpx.Response]]
+
+# the budget is released by other buffers too, without telling the segments
+_ROOM_RETRY_INTERVAL = 1.0
+
+
+class _Download(object):
+    """state shared by the segments of one download"""
+
+    __slots__ = ("released",)
+
+    def __init__(self) -> None:
+        self.released = asyncio.Event()
+
+    def notify(self) -> None:
+        released, self.released = self.released, asyncio.Event()
+        released.set()
+
+
+class _Segment(object):
+    __slots__ = ("start", "end", "download", "chunks", "buffered", "task")
+
+    def __init__(self, start: int, end: int, download: _Download) -> None:
+        self.start = start
+        self.end = end
+        self.download = download
+        # the bytes, then None at the end, or the error
+        self.chunks: "asyncio.Queue[Union[bytes, Exception, None]]" = asyncio.Queue()
+        # bytes in `chunks`, reserved from the memory budget
+        self.buffered = 0
+        self.task: "Optional[asyncio.Task[None]]" = None
+
+
+class SegmentedDownloader(object):
+    """Download the body of a big file by concurrent range requests.
+
+    A single TCP stream is limited by the latency to the origin, several
+    ranges multiply the throughput. The first response of upstream serve the
+    first segment, the others are requested with `If-Range`, a changed file
+    break the download. At most `segments` are downloading at once, the ones
+    ahead of the client are kept in memory, so the reorder buffer is bounded
+    by `(segments - 1) * segment_size`. The buffered bytes are reserved from
+    `memory_budget`, a segment refused wait for the client to read.
+    """
+
+    def __init__(
+        self,
+        segments: int = 0,
+        segment_size: int = 4 * 1024 * 1024,
+        min_size: int = 16 * 1024 * 1024,
+        retries: int = 2,
+        memory_budget: Optional[MemoryBudget] = None,
+    ) -> None:
+        self.segments = segments
+        self.segment_size = segment_size
+        self.min_size = min_size
+        self.retries = retries
+        self.memory_budget = memory_budget
+        self.downloads = 0
+        self.fetched = 0
+        self.retried = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.segments > 1
+
+    def size_of(self, response: httpx.Response) -> Optional[int]:
+        """the size of the body if it can be split, None otherwise
+
+        The response must be the whole file, as it is, and identified by a
+        strong validator.
+        """
+        if not self.enabled or response.status_code != 200:
+            return None
+        headers = response.headers
+        if headers.get("accept-ranges", "").lower() != "bytes":
+            return None
+        if headers.get("content-encoding", "identity").lower() != "identity":
+            return None
+        if strong_validator(headers.get("etag"), headers.get("last-modified")) is None:
+            return None
+        length = headers.get("content-length", "")
+        if not length.isdigit():
+            return None
+        size = int(length)
+        if size < max(self.min_size, 2 * self.segment_size):
+            return None
+        return size
+
+    def _reserve(self, segment: _Segment, size: int) -> bool:
+        budget = self.memory_budget
+        # one chunk of every segment is always allowed, the client must not starve
+        if budget is not None and not budget.reserve(size, force=not segment.buffered):
+            return False
+        segment.buffered += size
+        return True
+
+    def _release(self, segment: _Segment, size: int) -> None:
+        segment.buffered -= size
+        if self.memory_budget is not None:
+            self.memory_budget.release(size)
+
+    async def _wait_room(self, segment: _Segment, size: int) -> None:
+        """backpressure, wait until the `size` bytes can be buffered"""
+        while not self._reserve(segment, size):
+            released = segment.download.released
+            try:
+                await asyncio.wait_for(released.wait(), _ROOM_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fill(
+        self,
+        segment: _Segment,
+        first: Optional[httpx.Response],
+        open_range: RangeOpener,
+    ) -> None:
+        """read the segment into its queue, resume from the last byte on error"""
+        offset = segment.start
+        attempts = 0
+        response = first
+        try:
+            while offset <= segment.end:
+                try:
+                    if response is None:
+                        response = await open_range(offset, segment.end)
+                        content_range = parse_content_range(
+                            response.headers.get("content-range")
+                        )
+                        if response.status_code != 206 or (
+                            content_range is None or content_range.start != offset
+                        ):
+                            raise RuntimeError(
+                                f"upstream file is changed: {response.url}"
+                            )
+                    async for chunk in response.aiter_raw():
+                        # the first response go on after its segment
+                        chunk = chunk[: segment.end + 1 - offset]
+                        if chunk:
+                            await self._wait_room(segment, len(chunk))
+                            segment.chunks.put_nowait(chunk)
+                            offset += len(chunk)
+                        if offset > segment.end:
+                            break
+                    if offset <= segment.end:
+                        raise httpx.ReadError(f"segment is truncated at {offset}")
+                except httpx.TransportError:
+                    attempts += 1
+                    if attempts > self.retries:
+                        raise
+                    self.retried += 1
+                finally:
+                    if response is not None:
+                        await response.aclose()
+                        response = None
+            segment.chunks.put_nowait(None)
+        except Exception as e:
+            self.failures += 1
+            segment.chunks.put_nowait(e)
+
+    async def stream(
+        self, first: httpx.Response, size: int, open_range: RangeOpener
+    ) -> AsyncIterator[bytes]:
+        """the whole body in order, `first` is the response of the whole file"""
+        self.downloads += 1
+        download = _Download()
+        segments = [
+            _Segment(start, min(start + self.segment_size, size) - 1, download)
+            for start in range(0, size, self.segment_size)
+        ]
+        scheduled: List[_Segment] = []
+        try:
+            for index, segment in enumerate(segments):
+                # keep `segments` downloading, from the one the client is reading
+                for ahead in segments[len(scheduled) : index + self.segments]:
+                    ahead.task = asyncio.create_task(
+                        self._fill(ahead, first if not scheduled else None, open_range)
+                    )
+                    scheduled.append(ahead)
+                while True:
+                    item = await segment.chunks.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    self._release(segment, len(item))
+                    download.notify()
+                    yield item
+                self.fetched += 1
+        finally:
+            tasks = [segment.task for segment in scheduled if segment.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # the chunks left in the queues are dropped
+            for segment in scheduled:
+                self._release(segment, segment.buffered)
+            await first.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "downloads": self.downloads,
+            "segments": self.fetched,
+            "retried": self.retried,
+            "failures": self.failures,
+        }
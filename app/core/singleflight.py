@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   singleflight.py
+@Time    :   2024/05/14 22:05:19
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   coalesce concurrent identical upstream requests, fan out one response to many clients
+"""
+
+import asyncio
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Set,
+)
+
+import httpx
+from loguru import logger
+
+from app.core.memory_budget import MemoryBudget
+
+# request headers which never change the upstream response, every other one
+# is part of the key, e.g. `x-api-key` or `user-agent` may select another body
+IGNORED_HEADERS = frozenset(
+    (
+        # `host` is in the url
+        "host",
+        "connection",
+        "content-length",
+        "cache-control",
+        "pragma",
+        "priority",
+    )
+)
+
+# only safe method without body can share the response
+_COALESCE_METHODS = ("GET", "HEAD")
+
+
+def flight_key(request: httpx.Request) -> Optional[str]:
+    """method + url + headers, None if the request can not be shared
+
+    Only the requests with the same credentials, client hints, etc. share
+    one response, the order of the same header is kept.
+    """
+    if request.method not in _COALESCE_METHODS:
+        return None
+    headers = sorted(
+        (
+            (name, value)
+            for name, value in request.headers.multi_items()
+            if name not in IGNORED_HEADERS
+        ),
+        key=lambda item: item[0],
+    )
+    parts = [request.method, str(request.url)]
+    parts.extend(f"{name}:{value}" for name, value in headers)
+    return "\n".join(parts)
+
+
+class ReaderDropped(Exception):
+    """the client is too slow and left behind by the ring buffer"""
+
+
+class _Flight(object):
+    """one upstream response, the raw body is kept in a bounded ring buffer
+
+    The buffer hold the chunks between the slowest and the fastest reader,
+    the upstream reading pause when it is full or the memory budget is used
+    up. A reader which lag longer than `lag_timeout` is dropped so it can not
+    stall the others.
+    """
+
+    def __init__(
+        self, owner: "SingleFlight", key: str, capacity: int, lag_timeout: float
+    ) -> None:
+        self.owner = owner
+        self.key = key
+        self.capacity = capacity
+        self.lag_timeout = lag_timeout
+
+        self.response: Optional[httpx.Response] = None
+        self.error: Optional[BaseException] = None
+        self.ready = asyncio.Event()
+
+        self.chunks: Deque[bytes] = deque()
+        # chunk index of `chunks[0]`
+        self.base = 0
+        self.buffered = 0
+        self.done = False
+        # reader id -> index of the next chunk
+        self.readers: Dict[int, int] = {}
+        self.dropped: Set[int] = set()
+        self._next_reader = 0
+        self._changed = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def joinable(self) -> bool:
+        """a new reader must read from the first chunk"""
+        return self.base == 0 and self.error is None
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def add_reader(self) -> int:
+        reader = self._next_reader
+        self._next_reader += 1
+        self.readers[reader] = self.base
+        return reader
+
+    def remove_reader(self, reader: int) -> None:
+        if self.readers.pop(reader, None) is not None:
+            self._trim()
+            self._notify()
+
+    def _trim(self) -> None:
+        """drop the chunks every reader has consumed"""
+        lowest = (
+            min(self.readers.values()) if self.readers else self.base + len(self.chunks)
+        )
+        released = 0
+        while self.base < lowest and self.chunks:
+            released += len(self.chunks.popleft())
+            self.base += 1
+        self.buffered -= released
+        if released and self.owner.memory_budget is not None:
+            self.owner.memory_budget.release(released)
+        if self.base > 0:
+            # the beginning is gone, later request must fetch by itself
+            self.owner.forget(self)
+
+    def start(self, response: httpx.Response, stream: AsyncIterator[bytes]) -> None:
+        self.response = response
+        self.ready.set()
+        self._task = asyncio.ensure_future(self._pump(response, stream))
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        self.done = True
+        self.ready.set()
+        self.owner.forget(self)
+
+    def _reserve(self, size: int) -> bool:
+        if self.buffered >= self.capacity:
+            return False
+        budget = self.owner.memory_budget
+        # one chunk is always allowed, the readers must not starve
+        return budget is None or budget.reserve(size, force=not self.buffered)
+
+    async def _wait_room(self, size: int) -> bool:
+        """backpressure, wait the slowest reader, then take the room of `size`
+
+        return False if every client is gone
+        """
+        while self.readers:
+            if self._reserve(size):
+                return True
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), self.lag_timeout)
+            except asyncio.TimeoutError:
+                lowest = min(self.readers.values())
+                for reader, position in list(self.readers.items()):
+                    if position == lowest:
+                        logger.warning(f"drop slow reader of {self.key!r}")
+                        del self.readers[reader]
+                        self.dropped.add(reader)
+                self._trim()
+                self._notify()
+        return False
+
+    async def _pump(
+        self, response: httpx.Response, stream: AsyncIterator[bytes]
+    ) -> None:
+        try:
+            async for chunk in stream:
+                if not chunk:
+                    continue
+                if not await self._wait_room(len(chunk)):
+                    # every client is gone
+                    break
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            self.owner.forget(self)
+            # an unfinished body must not be stored in the cache
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            await response.aclose()
+
+    async def read(self, reader: int) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                if reader in self.dropped:
+                    raise ReaderDropped(self.key)
+                position = self.readers.get(reader)
+                if position is None:
+                    return
+                if position < self.base + len(self.chunks):
+                    chunk = self.chunks[position - self.base]
+                    self.readers[reader] = position + 1
+                    self._trim()
+                    self._notify()
+                    yield chunk
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.remove_reader(reader)
+
+
+class SharedResponse(object):
+    """one client's view of the shared upstream response
+
+    Duck typed like `httpx.Response` which is used by the proxy,
+    the headers is a copy so every client can change it.
+    """
+
+    def __init__(self, flight: _Flight, reader: int) -> None:
+        response = flight.response
+        assert response is not None
+        self._flight = flight
+        self._reader = reader
+        self.status_code = response.status_code
+        self.headers = httpx.Headers(response.headers)
+        self.url = response.url
+        self.history = response.history
+        self.request = response.request
+
+    def aiter_raw(self) -> AsyncIterator[bytes]:
+        return self._flight.read(self._reader)
+
+    async def aclose(self) -> None:
+        self._flight.remove_reader(self._reader)
+
+
+class SingleFlight(object):
+    """Deduplicate in-flight upstream requests.
+
+    The first request of a key send to upstream, the identical requests
+    arrived before the body is consumed wait for it and share the body.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 4 * 1024 * 1024,
+        lag_timeout: float = 10,
+        memory_budget: Optional[MemoryBudget] = None,
+    ):
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.lag_timeout = lag_timeout
+        self._flights: Dict[str, _Flight] = {}
+        self.coalesced = 0
+
+    def forget(self, flight: _Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def fetch(
+        self,
+        key: str,
+        send: Callable[[], Awaitable[httpx.Response]],
+        open_stream: Callable[[httpx.Response], AsyncIterator[bytes]],
+    ) -> SharedResponse:
+        """share the response of `send`, `open_stream` is only called by the leader"""
+        flight = self._flights.get(key)
+        while flight is not None and flight.joinable:
+            reader = flight.add_reader()
+            try:
+                await flight.ready.wait()
+            except BaseException:
+                flight.remove_reader(reader)
+                raise
+            if flight.error is None:
+                self.coalesced += 1
+                return SharedResponse(flight, reader)
+            flight.remove_reader(reader)
+            if not isinstance(flight.error, asyncio.CancelledError):
+                raise flight.error
+            # the leader is cancelled by its client, try again
+            flight = self._flights.get(key)
+
+        flight = _Flight(self, key, self.capacity, self.lag_timeout)
+        self._flights[key] = flight
+        reader = flight.add_reader()
+        try:
+            response = await send()
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.start(response, open_stream(response))
+        return SharedResponse(flight, reader)
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), "coalesced": self.coalesced}
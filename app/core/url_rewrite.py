@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   url_rewrite.py
+@Time    :   2024/05/25 16:03:27
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   map the url in html attributes, srcset, css and js back to the proxy
+"""
+
+import re
+from urllib.parse import quote, urljoin
+from typing import Callable, List, Optional
+
+# url mapper signature: (base_url, url) -> new url
+UrlMapper = Callable[[str, str], str]
+
+# values which must keep untouched
+_SKIP_PREFIX = ("#", "data:", "javascript:", "mailto:", "tel:", "about:", "blob:")
+
+# url(...) and @import "..." in css
+_CSS_URL_RE = re.compile(
+    r"""(?P<prefix>url\(\s*)(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^)"'\s]*))"""
+    r"""|(?P<import>@import\s+)(?:"(?P<idq>[^"]*)"|'(?P<isq>[^']*)')""",
+    re.I,
+)
+
+# absolute url string literal in js, e.g. fetch("https://api.example.com/x")
+# protocol relative url must look like a domain, avoid `"//"` comments in string
+_JS_URL_RE = re.compile(
+    r"""(?P<quote>["'`])"""
+    r"""(?P<url>(?:https?:)?//[\w-]+(?:\.[\w-]+)+(?::\d+)?(?:/[^"'`\s\\]*)?)"""
+    r"""(?P=quote)""",
+    re.I,
+)
+
+# xml namespaces look like urls, e.g. document.createElementNS(SVG_NS, "svg"),
+# they are names and must keep untouched
+_XML_NAMESPACES = frozenset(
+    (
+        "http://www.w3.org/2000/svg",
+        "http://www.w3.org/1999/xhtml",
+        "http://www.w3.org/1999/xlink",
+        "http://www.w3.org/1998/Math/MathML",
+        "http://www.w3.org/XML/1998/namespace",
+        "http://www.w3.org/2000/xmlns/",
+    )
+)
+
+# `<url>; rel=preload` of `link` header
+_LINK_HEADER_URL_RE = re.compile(r"<([^>]*)>")
+
+_SPACE_OR_COMMA_RE = re.compile(r"[\s,]*")
+_NON_SPACE_RE = re.compile(r"\S+")
+
+
+def join_url(base_url: str, value: str) -> str:
+    """default url mapper: make relative url absolute"""
+    stripped = value.strip()
+    if not stripped or stripped.lower().startswith(_SKIP_PREFIX):
+        return value
+    return urljoin(base_url, stripped)
+
+
+def proxy_url_mapper(endpoint: str) -> UrlMapper:
+    """url mapper which route every http(s) url through `endpoint?url=`
+
+    The fragment is kept outside, it is only used by the browser.
+    The returned url is ascii.
+    """
+    prefix = endpoint + "?url="
+
+    def mapper(base_url: str, value: str) -> str:
+        absolute = join_url(base_url, value)
+        if not absolute.startswith(("http://", "https://")):
+            return value
+        url, sep, fragment = absolute.partition("#")
+        try:
+            # the document is decoded as latin-1, get back the original bytes
+            raw = url.encode("latin-1")
+        except UnicodeEncodeError:
+            # unescaped html character reference
+            raw = url.encode("utf-8")
+        return prefix + quote(raw, safe=":/") + sep + fragment
+
+    return mapper
+
+
+def rewrite_srcset(base_url: str, value: str, url_mapper: UrlMapper) -> str:
+    """`a.png 1x, b.png 2x`, url may contain comma (data:), descriptor not
+
+    https://html.spec.whatwg.org/multipage/images.html#parse-a-srcset-attribute
+    """
+    out: List[str] = []
+    pos = 0
+    length = len(value)
+    while pos < length:
+        gap = _SPACE_OR_COMMA_RE.match(value, pos)
+        assert gap is not None
+        out.append(gap.group())
+        pos = gap.end()
+        if pos >= length:
+            break
+        url = _NON_SPACE_RE.match(value, pos)
+        assert url is not None
+        pos = url.end()
+        stripped = url.group().rstrip(",")
+        out.append(url_mapper(base_url, stripped))
+        out.append(url.group()[len(stripped) :])
+        if len(stripped) != len(url.group()):
+            # the trailing comma end the candidate, no descriptor
+            continue
+        end = value.find(",", pos)
+        end = length if end == -1 else end + 1
+        out.append(value[pos:end])
+        pos = end
+    return "".join(out)
+
+
+def rewrite_link_header(base_url: str, value: str, url_mapper: UrlMapper) -> str:
+    """upstream `link` header, the browser would preload from upstream directly"""
+    return _LINK_HEADER_URL_RE.sub(
+        lambda m: "<" + url_mapper(base_url, m.group(1)) + ">", value
+    )
+
+
+def rewrite_css(base_url: str, text: str, url_mapper: UrlMapper) -> str:
+    """rewrite `url()` and `@import` in stylesheet or inline style"""
+
+    def replace(match: "re.Match[str]") -> str:
+        if match.group("import") is not None:
+            prefix = match.group("import")
+            groups = (("idq", '"'), ("isq", "'"))
+        else:
+            prefix = match.group("prefix")
+            groups = (("dq", '"'), ("sq", "'"), ("uq", ""))
+        for group, quote_char in groups:
+            value = match.group(group)
+            if value is not None:
+                break
+        new_value = url_mapper(base_url, value) if value.strip() else value
+        if new_value == value:
+            return match.group()
+        return prefix + quote_char + new_value + quote_char
+
+    return _CSS_URL_RE.sub(replace, text)
+
+
+def rewrite_js(base_url: str, text: str, url_mapper: UrlMapper) -> str:
+    """rewrite absolute url string literals, relative url in js can not be known"""
+
+    def replace(match: "re.Match[str]") -> str:
+        url = match.group("url")
+        if url in _XML_NAMESPACES:
+            return match.group()
+        quote_char = match.group("quote")
+        return quote_char + url_mapper(base_url, url) + quote_char
+
+    return _JS_URL_RE.sub(replace, text)
+
+
+class StreamingTextRewriter(object):
+    """Apply a text rewrite function on a stream.
+
+    Text is only cut at `separators` outside string literals and `url(...)`,
+    so a url token is not split between two chunks. A piece without such a
+    cut longer than `max_buffer` is rewritten anyway, the memory is bounded.
+    """
+
+    def __init__(
+        self,
+        rewrite: Callable[[str], str],
+        separators: str,
+        max_buffer: int = 64 * 1024,
+    ) -> None:
+        self.rewrite = rewrite
+        self.separators = separators
+        self.max_buffer = max_buffer
+        self._buffer = ""
+        # scan state at the end of the buffer, kept between the chunks
+        self._scanned = 0
+        self._quote = ""
+        self._escape = False
+        self._in_url = False
+
+    def _last_cut(self, buf: str) -> int:
+        """offset after the last separator outside quotes and `url(`, 0 if none"""
+        cut = 0
+        for i in range(self._scanned, len(buf)):
+            char = buf[i]
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif self._quote:
+                if char == self._quote:
+                    self._quote = ""
+                elif char == "\n" and self._quote != "`":
+                    # an unterminated string, it was a comment or a regex
+                    self._quote = ""
+                    self._in_url = False
+            elif char in "\"'`":
+                self._quote = char
+            elif self._in_url:
+                if char == ")" or char == "\n":
+                    self._in_url = False
+            elif char == "(" and buf[i - 3 : i].lower() == "url":
+                self._in_url = True
+            elif char in self.separators:
+                cut = i + 1
+        self._scanned = len(buf)
+        return cut
+
+    def feed(self, chunk: str) -> str:
+        buf = self._buffer + chunk if self._buffer else chunk
+        cut = self._last_cut(buf)
+        if cut == 0:
+            if len(buf) <= self.max_buffer:
+                self._buffer = buf
+                return ""
+            cut = len(buf)
+        self._buffer = buf[cut:]
+        self._scanned = len(self._buffer)
+        return self.rewrite(buf[:cut])
+
+    def flush(self) -> str:
+        rest, self._buffer = self._buffer, ""
+        self._scanned = 0
+        return self.rewrite(rest) if rest else ""
+
+
+def css_stream_rewriter(base_url: str, url_mapper: UrlMapper) -> StreamingTextRewriter:
+    # the end of a declaration or a rule, never inside `url()` or a string
+    return StreamingTextRewriter(
+        lambda text: rewrite_css(base_url, text, url_mapper), separators=";}\n"
+    )
+
+
+def js_stream_rewriter(base_url: str, url_mapper: UrlMapper) -> StreamingTextRewriter:
+    return StreamingTextRewriter(
+        lambda text: rewrite_js(base_url, text, url_mapper), separators=";\n"
+    )
+
+
+def text_stream_rewriter(
+    content_type: str, base_url: str, url_mapper: UrlMapper
+) -> Optional[StreamingTextRewriter]:
+    """rewriter of css or js document, None for other type"""
+    content_type = content_type.lower()
+    if "text/css" in content_type:
+        return css_stream_rewriter(base_url, url_mapper)
+    if "javascript" in content_type or "ecmascript" in content_type:
+        return js_stream_rewriter(base_url, url_mapper)
+    return None
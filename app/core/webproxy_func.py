@@ -1,8 +1,14 @@
 # modify for: https://github.com/WSH032/fastapi-proxy-lib/blob/main/src/fastapi_proxy_lib/core/http.py
+import os
+import math
+import asyncio
+import hashlib
 import httpx
-import re
+import httpcore
+from collections import OrderedDict
+from http.cookiejar import Cookie, CookieJar
 from fastapi import Request, Response
-from urllib.parse import unquote, urljoin
+from urllib.parse import unquote
 from loguru import logger
 from typing import List
 from starlette.datastructures import (
@@ -13,15 +19,340 @@ from starlette.datastructures import (
 )
 from starlette.background import BackgroundTask
 from fastapi.responses import StreamingResponse, PlainTextResponse
-import gzip
 
 from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
     List,
     NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from app.core.html_rewrite import StreamingHTMLRewriter
+from app.core.url_rewrite import (
+    StreamingTextRewriter,
+    UrlMapper,
+    proxy_url_mapper,
+    rewrite_link_header,
+    text_stream_rewriter,
+)
+from app.core.early_hints import (
+    PreloadHints,
+    Prefetcher,
+    ResourceCallback,
+    preload_link,
+)
+from app.core.content_coding import (
+    decode_stream,
+    encode_stream,
+    filter_accept_encoding,
+    get_decoder,
+    get_encoder,
+    negotiate_encoding,
+)
+from app.core.compression import (
+    EncodedCache,
+    add_vary_accept_encoding,
+    set_encoding_headers,
+    should_compress,
+)
+from app.core.proxy_cache import (
+    CacheEntry,
+    ResponseCache,
+    parse_cache_control,
+    range_request_is_cacheable,
+    request_has_credentials,
+    request_is_cacheable,
+    request_requires_revalidation,
+    response_is_shareable,
+    tee_to_cache,
+)
+from app.core.range_cache import (
+    ByteRange,
+    CachedObject,
+    ChunkStore,
+    block_request_is_cacheable,
+    object_headers,
+    open_block_file,
+    parse_content_range,
+    parse_range,
+    read_blocks,
+    resolve_range,
+    strong_validator,
+    write_block,
+)
+from app.core.admission import AdmissionController, AdmissionRejected, AdmittedResponse
+from app.core.bandwidth import BandwidthScheduler
+from app.core.circuit_breaker import (
+    FAILURE_STATUS,
+    CircuitBreaker,
+    UpstreamUnavailable,
+)
+from app.core.dns_cache import CachingNetworkBackend, DNSCache
+from app.core.file_response import FileSliceResponse, open_file
+from app.core.func import get_client_ip
+from app.core.hop_headers import (
+    RawHeaders,
+    encode_headers,
+    filter_request_headers,
+    filter_response_headers,
+)
+from app.core.redirect_cache import RedirectResolver
+from app.core.image_transcode import ImageTranscoder, is_transcodable
+from app.core.memory_budget import MemoryBudget
+from app.core.request_body import prepare_request_body
+from app.core.segmented_download import SegmentedDownloader
+from app.core.singleflight import SharedResponse, SingleFlight, flight_key
+from app.config import settings
+
+# http2 is optional, it need `h2` package (httpx[http2])
+try:
+    import h2  # noqa: F401
+
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    _HTTP2_AVAILABLE = False
+
+
+class _NullCookieJar(CookieJar):
+    """A cookie jar which never store nor send any cookie.
+
+    The proxy is shared by every client, cookies must only travel in the
+    headers of each request/response, never in the shared client.
+    """
+
+    def set_cookie(self, cookie: Cookie) -> None:
+        return None
+
+    def extract_cookies(self, response: Any, request: Any) -> None:
+        return None
+
+    def add_cookie_header(self, request: Any) -> None:
+        return None
+
+
+class HttpxClientRegistry(object):
+    """One `httpx.AsyncClient` (connection pool) per upstream host.
+
+    A slow host can only exhaust its own pool. With http2 the requests
+    to the same host are multiplexed on one connection.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30,
+        http2: bool = True,
+        timeout: float = 8,
+        connect_timeout: Optional[float] = None,
+        max_hosts: int = 256,
+        network_backend: Optional[httpcore.AsyncNetworkBackend] = None,
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2 and _HTTP2_AVAILABLE
+        if http2 and not _HTTP2_AVAILABLE:
+            logger.warning("h2 is not installed, upstream use http/1.1 only")
+        # a dead host fail fast, a slow response still has `timeout`
+        self.timeout = httpx.Timeout(
+            timeout, connect=timeout if connect_timeout is None else connect_timeout
+        )
+        self.max_hosts = max_hosts
+        # e.g. `CachingNetworkBackend`, shared by every pool
+        self.network_backend = network_backend
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+
+    @staticmethod
+    def host_key(url: httpx.URL) -> str:
+        if url.port is None:
+            return f"{url.scheme}://{url.host}"
+        return f"{url.scheme}://{url.host}:{url.port}"
+
+    def _create_client(self) -> httpx.AsyncClient:
+        transport = httpx.AsyncHTTPTransport(
+            verify=False, limits=self.limits, http2=self.http2
+        )
+        if self.network_backend is not None:
+            # NOTE: httpx not expose it, the pool create every connection with it.
+            # private attribute of httpcore 1.x, pinned in requirements.txt
+            pool = getattr(transport, "_pool", None)
+            if hasattr(pool, "_network_backend"):
+                pool._network_backend = self.network_backend
+            else:
+                logger.warning("httpcore pool has no network backend, dns not cached")
+        return httpx.AsyncClient(
+            transport=transport,
+            # NOTE: requests never mutate shared state, no need to clear cookie
+            cookies=_NullCookieJar(),
+            timeout=self.timeout,
+        )
+
+    def get(self, url: Union[str, httpx.URL]) -> httpx.AsyncClient:
+        """the client of the url host"""
+        key = self.host_key(httpx.URL(url))
+        client = self._clients.get(key)
+        if client is not None:
+            self._clients.move_to_end(key)
+            return client
+
+        client = self._clients[key] = self._create_client()
+        if len(self._clients) > self.max_hosts:
+            self._evict_idle()
+        return client
+
+    def _evict_idle(self) -> None:
+        """close the least recently used pools without running request"""
+        for key, client in list(self._clients.items()):
+            if len(self._clients) <= self.max_hosts:
+                break
+            if self._pool_stats(client)["active"] == 0:
+                del self._clients[key]
+                asyncio.ensure_future(client.aclose())
+
+    @staticmethod
+    def _pool_stats(client: httpx.AsyncClient) -> Dict[str, int]:
+        # NOTE: httpcore pool is not public api, read it carefully
+        pool = getattr(client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "connections": len(connections),
+            "idle": idle,
+            "active": len(connections) - idle,
+            "waiting": len(getattr(pool, "_requests", [])),
+        }
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """pool occupancy of every upstream host"""
+        return {key: self._pool_stats(c) for key, c in self._clients.items()}
+
+    async def aclose(self) -> None:
+        clients, self._clients = list(self._clients.values()), OrderedDict()
+        for client in clients:
+            await client.aclose()
+
+
+# resolve every upstream hostname once per ttl
+GlobalDNSCache = DNSCache(
+    default_ttl=settings.PROXY_DNS_TTL,
+    max_ttl=max(settings.PROXY_DNS_TTL, 3600),
+    negative_ttl=settings.PROXY_DNS_NEGATIVE_TTL,
+    max_entries=settings.PROXY_DNS_CACHE_SIZE,
 )
 
 # # NOTE: client must be a global variable.outside of the function.
-GlobalHttpxClient = httpx.AsyncClient(verify=False, timeout=8)
+GlobalHttpxClientRegistry = HttpxClientRegistry(
+    max_connections=settings.PROXY_MAX_CONNECTIONS_PER_HOST,
+    max_keepalive_connections=settings.PROXY_MAX_KEEPALIVE_PER_HOST,
+    keepalive_expiry=settings.PROXY_KEEPALIVE_EXPIRY,
+    http2=settings.PROXY_HTTP2,
+    timeout=settings.PROXY_TIMEOUT,
+    connect_timeout=settings.PROXY_CONNECT_TIMEOUT,
+    max_hosts=settings.PROXY_MAX_HOSTS,
+    network_backend=(
+        CachingNetworkBackend(GlobalDNSCache) if settings.PROXY_DNS_CACHE else None
+    ),
+)
+
+# health of every upstream host, fail fast while it is down
+GlobalCircuitBreaker = CircuitBreaker(
+    failure_threshold=settings.PROXY_BREAKER_FAILURES,
+    recovery_time=settings.PROXY_BREAKER_RECOVERY,
+)
+
+# bound the running proxy requests, queue and shed the burst
+GlobalAdmissionController = AdmissionController(
+    max_active=settings.PROXY_MAX_ACTIVE,
+    max_active_per_host=settings.PROXY_MAX_ACTIVE_PER_HOST,
+    max_queue=settings.PROXY_ADMISSION_QUEUE,
+    queue_timeout=settings.PROXY_ADMISSION_TIMEOUT,
+)
+
+# response bodies buffered in memory by all requests
+GlobalMemoryBudget = MemoryBudget(limit=settings.PROXY_MEMORY_BUDGET)
+
+# shared by /proxy/ and /file/
+GlobalResponseCache = ResponseCache(
+    memory_size=settings.PROXY_CACHE_MEMORY_SIZE,
+    memory_object_size=settings.PROXY_CACHE_MEMORY_OBJECT_SIZE,
+    disk_size=settings.PROXY_CACHE_DISK_SIZE,
+    disk_object_size=settings.PROXY_CACHE_DISK_OBJECT_SIZE,
+    directory=settings.PROXY_CACHE_DIR or None,
+    stale_while_revalidate=settings.PROXY_STALE_WHILE_REVALIDATE,
+    stale_if_error=settings.PROXY_STALE_IF_ERROR,
+    memory_budget=GlobalMemoryBudget,
+)
+
+# coalesce identical concurrent upstream requests
+GlobalSingleFlight = SingleFlight(
+    capacity=settings.PROXY_SINGLE_FLIGHT_BUFFER,
+    lag_timeout=settings.PROXY_SINGLE_FLIGHT_LAG_TIMEOUT,
+    memory_budget=GlobalMemoryBudget,
+)
+
+# pace /file/ streams
+GlobalBandwidthScheduler = BandwidthScheduler(
+    global_rate=settings.PROXY_BANDWIDTH_GLOBAL,
+    per_ip_rate=settings.PROXY_BANDWIDTH_PER_IP,
+    per_host_rate=settings.PROXY_BANDWIDTH_PER_HOST,
+)
+
+# known redirect hops
+GlobalRedirectResolver = RedirectResolver(
+    permanent_ttl=settings.PROXY_REDIRECT_TTL,
+    max_entries=settings.PROXY_REDIRECT_CACHE_SIZE,
+)
+
+# blocks of range request of /file/
+GlobalChunkStore = ChunkStore(
+    block_size=settings.PROXY_RANGE_BLOCK_SIZE,
+    max_size=settings.PROXY_RANGE_CACHE_SIZE,
+    directory=settings.PROXY_RANGE_CACHE_DIR or None,
+    min_fetch_size=settings.PROXY_RANGE_MIN_FETCH,
+)
+
+# big file of /file/ by concurrent ranges
+GlobalSegmentedDownloader = SegmentedDownloader(
+    segments=settings.PROXY_SEGMENTS,
+    segment_size=settings.PROXY_SEGMENT_SIZE,
+    min_size=settings.PROXY_SEGMENT_MIN_SIZE,
+    memory_budget=GlobalMemoryBudget,
+)
+
+# client side coding levels, shared with `CompressionMiddleware`
+GlobalCompressionLevels = {
+    "gzip": settings.COMPRESSION_GZIP_LEVEL,
+    "br": settings.COMPRESSION_BROTLI_LEVEL,
+    "zstd": settings.COMPRESSION_ZSTD_LEVEL,
+}
+
+# compressed bodies of the cached responses
+GlobalEncodedCache = EncodedCache(
+    max_size=settings.PROXY_ENCODED_CACHE_SIZE, memory_budget=GlobalMemoryBudget
+)
+
+# avif/webp images for the clients accept them
+GlobalImageTranscoder = ImageTranscoder(
+    formats=settings.PROXY_IMAGE_FORMATS if settings.PROXY_IMAGE_TRANSCODE else (),
+    workers=settings.PROXY_IMAGE_WORKERS,
+    max_input_size=settings.PROXY_IMAGE_MAX_SIZE,
+    cache_size=settings.PROXY_IMAGE_CACHE_SIZE,
+)
+
+# critical subresources of the proxied pages, and the cache warming of them
+GlobalPreloadHints = PreloadHints(max_resources=settings.PROXY_PRELOAD_HINTS)
+GlobalPrefetcher = Prefetcher(concurrency=settings.PROXY_PREFETCH_CONCURRENCY)
+# refresh the stale cached responses which are still served
+GlobalRevalidator = Prefetcher(concurrency=settings.PROXY_REVALIDATE_CONCURRENCY)
 
 
 class _ConnectionHeaderParseResult(NamedTuple):
@@ -29,9 +360,7 @@ class _ConnectionHeaderParseResult(NamedTuple):
 
     Attributes:
         require_close: If "connection" header contain "close" value, this will be True, else False.
-        new_headers: New request headers.
-            "connection" header does not contain a 'close' value, but must contain 'keep-alive' value,
-            and the "keep-alive" header was removed.
+        new_headers: New request headers, the hop-by-hop headers were removed.
     """
 
     require_close: bool
@@ -49,22 +378,87 @@ def modify_url(request: Request, url: str) -> str:
     return unquote(url)
 
 
-def get_redirect_url(url: str) -> str:
-    """get the moved url"""
-    with httpx.Client(verify=False) as client:
-        resp = client.head(url, follow_redirects=True)
-        return str(resp.url)
+async def get_redirect_url(url: str) -> str:
+    """get the moved url, the known hops are skipped"""
+    target = GlobalRedirectResolver.resolve(httpx.URL(url))
+    client = GlobalHttpxClientRegistry.get(target)
+    resp = await client.head(target, follow_redirects=True)
+    await resp.aclose()
+    GlobalRedirectResolver.record(resp)
+    return str(resp.url)
+
+
+async def send_upstream(
+    client: httpx.AsyncClient, upstream_request: httpx.Request, hedge: bool = False
+) -> httpx.Response:
+    """send through the circuit breaker of the upstream host, the body is streamed
+
+    With `hedge`, a slow GET/HEAD without body may be sent twice.
+    """
+
+    async def send() -> httpx.Response:
+        return await client.send(upstream_request, stream=True, follow_redirects=True)
+
+    if not settings.PROXY_BREAKER:
+        return await send()
+    hedge_percentile = None
+    if (
+        hedge
+        and settings.PROXY_HEDGE_PERCENTILE > 0
+        and upstream_request.method in ("GET", "HEAD")
+        # replayable body
+        and isinstance(upstream_request.stream, httpx.ByteStream)
+    ):
+        hedge_percentile = settings.PROXY_HEDGE_PERCENTILE
+    return await GlobalCircuitBreaker.call(
+        HttpxClientRegistry.host_key(upstream_request.url),
+        send,
+        hedge_percentile=hedge_percentile,
+        min_hedge_delay=settings.PROXY_HEDGE_MIN_DELAY,
+    )
+
+
+def unavailable_response(
+    error: Union[UpstreamUnavailable, AdmissionRejected],
+) -> Response:
+    """fast fail while the circuit of upstream is open, or the proxy is overloaded"""
+    return PlainTextResponse(
+        content=f"Error: {error}",
+        status_code=503,
+        headers={"retry-after": str(max(1, math.ceil(error.retry_after)))},
+    )
 
 
 def replace_html(html: bytes, proxy_url: str) -> str:
     """replace the src and href in html"""
-    pattern = r'(src|href|content)="(.*?)"'
-    content = re.sub(
-        pattern,
-        lambda match: match.group(1) + '="' + urljoin(proxy_url, match.group(2)) + '"',
-        html.decode("utf-8"),
-    )
-    return content
+    rewriter = StreamingHTMLRewriter(proxy_url)
+    return rewriter.feed(html.decode("latin-1")) + rewriter.flush()
+
+
+def is_html_response(headers: StarletteHeaders) -> bool:
+    """whether the response body is a html document"""
+    content_type = headers.get("content-type", "").lower()
+    return "text/html" in content_type or "application/xhtml+xml" in content_type
+
+
+def proxy_target_params(query_params: Any) -> List[Tuple[str, str]]:
+    """client query params which belong to the target url, without our `url`"""
+    return [(k, v) for k, v in query_params.multi_items() if k != "url"]
+
+
+async def rewrite_stream(
+    stream: AsyncIterator[bytes],
+    rewriter: Union[StreamingHTMLRewriter, StreamingTextRewriter],
+) -> AsyncIterator[bytes]:
+    """rewrite the url in document chunk by chunk while forwarding"""
+    # NOTE: latin-1 round trip every byte, so the page charset is not matter
+    async for chunk in stream:
+        piece = rewriter.feed(chunk.decode("latin-1"))
+        if piece:
+            yield piece.encode("latin-1")
+    tail = rewriter.flush()
+    if tail:
+        yield tail.encode("latin-1")
 
 
 def change_necessary_client_header_for_httpx(
@@ -72,7 +466,7 @@ def change_necessary_client_header_for_httpx(
 ) -> StarletteMutableHeaders:
     """Change client request headers for sending to proxy server.
 
-    - Change "host" header to `target_url.netloc.decode("ascii")`.
+    - Change "host" header to `target_url.netloc`.
     - If "Cookie" header is not in headers,
         will forcibly add a empty "Cookie" header
         to avoid httpx.AsyncClient automatically add another user cookiejar.
@@ -85,20 +479,18 @@ def change_necessary_client_header_for_httpx(
         New requests headers, the copy of original input headers.
     """
     # https://www.starlette.io/requests/#headers
-    new_headers = headers.mutablecopy()
-
-    # 将host字段更新为目标url的host
-    # TODO: 如果查看httpx.URL源码，就会发现netloc是被字符串编码成bytes的，能否想个办法直接获取字符串来提高性能?
-    new_headers["host"] = target_url.netloc.decode("ascii")
+    # work on the raw bytes, `netloc` is already bytes, not need to decode
+    raw = [(k, v) for k, v in headers.raw if k != b"host"]
+    raw.append((b"host", target_url.netloc))
 
     # https://developer.mozilla.org/zh-CN/docs/Web/HTTP/Headers/Cookie
 
     # FIX: https://github.com/WSH032/fastapi-proxy-lib/security/advisories/GHSA-7vwr-g6pm-9hc8
     # forcibly set `Cookie` header to avoid httpx.AsyncClient automatically add another user cookiejar
-    if "Cookie" not in new_headers:  # case-insensitive
-        new_headers["Cookie"] = ""
+    if "cookie" not in headers:
+        raw.append((b"cookie", b""))
 
-    return new_headers
+    return StarletteMutableHeaders(raw=raw)
 
 
 def change_client_header(
@@ -106,12 +498,12 @@ def change_client_header(
 ) -> _ConnectionHeaderParseResult:
     """Change client request headers for sending to proxy server.
 
-    - Change "host" header to `target_url.netloc.decode("ascii")`.
+    - Change "host" header to `target_url.netloc`.
     - If "Cookie" header is not in headers,
         will forcibly add a empty "Cookie" header
         to avoid httpx.AsyncClient automatically add another user cookiejar.
-    - Will remove "close" value in "connection" header, and add "keep-alive" value to it.
-    - And remove "keep-alive" header.
+    - Remove the hop-by-hop headers ("connection", "keep-alive", "te", ...)
+        and the headers listed in "connection", httpx keep the upstream connection alive.
 
     Args:
         headers: original client request headers.
@@ -122,194 +514,1126 @@ def change_client_header(
             require_close: If "connection" header contain "close" value, this will be True, else False.
             new_headers: New requests headers, the **copy** of original input headers.
     """
-    # https://www.starlette.io/requests/#headers
-
-    new_headers = change_necessary_client_header_for_httpx(
-        headers=headers, target_url=target_url
-    )
-
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Connection#syntax
-    # NOTE: http标准中规定，connecttion头字段的值用于指示逐段头，而标头是大小写不敏感的，故认为可以转为小写处理
-    client_connection_header = [
-        v.strip() for v in new_headers.get("connection", "").lower().split(",")
-    ]
-
-    # 判断原始请求头中是否有"close"字段，如果有则将其移除，并记录
-    if "close" in client_connection_header:
-        whether_require_close = True
-        client_connection_header.remove("close")
-    else:
-        whether_require_close = False
-    # 强制添加"keep-alive"字段保持连接
-    if "keep-alive" not in client_connection_header:
-        client_connection_header.insert(0, "keep-alive")
-    # 将新的connection头字段更新到新的请求头中
-    # 因为 "keep-alive" 一定存在于 "connection"字段 中，所以这里不需要判断是否为空
-    new_headers["connection"] = ",".join(client_connection_header)
-
-    # 移除"keep-alive"字段
-    if "keep-alive" in new_headers:
-        del new_headers["keep-alive"]
-
-    # new_headers[
-    #     "user-agent"
-    # ] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/999.0.9999.999 Safari/537.36"
-
-    return _ConnectionHeaderParseResult(whether_require_close, new_headers)
+    # one pass on the ASGI raw headers, no str decoding and no case-insensitive lookup
+    require_close, raw = filter_request_headers(headers.raw, target_url.netloc)
+    return _ConnectionHeaderParseResult(require_close, StarletteMutableHeaders(raw=raw))
 
 
 def change_server_header(
-    *, headers: httpx.Headers, require_close: bool
-) -> httpx.Headers:
+    *, headers: Union[httpx.Headers, RawHeaders], require_close: bool
+) -> StarletteMutableHeaders:
     """Change server response headers for sending to client.
 
-    - If require_close is True, will make sure "connection: close" in headers, else will remove it.
-    - And remove "keep-alive" header.
+    - If require_close is True, will make sure "connection: close" in headers.
+    - Remove the hop-by-hop headers and the headers listed in "connection".
 
     Args:
-        headers: server response headers
+        headers: server response headers, or the raw headers of them.
         require_close: whether require close connection
 
     Returns:
-        The **oringinal headers**, but **had been changed**.
+        New headers, the names are lowercase. Use `stream_response` to send them
+        without encoding again.
+    """
+    raw = headers.raw if isinstance(headers, httpx.Headers) else headers
+    # https://www.uvicorn.org/server-behavior/#http-headers
+    # 如果响应头包含"connection": "close"，uvicorn会自动关闭连接
+    return StarletteMutableHeaders(raw=filter_response_headers(raw, require_close))
+
+
+def stream_response(
+    content: AsyncIterator[bytes],
+    status_code: int,
+    headers: StarletteMutableHeaders,
+    background: Optional[BackgroundTask] = None,
+) -> StreamingResponse:
+    """StreamingResponse which take the raw headers directly
+
+    Duplicate headers (e.g. set-cookie) are kept, `httpx.Headers.items()` would merge them.
     """
-    server_connection_header: List[str] = [
-        v.strip() for v in headers.get("connection", "").lower().split(",")
-    ]
-
-    # 移除或添加"connection": "close"头
-    if require_close:
-        if "close" not in server_connection_header:
-            server_connection_header.insert(0, "close")
+    response = StreamingResponse(
+        content=content, status_code=status_code, background=background
+    )
+    response.raw_headers = headers.raw
+    return response
+
+
+def response_encoding(
+    request: Request, headers: StarletteMutableHeaders, status_code: int
+) -> Optional[str]:
+    """coding the proxy add for the client, None send the body as it is"""
+    if not settings.COMPRESSION or request.method == "HEAD":
+        return None
+    if not should_compress(headers, status_code, settings.COMPRESSION_MINIMUM_SIZE):
+        return None
+    # the body depend on it even if it is sent as it is
+    add_vary_accept_encoding(headers)
+    return negotiate_encoding(request.headers.get("accept-encoding"))
+
+
+def encoded_response(
+    content: AsyncIterator[bytes],
+    status_code: int,
+    headers: StarletteMutableHeaders,
+    encoding: Optional[str],
+    variant: Optional[str] = None,
+    background: Optional[BackgroundTask] = None,
+) -> Response:
+    """compress the body with `encoding`
+
+    `variant` identify a stored body and the transform of it, the compressed
+    body is cached under it and never compressed again.
+    """
+    if encoding is None:
+        return stream_response(content, status_code, headers, background)
+    set_encoding_headers(headers, encoding)
+    encoder = get_encoder(encoding, GlobalCompressionLevels)
+    if variant is None:
+        return stream_response(
+            encode_stream(content, encoder), status_code, headers, background
+        )
+
+    key = f"{variant}|{encoding}"
+    body = GlobalEncodedCache.get(key)
+    if body is None:
+        content = GlobalEncodedCache.encode(key, content, encoder)
+        return stream_response(content, status_code, headers, background)
+    headers["content-length"] = str(len(body))
+    response = Response(content=body, status_code=status_code, background=background)
+    response.raw_headers = headers.raw
+    return response
+
+
+async def read_response_body(response: Response) -> bytes:
+    """consume the body of the built response, it can not be sent any more"""
+    if isinstance(response, StreamingResponse):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    if isinstance(response, FileSliceResponse):
+        return await response.read()
+    return response.body
+
+
+async def transcode_image_response(
+    request: Request, target_url: str, response: Response
+) -> Response:
+    """the image in avif/webp if the client accept it, otherwise as it is
+
+    Only for the subresources of /proxy/, /file/ is a download. The image is
+    small enough to be read in memory.
+    """
+    if not GlobalImageTranscoder.enabled or response.status_code != 200:
+        return response
+    headers = response.headers
+    if (
+        not is_transcodable(headers.get("content-type"))
+        or "content-encoding" in headers
+        # saved as a file, the name tell the format
+        or "content-disposition" in headers
+        or "no-transform" in parse_cache_control(headers.get("cache-control", ""))
+    ):
+        return response
+    # the representation depend on `accept` from now on
+    headers.add_vary_header("accept")
+
+    image_format = GlobalImageTranscoder.negotiate(request.headers.get("accept"))
+    length = headers.get("content-length", "")
+    if (
+        image_format is None
+        or request.method != "GET"
+        or not length.isdigit()
+        or not GlobalImageTranscoder.accepts_size(int(length))
+        or not GlobalMemoryBudget.reserve(int(length))
+    ):
+        return response
+    try:
+        data = await read_response_body(response)
+        validator = headers.get("etag") or headers.get("last-modified")
+        if validator is None:
+            validator = hashlib.blake2b(data, digest_size=16).hexdigest()
+        url = httpx.URL(target_url).copy_merge_params(
+            proxy_target_params(request.query_params)
+        )
+        body = await GlobalImageTranscoder.transcode(
+            f"{url}|{validator}|{image_format}", data, image_format
+        )
+    except BaseException:
+        # the response is never sent, close the upstream response it hold
+        if response.background is not None:
+            await response.background()
+        raise
+    finally:
+        GlobalMemoryBudget.release(int(length))
+
+    if body:
+        headers["content-type"] = f"image/{image_format}"
+        etag = headers.get("etag")
+        if etag is not None and etag.endswith('"'):
+            headers["etag"] = f'{etag[:-1]}-{image_format}"'
+        if "accept-ranges" in headers:
+            del headers["accept-ranges"]
     else:
-        if "close" in server_connection_header:
-            server_connection_header.remove("close")
-    # 将新的connection头字段更新到新的请求头中，如果为空则移除
-    if server_connection_header:
-        headers["connection"] = ",".join(server_connection_header)
+        body = data
+    headers["content-length"] = str(len(body))
+    image_response = Response(
+        content=body, status_code=200, background=response.background
+    )
+    image_response.raw_headers = headers.raw
+    return image_response
+
+
+def transform_web_content(
+    headers: StarletteMutableHeaders,
+    raw_stream: AsyncIterator[bytes],
+    base_url: str,
+    url_mapper: Optional[UrlMapper] = None,
+    on_resource: Optional[ResourceCallback] = None,
+) -> AsyncIterator[bytes]:
+    """decode and rewrite html, css and js document, other body is forwarded untouched
+
+    With `url_mapper` (e.g. `proxy_url_mapper`), the url are routed through the proxy,
+    else the relative url of html are made absolute.
+    `on_resource` receive the critical subresources of html.
+
+    NOTE: `headers` will be changed if the body is rewritten.
+    """
+    if url_mapper is not None and "link" in headers:
+        # upstream preload, the browser would fetch it from upstream directly
+        raw = headers.raw
+        for i, (name, value) in enumerate(raw):
+            if name == b"link":
+                link = value.decode("latin-1")
+                link = rewrite_link_header(base_url, link, url_mapper)
+                raw[i] = (name, link.encode("latin-1"))
+
+    rewriter: Optional[Union[StreamingHTMLRewriter, StreamingTextRewriter]] = None
+    if is_html_response(headers):
+        rewriter = StreamingHTMLRewriter(base_url, url_mapper, on_resource=on_resource)
+    elif url_mapper is not None:
+        rewriter = text_stream_rewriter(
+            headers.get("content-type", ""), base_url, url_mapper
+        )
+
+    decoder = None
+    if rewriter is not None:
+        decoder = get_decoder(headers.get("content-encoding", ""))
+        if decoder is None:
+            logger.warning(
+                f"Unsupported content-encoding {headers['content-encoding']}, skip rewrite {base_url}"
+            )
+
+    if decoder is None:
+        # body is not touched, forward the encoded bytes and keep content-length
+        return raw_stream
+
+    # only decode the body when it need to be rewritten
+    # the length is changed after rewriting, it is compressed again for the client
+    for header in ("content-encoding", "content-length"):
+        if header in headers:
+            del headers[header]
+    assert rewriter is not None
+    return rewrite_stream(decode_stream(raw_stream, decoder), rewriter)
+
+
+def cached_response(
+    request: Request,
+    entry: CacheEntry,
+    require_close: bool,
+    cache_status: str,
+    rewrite: bool,
+    on_resource: Optional[ResourceCallback] = None,
+) -> Response:
+    """build response from the stored upstream response"""
+    headers = change_server_header(
+        headers=encode_headers(entry.response_headers()), require_close=require_close
+    )
+    headers["x-proxy-cache"] = cache_status
+
+    if entry.status_code == 200 and entry.not_modified_for(request.headers):
+        for header in ("content-length", "content-encoding", "content-type"):
+            if header in headers:
+                del headers[header]
+        return Response(status_code=304, headers=headers)
+
+    if not rewrite:
+        return _cached_body_response(request, entry, headers)
+
+    content = transform_web_content(
+        headers,
+        entry.iter_body(),
+        entry.url,
+        proxy_url_mapper(request.url.path),
+        on_resource,
+    )
+    # the rewritten document only depend on the body and the proxy endpoint
+    return encoded_response(
+        content,
+        entry.status_code,
+        headers,
+        response_encoding(request, headers, entry.status_code),
+        variant=f"{entry.serial}|{request.url.path}",
+    )
+
+
+def _cached_body_response(
+    request: Request, entry: CacheEntry, headers: StarletteMutableHeaders
+) -> Response:
+    """the stored body as it is, or the requested range of it
+
+    The file of disk tier is sent by the server (zero-copy) if it can.
+    """
+    offset, count, status_code = 0, entry.size, entry.status_code
+    if entry.status_code == 200:
+        headers["accept-ranges"] = "bytes"
+        spec = parse_range(request.headers.get("range", ""))
+        if_range = request.headers.get("if-range")
+        validator = strong_validator(entry.etag, entry.last_modified)
+        # client has another version, send the whole file
+        if spec is not None and (if_range is None or if_range == validator):
+            byte_range = resolve_range(spec, entry.size)
+            if byte_range is None:
+                return _range_not_satisfiable(entry.size)
+            offset = byte_range.start
+            count = byte_range.end - byte_range.start + 1
+            status_code = 206
+            headers["content-range"] = (
+                f"bytes {byte_range.start}-{byte_range.end}/{entry.size}"
+            )
+
+    if status_code != 206:
+        encoding = response_encoding(request, headers, status_code)
+        if encoding is not None:
+            return encoded_response(
+                entry.iter_body(),
+                status_code,
+                headers,
+                encoding,
+                variant=str(entry.serial),
+            )
+
+    file = open_file(entry.path)
+    if file is not None:
+        return FileSliceResponse(file, offset, count, status_code, headers)
+    headers["content-length"] = str(count)
+    return stream_response(entry.iter_body(offset, count), status_code, headers)
+
+
+async def send_early_hints(request: Request, links: List[str]) -> None:
+    """103 Early Hints, only when the ASGI server support it (e.g. hypercorn)"""
+    if not links or "http.response.early_hint" not in request.scope.get(
+        "extensions", {}
+    ):
+        return
+    # NOTE: starlette Request keep the send channel, as `send_push_promise` use it
+    await request._send(
+        {
+            "type": "http.response.early_hint",
+            "links": [link.encode("latin-1") for link in links],
+        }
+    )
+
+
+def add_links(response: Response, links: List[str]) -> Response:
+    """append the preload links, skip the url upstream already listed"""
+    if not links:
+        return response
+    existing = ",".join(response.headers.getlist("link"))
+    for link in links:
+        if link[: link.index(">") + 1] not in existing:
+            response.headers.append("link", link)
+    return response
+
+
+async def prefetch_to_cache(url: str, headers: StarletteHeaders) -> None:
+    """fetch a subresource into the shared cache, nobody read the body"""
+    target = httpx.URL(url)
+    if settings.PROXY_REDIRECT_CACHE:
+        target = GlobalRedirectResolver.resolve(target)
+    request_headers = headers.mutablecopy()
+    request_headers["host"] = target.netloc.decode("ascii")
+    client = GlobalHttpxClientRegistry.get(target)
+    prefetch_request = client.build_request(
+        method="GET", url=target, headers=request_headers.raw
+    )
+    cache_url = str(prefetch_request.url)
+    if GlobalResponseCache.lookup("GET", cache_url, request_headers) is not None:
+        return
+
+    response = await send_upstream(client, prefetch_request)
+    try:
+        if settings.PROXY_REDIRECT_CACHE:
+            GlobalRedirectResolver.record(response)
+        if not GlobalResponseCache.response_is_cacheable(response, request_headers):
+            return
+        writer = GlobalResponseCache.create_writer(
+            "GET", cache_url, response, request_headers
+        )
+        async for _ in tee_to_cache(response.aiter_raw(), writer):
+            pass
+    finally:
+        await response.aclose()
+
+
+async def revalidate_entry(
+    entry: CacheEntry, url: str, proxy_header: StarletteHeaders
+) -> None:
+    """refresh the stale entry in background, the clients are served with it"""
+    headers = proxy_header.mutablecopy()
+    for name in ("range", "if-range", "if-none-match", "if-modified-since"):
+        if name in headers:
+            del headers[name]
+    headers.update(entry.conditional_headers())
+    client = GlobalHttpxClientRegistry.get(url)
+    revalidate_request = client.build_request(
+        method="GET", url=url, headers=headers.raw
+    )
+    response = await send_upstream(client, revalidate_request)
+    try:
+        if response.status_code == 304:
+            GlobalResponseCache.freshen(entry, response.headers)
+            return
+        if response.status_code in FAILURE_STATUS:
+            # keep the stale entry for stale-if-error
+            return
+        if not GlobalResponseCache.response_is_cacheable(response, proxy_header):
+            GlobalResponseCache.remove(entry.key)
+            return
+        writer = GlobalResponseCache.create_writer("GET", url, response, proxy_header)
+        async for _ in tee_to_cache(response.aiter_raw(), writer):
+            pass
+    finally:
+        await response.aclose()
+
+
+def _prefetch_callback(proxy_header: StarletteHeaders) -> ResourceCallback:
+    """warm the cache with the subresources of the page"""
+    # anonymous request, the shared cache must not keep the private response
+    headers = proxy_header.mutablecopy()
+    for name in (
+        "authorization",
+        "range",
+        "if-range",
+        "if-none-match",
+        "if-modified-since",
+    ):
+        if name in headers:
+            del headers[name]
+    headers["cookie"] = ""
+    headers["accept"] = "*/*"
+
+    def prefetch(url: str, destination: str) -> None:
+        GlobalPrefetcher.schedule(url, lambda: prefetch_to_cache(url, headers))
+
+    return prefetch
+
+
+async def _send_block_request(
+    proxy_header: StarletteHeaders,
+    url: str,
+    start: int,
+    end: Optional[int],
+    validator: Optional[str] = None,
+) -> httpx.Response:
+    """request blocks from upstream, `end` None means to the end of file
+
+    With `validator`, upstream send the whole file if it is changed.
+    """
+    headers = proxy_header.mutablecopy()
+    headers["range"] = f"bytes={start}-{'' if end is None else end}"
+    if validator is not None:
+        headers["if-range"] = validator
+    # the block must be the raw bytes of the file
+    headers["accept-encoding"] = "identity"
+    client = GlobalHttpxClientRegistry.get(url)
+    block_request = client.build_request(method="GET", url=url, headers=headers.raw)
+    return await send_upstream(client, block_request)
+
+
+def _segmented_body(
+    response: httpx.Response, proxy_header: StarletteHeaders
+) -> Optional[AsyncIterator[bytes]]:
+    """the body by concurrent range requests, None if upstream can not split it"""
+    size = GlobalSegmentedDownloader.size_of(response)
+    if size is None:
+        return None
+    url = str(response.url)
+    validator = strong_validator(
+        response.headers.get("etag"), response.headers.get("last-modified")
+    )
+
+    def open_range(start: int, end: int) -> Awaitable[httpx.Response]:
+        return _send_block_request(proxy_header, url, start, end, validator)
+
+    return GlobalSegmentedDownloader.stream(response, size, open_range)
+
+
+async def _store_blocks(
+    stream: AsyncIterator[bytes],
+    offset: int,
+    run_end: int,
+    byte_range: ByteRange,
+    obj: Optional[CachedObject],
+    fd: Optional[int],
+) -> AsyncIterator[bytes]:
+    """forward the part within `byte_range`, and store every completed block
+
+    Args:
+        offset: the position of the first byte of the stream, aligned to block
+        run_end: exclusive end position of the blocks need to be read
+    """
+    block_size = GlobalChunkStore.block_size
+    pending = bytearray()
+    pending_offset = offset
+    async for chunk in stream:
+        chunk_start, offset = offset, offset + len(chunk)
+        low = max(chunk_start, byte_range.start)
+        high = min(offset, byte_range.end + 1)
+        if low < high:
+            yield chunk[low - chunk_start : high - chunk_start]
+
+        if obj is not None and fd is not None:
+            pending += chunk
+            while len(pending) >= block_size:
+                await write_block(fd, bytes(pending[:block_size]), pending_offset)
+                GlobalChunkStore.mark(obj, pending_offset // block_size)
+                del pending[:block_size]
+                pending_offset += block_size
+        if offset >= run_end:
+            break
+
+    # the last block of the file is shorter
+    if obj is not None and fd is not None and pending:
+        if pending_offset + len(pending) >= obj.size:
+            await write_block(
+                fd, bytes(pending[: obj.size - pending_offset]), pending_offset
+            )
+            GlobalChunkStore.mark(obj, pending_offset // block_size)
+
+
+async def _iter_range(
+    obj: Optional[CachedObject],
+    byte_range: ByteRange,
+    proxy_header: StarletteHeaders,
+    first_response: Optional[httpx.Response],
+) -> AsyncIterator[bytes]:
+    """read stored blocks and fetch the missing runs from upstream"""
+    block_size = GlobalChunkStore.block_size
+    first = byte_range.start // block_size
+    last = byte_range.end // block_size
+    fd = open_block_file(obj) if obj is not None else None
+    if fd is None or first_response is not None:
+        # the first response already cover all blocks, or the object is evicted
+        runs = [(False, first, last)]
     else:
-        if "connection" in headers:
-            del headers["connection"]
+        assert obj is not None
+        runs = GlobalChunkStore.plan(obj, byte_range)
+
+    try:
+        for stored, run_first, run_last in runs:
+            run_start = run_first * block_size
+            run_end = (run_last + 1) * block_size
+            if obj is not None:
+                run_end = min(run_end, obj.size)
+            if stored:
+                assert fd is not None
+                async for data in read_blocks(
+                    fd,
+                    max(byte_range.start, run_start),
+                    min(byte_range.end, run_end - 1),
+                ):
+                    yield data
+                continue
 
-    # 移除"keep-alive"字段
-    if "keep-alive" in headers:
-        del headers["keep-alive"]
+            if first_response is not None:
+                response, first_response = first_response, None
+            else:
+                assert obj is not None
+                response = await _send_block_request(
+                    proxy_header, obj.url, run_start, run_end - 1, obj.validator
+                )
+                content_range = parse_content_range(
+                    response.headers.get("content-range")
+                )
+                if response.status_code != 206 or (
+                    content_range is None or content_range.start != run_start
+                ):
+                    await response.aclose()
+                    GlobalChunkStore.invalidate(obj.url)
+                    raise RuntimeError(f"upstream file is changed: {obj.url}")
 
+            try:
+                async for data in _store_blocks(
+                    response.aiter_raw(), run_start, run_end, byte_range, obj, fd
+                ):
+                    yield data
+            finally:
+                await response.aclose()
+    finally:
+        if first_response is not None:
+            await first_response.aclose()
+        if fd is not None:
+            os.close(fd)
+
+
+def _range_headers(
+    obj_headers: List[Tuple[str, str]],
+    size: int,
+    byte_range: ByteRange,
+    require_close: bool,
+    cache_status: str,
+) -> StarletteMutableHeaders:
+    headers = change_server_header(
+        headers=encode_headers(obj_headers), require_close=require_close
+    )
+    headers["accept-ranges"] = "bytes"
+    headers["content-range"] = f"bytes {byte_range.start}-{byte_range.end}/{size}"
+    headers["content-length"] = str(byte_range.end - byte_range.start + 1)
+    headers["x-proxy-cache"] = cache_status
     return headers
 
 
-async def proxy_stream_file(request: Request, target_url: str) -> StreamingResponse:
-    """send request to target url
+def _range_response(
+    obj_headers: List[Tuple[str, str]],
+    size: int,
+    byte_range: ByteRange,
+    content: AsyncIterator[bytes],
+    require_close: bool,
+    cache_status: str,
+) -> StreamingResponse:
+    headers = _range_headers(obj_headers, size, byte_range, require_close, cache_status)
+    return stream_response(content, 206, headers)
 
-    return the stream response
+
+def _whole_file_response(
+    response: httpx.Response,
+    spec: Tuple[Optional[int], Optional[int]],
+    if_range: Optional[str],
+    require_close: bool,
+) -> Response:
+    """the range sliced from the whole file upstream sent instead
+
+    The whole file is forwarded if the range can not be located in it.
     """
-    # clean cookie
-    GlobalHttpxClient.cookies.clear()
+    background = BackgroundTask(response.aclose)
+    headers = response.headers
+    length = headers.get("content-length", "")
+    validator = strong_validator(headers.get("etag"), headers.get("last-modified"))
+    byte_range = None
+    # a client with another version get the whole file
+    if (
+        length.isdigit()
+        and "content-encoding" not in headers
+        and if_range in (None, validator)
+    ):
+        byte_range = resolve_range(spec, int(length))
+    if byte_range is None:
+        whole_headers = change_server_header(
+            headers=headers, require_close=require_close
+        )
+        whole_headers["x-proxy-cache"] = "BYPASS"
+        return stream_response(response.aiter_raw(), 200, whole_headers, background)
 
-    # url = modify_url(request, target_url)
-    # not need content body method
-    url = target_url
-    _NON_REQUEST_BODY_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
-    request_content = (
-        None if request.method in _NON_REQUEST_BODY_METHODS else request.stream()
+    content = _store_blocks(
+        response.aiter_raw(), 0, byte_range.end + 1, byte_range, None, None
     )
-    # 将请求头中的host字段改为目标url的host
-    # 同时强制移除"keep-alive"字段和添加"keep-alive"值到"connection"字段中保持连接
-    require_close, proxy_header = change_client_header(
-        headers=request.headers, target_url=httpx.URL(url)
+    range_headers = _range_headers(
+        object_headers(headers), int(length), byte_range, require_close, "BYPASS"
     )
+    return stream_response(content, 206, range_headers, background)
 
-    # generate request
-    proxy_request = GlobalHttpxClient.build_request(
-        method=request.method,
-        url=url,
-        params=request.query_params,
-        headers=proxy_header,
-        content=request_content,  # FIXME: 一个已知问题是，流式响应头包含'transfer-encoding': 'chunked'，但有些服务器会400拒绝这个头
-        # cookies=request.cookies,  # NOTE: headers中已有的cookie优先级高，所以这里不需要
-    )
 
-    # send request
-    # follow redirect can open
-    proxy_response = await GlobalHttpxClient.send(
-        proxy_request,
-        stream=True,
-        follow_redirects=True,
+def _range_not_satisfiable(size: int) -> Response:
+    return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+
+
+async def _revalidate_object(
+    obj: CachedObject, request: Request, proxy_header: StarletteHeaders
+) -> bool:
+    """ask upstream whether the stored file is unchanged, freshen it if so
+
+    The object is dropped if it is changed or can not be shared any more.
+    """
+    headers = proxy_header.mutablecopy()
+    for name in ("if-range", "if-none-match", "if-modified-since"):
+        if name in headers:
+            del headers[name]
+    # only the status and the headers are needed
+    headers["range"] = "bytes=0-0"
+    headers["accept-encoding"] = "identity"
+    headers.update(obj.conditional_headers())
+    client = GlobalHttpxClientRegistry.get(obj.url)
+    response = await send_upstream(
+        client, client.build_request(method="GET", url=obj.url, headers=headers.raw)
     )
+    await response.aclose()
 
-    # 依据先前客户端的请求，决定是否要添加"connection": "close"头到响应头中以关闭连接
-    # https://www.uvicorn.org/server-behavior/#http-headers
-    # 如果响应头包含"connection": "close"，uvicorn会自动关闭连接
-    proxy_response_headers = change_server_header(
-        headers=proxy_response.headers, require_close=require_close
+    if response.status_code == 304:
+        unchanged = response_is_shareable(response.headers, request.headers)
+    elif response.status_code in (200, 206):
+        content_range = parse_content_range(response.headers.get("content-range"))
+        size = content_range.size if content_range is not None else None
+        unchanged = (
+            GlobalChunkStore.response_is_cacheable(response, request.headers)
+            and size == obj.size
+            and strong_validator(
+                response.headers.get("etag"), response.headers.get("last-modified")
+            )
+            == obj.validator
+        )
+    else:
+        unchanged = False
+    if not unchanged:
+        GlobalChunkStore.invalidate(obj.url)
+        return False
+    obj.freshen(response.headers)
+    return True
+
+
+async def _proxy_range_request(
+    request: Request, url: str, proxy_header: StarletteHeaders, require_close: bool
+) -> Optional[Response]:
+    """serve single range GET of /file/ with the chunk store
+
+    return None if the request can not be served by blocks, go on normal proxy
+    """
+    spec = parse_range(request.headers["range"])
+    if spec is None:
+        # multiple ranges, forward to upstream as it is
+        return None
+    block_size = GlobalChunkStore.block_size
+    if_range = request.headers.get("if-range")
+
+    obj = GlobalChunkStore.get(url)
+    cache_status = "HIT"
+    if obj is not None and (
+        not obj.is_fresh() or request_requires_revalidation(request.headers)
+    ):
+        cache_status = "REVALIDATED"
+        if not await _revalidate_object(obj, request, proxy_header):
+            obj = None
+    if obj is not None:
+        if if_range is not None and if_range != obj.validator:
+            # client has another version, upstream decide to send the whole file
+            return None
+        byte_range = resolve_range(spec, obj.size)
+        if byte_range is None:
+            return _range_not_satisfiable(obj.size)
+        runs = GlobalChunkStore.plan(obj, byte_range)
+        if all(stored for stored, _, _ in runs):
+            # every block is stored, the slice of the block file is the range
+            file = open_file(obj.path)
+            if file is not None:
+                return FileSliceResponse(
+                    file,
+                    byte_range.start,
+                    byte_range.end - byte_range.start + 1,
+                    206,
+                    _range_headers(
+                        obj.headers, obj.size, byte_range, require_close, cache_status
+                    ),
+                )
+        return _range_response(
+            obj.headers,
+            obj.size,
+            byte_range,
+            _iter_range(obj, byte_range, proxy_header, None),
+            require_close,
+            cache_status if all(stored for stored, _, _ in runs) else "PARTIAL",
+        )
+
+    start, end = spec
+    if start is None:
+        # suffix range need the size of file first
+        return None
+    if end is not None and end - start + 1 < GlobalChunkStore.min_fetch_size:
+        # e.g. a player probing the header of the file
+        return None
+    # fetch whole blocks, so they can be stored
+    aligned_start = start // block_size * block_size
+    aligned_end = None if end is None else (end // block_size + 1) * block_size - 1
+    response = await _send_block_request(proxy_header, url, aligned_start, aligned_end)
+
+    if response.status_code == 200 and "content-range" not in response.headers:
+        # upstream ignore range, send the whole file once only, the next
+        # requests of the url are proxied as they are
+        GlobalChunkStore.mark_range_unsupported(url)
+        return _whole_file_response(response, spec, if_range, require_close)
+
+    content_range = parse_content_range(response.headers.get("content-range"))
+    if (
+        response.status_code != 206
+        or content_range is None
+        or content_range.size is None
+        or content_range.start != aligned_start
+        or "content-encoding" in response.headers
+    ):
+        await response.aclose()
+        return None
+
+    size = content_range.size
+    byte_range = resolve_range(spec, size)
+    if byte_range is None:
+        await response.aclose()
+        return _range_not_satisfiable(size)
+
+    validator = strong_validator(
+        response.headers.get("etag"), response.headers.get("last-modified")
     )
-    return StreamingResponse(
-        content=proxy_response.aiter_raw(),
-        status_code=proxy_response.status_code,
-        headers=proxy_response_headers,
-        background=BackgroundTask(proxy_response.aclose),
+    if if_range is not None and if_range != validator:
+        await response.aclose()
+        return None
+
+    new_obj = None
+    if validator is not None and GlobalChunkStore.response_is_cacheable(
+        response, request.headers
+    ):
+        new_obj = GlobalChunkStore.put(url, validator, size, response.headers)
+    return _range_response(
+        object_headers(response.headers),
+        size,
+        byte_range,
+        _iter_range(new_obj, byte_range, proxy_header, response),
+        require_close,
+        "MISS" if new_obj is not None else "BYPASS",
     )
 
 
-async def proxy_web_content(request: Request, target_url: str) -> Response:
-    """send request to target url
+async def _admitted(
+    target_url: str, handle: Callable[[], Awaitable[Response]]
+) -> Response:
+    """run `handle` in an admission slot of the upstream host
 
-    return the stream response
+    the slot is held until the response is sent.
     """
-    # clean cookie
-    GlobalHttpxClient.cookies.clear()
+    if not settings.PROXY_ADMISSION:
+        return await handle()
+    host = HttpxClientRegistry.host_key(httpx.URL(target_url))
+    try:
+        release = await GlobalAdmissionController.acquire(host)
+    except AdmissionRejected as e:
+        logger.warning(f"shed {target_url}: {e}")
+        return unavailable_response(e)
+    try:
+        response = await handle()
+    except BaseException:
+        release()
+        raise
+    return AdmittedResponse(response, release)
+
+
+async def _proxy_request(request: Request, target_url: str, rewrite: bool) -> Response:
+    try:
+        return await _forward_request(request, target_url, rewrite)
+    except UpstreamUnavailable as e:
+        logger.warning(f"fast fail {target_url}: {e}")
+        return unavailable_response(e)
+
+
+async def _forward_request(
+    request: Request, target_url: str, rewrite: bool
+) -> Response:
+    """send request to target url, reply with the cache if possible
 
+    return the stream response
+    """
     # url = modify_url(request, target_url)
-    # not need content body method
-    url = target_url
-    _NON_REQUEST_BODY_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
-    request_content = (
-        None if request.method in _NON_REQUEST_BODY_METHODS else request.stream()
+    url = httpx.URL(target_url).copy_merge_params(
+        proxy_target_params(request.query_params)
+    )
+    # skip the known redirect hops, only safe method can be redirected blindly,
+    # a user with credentials may be redirected elsewhere
+    follow_known_redirect = (
+        settings.PROXY_REDIRECT_CACHE
+        and request.method in ("GET", "HEAD")
+        and not request_has_credentials(request.headers)
+    )
+    if follow_known_redirect:
+        url = GlobalRedirectResolver.resolve(url)
+    client = GlobalHttpxClientRegistry.get(url)
+    use_cache = settings.PROXY_CACHE and request_is_cacheable(
+        request.method, request.headers
     )
+    if settings.PROXY_BREAKER and not use_cache:
+        # neither read the body nor wait for upstream which is known down,
+        # a cacheable request may still be served stale
+        GlobalCircuitBreaker.check(HttpxClientRegistry.host_key(url))
+
     # 将请求头中的host字段改为目标url的host
-    # 同时强制移除"keep-alive"字段和添加"keep-alive"值到"connection"字段中保持连接
+    # 同时移除逐跳头, httpx自己保持与上游的连接
     require_close, proxy_header = change_client_header(
-        headers=request.headers, target_url=httpx.URL(url)
+        headers=request.headers, target_url=url
+    )
+    if rewrite and "accept-encoding" in proxy_header:
+        # upstream must only use the encoding we can decode, in case of rewriting
+        proxy_header["accept-encoding"] = filter_accept_encoding(
+            proxy_header["accept-encoding"]
+        )
+    # forward the body with a known length, some servers reject chunked request
+    request_content = await prepare_request_body(
+        request, proxy_header, settings.PROXY_BODY_MEMORY_LIMIT
     )
 
     # generate request
-    proxy_request = GlobalHttpxClient.build_request(
+    proxy_request = client.build_request(
         method=request.method,
         url=url,
-        params=request.query_params,
-        headers=proxy_header,
-        content=request_content,  # FIXME: 一个已知问题是，流式响应头包含'transfer-encoding': 'chunked'，但有些服务器会400拒绝这个头
+        headers=proxy_header.raw,
+        content=request_content,
         # cookies=request.cookies,  # NOTE: headers中已有的cookie优先级高，所以这里不需要
     )
 
+    # lookup the shared cache, the key is the real upstream url
+    cache_url = str(proxy_request.url)
+
+    url_mapper = proxy_url_mapper(request.url.path) if rewrite else None
+    # preload the subresources known from the last response of the page,
+    # the browser fetch them while upstream is still answering
+    hint_links: List[str] = []
+    on_resource: Optional[ResourceCallback] = None
+    if rewrite and settings.PROXY_EARLY_HINTS and request.method == "GET":
+        assert url_mapper is not None
+        hint_links = [
+            preload_link(url_mapper(cache_url, url), destination)
+            for url, destination in GlobalPreloadHints.get(cache_url)
+        ]
+        await send_early_hints(request, hint_links)
+        on_resource = GlobalPreloadHints.collector(
+            cache_url,
+            on_new=(
+                _prefetch_callback(proxy_header)
+                if settings.PROXY_PREFETCH and settings.PROXY_CACHE
+                else None
+            ),
+        )
+
+    # a range of the whole stored response is sliced from the cache
+    if (
+        not rewrite
+        and settings.PROXY_CACHE
+        and range_request_is_cacheable(request.method, request.headers)
+    ):
+        range_entry = GlobalResponseCache.lookup("GET", cache_url, proxy_header)
+        if (
+            range_entry is not None
+            and range_entry.status_code == 200
+            and range_entry.is_fresh()
+            and not request_requires_revalidation(request.headers)
+        ):
+            return cached_response(request, range_entry, require_close, "HIT", rewrite)
+
+    # video seeking and resumed download are served by the block store
+    if (
+        not rewrite
+        and settings.PROXY_RANGE_CACHE
+        and request.method == "GET"
+        and "range" in request.headers
+        and block_request_is_cacheable(request.headers)
+        and not GlobalChunkStore.range_unsupported(cache_url)
+    ):
+        range_response = await _proxy_range_request(
+            request, cache_url, proxy_header, require_close
+        )
+        if range_response is not None:
+            return range_response
+    cache_entry = None
+    revalidating = False
+    # client does not ask to revalidate, the expired entry may be served
+    allow_stale = not request_requires_revalidation(request.headers)
+    if use_cache:
+        cache_entry = GlobalResponseCache.lookup(
+            request.method, cache_url, proxy_header
+        )
+    if cache_entry is not None:
+        if cache_entry.is_fresh() and allow_stale:
+            return add_links(
+                cached_response(
+                    request, cache_entry, require_close, "HIT", rewrite, on_resource
+                ),
+                hint_links,
+            )
+        if allow_stale and GlobalResponseCache.can_serve_stale(cache_entry):
+            # never wait for upstream, refresh the entry for the next clients
+            stale_entry = cache_entry
+            GlobalRevalidator.schedule(
+                stale_entry.key,
+                lambda: revalidate_entry(stale_entry, cache_url, proxy_header),
+            )
+            return add_links(
+                cached_response(
+                    request, cache_entry, require_close, "STALE", rewrite, on_resource
+                ),
+                hint_links,
+            )
+        # client conditional request is answered by upstream directly
+        if cache_entry.has_validator() and not (
+            "if-none-match" in proxy_header or "if-modified-since" in proxy_header
+        ):
+            proxy_request.headers.update(cache_entry.conditional_headers())
+            revalidating = True
+
     # send request
-    proxy_response = await GlobalHttpxClient.send(
-        proxy_request,
-        follow_redirects=True,
+    # follow redirect can open
+    # NOTE: stream the body, never hold the whole page in memory
+    async def send() -> httpx.Response:
+        return await send_upstream(client, proxy_request, hedge=True)
+
+    def cacheable(response: "Union[httpx.Response, SharedResponse]") -> bool:
+        return use_cache and GlobalResponseCache.response_is_cacheable(
+            response, request.headers
+        )
+
+    # the whole big file is downloaded by concurrent ranges
+    segmented = (
+        not rewrite
+        and GlobalSegmentedDownloader.enabled
+        and request.method == "GET"
+        and "range" not in request.headers
     )
 
+    def open_stream(response: httpx.Response) -> AsyncIterator[bytes]:
+        """the upstream body, stored in the cache once for all clients"""
+        stream = _segmented_body(response, proxy_header) if segmented else None
+        if stream is None:
+            stream = response.aiter_raw()
+        if not cacheable(response):
+            return stream
+        writer = GlobalResponseCache.create_writer(
+            request.method, cache_url, response, proxy_header
+        )
+        return tee_to_cache(stream, writer)
+
+    def serve_stale_on_error() -> bool:
+        return (
+            cache_entry is not None
+            and allow_stale
+            and GlobalResponseCache.can_serve_stale(cache_entry, on_error=True)
+        )
+
+    # identical concurrent requests share one upstream response
+    key = flight_key(proxy_request) if settings.PROXY_SINGLE_FLIGHT else None
+    proxy_response: "Union[httpx.Response, SharedResponse]"
+    try:
+        if key is not None:
+            proxy_response = await GlobalSingleFlight.fetch(key, send, open_stream)
+            raw_stream = proxy_response.aiter_raw()
+        else:
+            proxy_response = await send()
+            raw_stream = open_stream(proxy_response)
+    except (httpx.TransportError, UpstreamUnavailable) as e:
+        if not serve_stale_on_error():
+            raise
+        assert cache_entry is not None
+        logger.warning(f"serve stale {cache_url}: {e!r}")
+        return add_links(
+            cached_response(
+                request, cache_entry, require_close, "STALE", rewrite, on_resource
+            ),
+            hint_links,
+        )
+    if follow_known_redirect:
+        GlobalRedirectResolver.record(proxy_response)
+
+    if proxy_response.status_code in FAILURE_STATUS and serve_stale_on_error():
+        assert cache_entry is not None
+        await proxy_response.aclose()
+        logger.warning(f"serve stale {cache_url}: {proxy_response.status_code}")
+        return add_links(
+            cached_response(
+                request, cache_entry, require_close, "STALE", rewrite, on_resource
+            ),
+            hint_links,
+        )
+
+    if revalidating and proxy_response.status_code == 304:
+        assert cache_entry is not None
+        await proxy_response.aclose()
+        GlobalResponseCache.freshen(cache_entry, proxy_response.headers)
+        return add_links(
+            cached_response(
+                request, cache_entry, require_close, "REVALIDATED", rewrite, on_resource
+            ),
+            hint_links,
+        )
+
+    cache_status = "MISS" if cacheable(proxy_response) else "BYPASS"
+
     # 依据先前客户端的请求，决定是否要添加"connection": "close"头到响应头中以关闭连接
-    # https://www.uvicorn.org/server-behavior/#http-headers
-    # 如果响应头包含"connection": "close"，uvicorn会自动关闭连接
     proxy_response_headers = change_server_header(
         headers=proxy_response.headers, require_close=require_close
     )
+    proxy_response_headers["x-proxy-cache"] = cache_status
 
-    content = proxy_response.content
+    content = raw_stream
+    if rewrite:
+        # redirect may change the document url, join relative url with the final one
+        content = transform_web_content(
+            proxy_response_headers,
+            raw_stream,
+            str(proxy_response.url),
+            url_mapper,
+            on_resource,
+        )
 
-    # must dispose gzip content.
-    # because httpx will auto decompress gzip content.
-    content_encoding = proxy_response_headers.get("content-encoding", "")
-    if "gzip" in content_encoding:
-        content = gzip.compress(content)
-        # delete content-length header let starlette auto calculate
-        if "content-length" in proxy_response_headers:
-            del proxy_response_headers["content-length"]
+    response = encoded_response(
+        content,
+        proxy_response.status_code,
+        proxy_response_headers,
+        response_encoding(request, proxy_response_headers, proxy_response.status_code),
+        background=BackgroundTask(proxy_response.aclose),
+    )
+    return add_links(response, hint_links)
 
-    await proxy_response.aclose()
 
-    return Response(
-        content=content,
-        status_code=proxy_response.status_code,
-        headers=proxy_response_headers,
-    )
+async def proxy_stream_file(request: Request, target_url: str) -> Response:
+    """send request to target url
+
+    return the stream response, the body is forwarded untouched
+    """
+
+    async def handle() -> Response:
+        response = await _proxy_request(request, target_url, rewrite=False)
+        # large download can not take the whole egress from other requests,
+        # a cached file is paced as well as a streamed one
+        if GlobalBandwidthScheduler.enabled:
+            response = GlobalBandwidthScheduler.shape(
+                response,
+                ip=get_client_ip(request),
+                host=httpx.URL(target_url).host,
+            )
+        return response
+
+    return await _admitted(target_url, handle)
+
+
+async def proxy_web_content(request: Request, target_url: str) -> Response:
+    """send request to target url
+
+    return the stream response, the url in html document is rewritten
+    """
+
+    async def handle() -> Response:
+        response = await _proxy_request(request, target_url, rewrite=True)
+        return await transcode_image_response(request, target_url, response)
+
+    return await _admitted(target_url, handle)
+
+
+def get_proxy_stats() -> Dict[str, Any]:
+    """runtime counters of the webproxy"""
+    return {
+        "pools": GlobalHttpxClientRegistry.stats(),
+        "dns": GlobalDNSCache.stats(),
+        "breaker": GlobalCircuitBreaker.stats(),
+        "admission": GlobalAdmissionController.stats(),
+        "cache": GlobalResponseCache.stats(),
+        "encoded": GlobalEncodedCache.stats(),
+        "memory": GlobalMemoryBudget.stats(),
+        "images": GlobalImageTranscoder.stats(),
+        "chunks": GlobalChunkStore.stats(),
+        "segmented": GlobalSegmentedDownloader.stats(),
+        "single_flight": GlobalSingleFlight.stats(),
+        "redirects": GlobalRedirectResolver.stats(),
+        "bandwidth": GlobalBandwidthScheduler.stats(),
+        "preload": GlobalPreloadHints.stats(),
+        "prefetch": GlobalPrefetcher.stats(),
+    }
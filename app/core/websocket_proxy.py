@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   websocket_proxy.py
+@Time    :   2024/05/23 21:17:56
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   relay websocket frames between client and upstream
+"""
+
+import ssl
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import httpx
+from fastapi import WebSocket
+from loguru import logger
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+
+from app.config import settings
+from app.core.webproxy_func import change_client_header, proxy_target_params
+
+# optional dependency, `uvicorn[standard]` already install it
+try:
+    from websockets.exceptions import ConnectionClosed
+    from websockets.asyncio.client import connect as ws_connect
+
+    _WS_HEADERS_ARG = "additional_headers"
+except ImportError:  # pragma: no cover
+    try:
+        # websockets < 13
+        from websockets import connect as ws_connect  # type: ignore
+
+        _WS_HEADERS_ARG = "extra_headers"
+    except ImportError:
+        ws_connect = None  # type: ignore
+        _WS_HEADERS_ARG = ""
+        ConnectionClosed = Exception  # type: ignore
+
+# generated by the websocket client itself
+_HANDSHAKE_HEADERS = (
+    "host",
+    "upgrade",
+    "connection",
+    "keep-alive",
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+    "content-length",
+    "transfer-encoding",
+)
+
+# can be sent in a close frame, with 3000-4999 of the applications,
+# the others are reserved or only used locally (1005, 1006, 1015)
+_SENDABLE_CLOSE_CODES = frozenset(
+    (1000, 1001, 1002, 1003, 1007, 1008, 1009, 1010, 1011, 1012, 1013, 1014)
+)
+
+# same as httpx client `verify=False`
+_SSL_CONTEXT = ssl.create_default_context()
+_SSL_CONTEXT.check_hostname = False
+_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+
+def to_websocket_url(url: httpx.URL) -> httpx.URL:
+    """http -> ws, https -> wss"""
+    if url.scheme == "http":
+        return url.copy_with(scheme="ws")
+    if url.scheme == "https":
+        return url.copy_with(scheme="wss")
+    return url
+
+
+def forward_close_code(code: Optional[int], abnormal: int) -> int:
+    """the close code of one side to send to the other side
+
+    No status is a normal close, an abnormal close or a reserved code
+    is replaced by `abnormal`.
+    """
+    if code is None or code == 1005:
+        return 1000
+    if code in _SENDABLE_CLOSE_CODES or 3000 <= code <= 4999:
+        return code
+    return abnormal
+
+
+def _client_connected(websocket: WebSocket) -> bool:
+    return (
+        websocket.client_state == WebSocketState.CONNECTED
+        and websocket.application_state == WebSocketState.CONNECTED
+    )
+
+
+async def _client_to_upstream(websocket: WebSocket, upstream: Any) -> None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            # the client is gone away if the connection is dropped
+            await upstream.close(code=forward_close_code(message.get("code"), 1001))
+            return
+        if message.get("bytes") is not None:
+            await upstream.send(message["bytes"])
+        elif message.get("text") is not None:
+            await upstream.send(message["text"])
+
+
+async def _upstream_to_client(websocket: WebSocket, upstream: Any) -> None:
+    try:
+        async for message in upstream:
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_text(message)
+    except ConnectionClosed:
+        # closed with an error code, forward it as well
+        pass
+    if not _client_connected(websocket):
+        return
+    code = forward_close_code(upstream.close_code, 1011)
+    await websocket.close(code=code, reason=upstream.close_reason or None)
+
+
+async def proxy_websocket(websocket: WebSocket, target_url: str) -> None:
+    """Tunnel the websocket to target url.
+
+    Every direction await the send before the next receive, with the bounded
+    queue of websocket client, a slow side push back the other side.
+    """
+    if ws_connect is None:
+        await websocket.close(code=1011, reason="websockets is not installed")
+        return
+
+    url = to_websocket_url(
+        httpx.URL(target_url).copy_merge_params(
+            proxy_target_params(websocket.query_params)
+        )
+    )
+    _, proxy_header = change_client_header(headers=websocket.headers, target_url=url)
+    subprotocols: List[str] = [
+        p.strip()
+        for p in websocket.headers.get("sec-websocket-protocol", "").split(",")
+        if p.strip()
+    ]
+    headers = [
+        (k, v)
+        for k, v in proxy_header.items()
+        if k not in _HANDSHAKE_HEADERS and not (k == "cookie" and not v)
+    ]
+
+    kwargs: Dict[str, Any] = {
+        _WS_HEADERS_ARG: headers,
+        "subprotocols": subprotocols or None,
+        "max_size": settings.PROXY_WS_MAX_MESSAGE,
+        "max_queue": settings.PROXY_WS_MAX_QUEUE,
+        "open_timeout": settings.PROXY_TIMEOUT,
+    }
+    if url.scheme == "wss":
+        kwargs["ssl"] = _SSL_CONTEXT
+    if _WS_HEADERS_ARG == "additional_headers":
+        # user-agent is forwarded from the client
+        kwargs["user_agent_header"] = None
+
+    try:
+        upstream = await ws_connect(str(url), **kwargs)
+    except Exception as e:
+        logger.error(f"websocket connect {url} fail: {e}")
+        await websocket.close(code=1011)
+        return
+
+    try:
+        await websocket.accept(subprotocol=upstream.subprotocol)
+        tasks = [
+            asyncio.ensure_future(_client_to_upstream(websocket, upstream)),
+            asyncio.ensure_future(_upstream_to_client(websocket, upstream)),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            error = task.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                logger.warning(f"websocket relay {url} stop: {error!r}")
+                # nothing to close if the client is already gone
+                if _client_connected(websocket):
+                    await websocket.close(code=1011)
+    finally:
+        await upstream.close()
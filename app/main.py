@@ -7,6 +7,12 @@ from dotenv import load_dotenv
 
 from app.config import settings, APPPATH, ROOTPATH
 from app.core.ip_lookup import setup_qqwry
+from app.core.webproxy_func import (
+    GlobalHttpxClientRegistry,
+    GlobalChunkStore,
+    GlobalImageTranscoder,
+    GlobalResponseCache,
+)
 
 
 def init_env():
@@ -29,6 +35,10 @@ FastAPI CONIG:
     )
     yield
     # after app stop
+    await GlobalHttpxClientRegistry.aclose()
+    GlobalImageTranscoder.shutdown()
+    GlobalResponseCache.close()
+    GlobalChunkStore.close()
     logger.success("After app stop")
 
 
@@ -2,15 +2,83 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Request, FastAPI
 from starlette.background import BackgroundTask
-from fastapi.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 
 # external
 from app.core.func import get_client_ip
+from app.core.compression import CompressionMiddleware
+from app.core.webproxy_func import GlobalCompressionLevels
 from app.config import settings
 from app.routers.common.db import accessLog
+from app.routers.webproxy.router import file_proxy_app
 
 import time
+from typing import Dict, Optional
+
+
+def access_log_task(request: Request, status_code: int) -> Optional[BackgroundTask]:
+    """write the access log in background, None if it is not recorded"""
+    ip = get_client_ip(request)
+
+    # don't record 404 error
+    if status_code == 404:
+        return None
+
+    # don't record route path
+    if request.url.path in settings.NOT_RECORD_PATH:
+        return None
+
+    # don't record special ip
+    if ip in settings.NOT_RECORD_IP:
+        return None
+
+    return BackgroundTask(accessLog.newAccessLog, ip, request.url._url, status_code)
+
+
+class FastPathMiddleware(object):
+    """Send the exact paths to raw ASGI apps, before the other middlewares.
+
+    The hot routes skip the http middleware wrapper, CORS and compression
+    of the app, only the access log is kept. Preflight requests still go
+    through CORS.
+
+    NOTE: so their responses have no `X-Process-Time` header and are never
+    compressed by `CompressionMiddleware`, the raw app must set the CORS
+    headers itself.
+    """
+
+    def __init__(self, app: ASGIApp, routes: Dict[str, ASGIApp]) -> None:
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        route = None
+        if scope["type"] == "http" and scope["method"] != "OPTIONS":
+            path = scope["path"]
+            root_path = scope.get("root_path", "")
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path) :]
+            route = self.routes.get(path)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await route(scope, receive, send_with_status)
+        finally:
+            # the failed and cancelled requests are recorded too
+            task = access_log_task(Request(scope), status_code)
+            if task is not None:
+                await task()
 
 
 def register_middleware(app: FastAPI):
@@ -21,28 +89,11 @@ def register_middleware(app: FastAPI):
         process_time = time.time() - start_time
         response.headers["X-Process-Time"] = str(process_time)
 
-        ip = get_client_ip(request)
-
-        # don't record 404 error
-        if response.status_code == 404:
-            return response
-
-        # don't record route path
-        if request.url.path in settings.NOT_RECORD_PATH:
-            return response
-
-        # don't record special ip
-        if ip in settings.NOT_RECORD_IP:
-            return response
-
         # fastapi middleware run background task
         # https://stackoverflow.com/questions/72372029/fastapi-background-task-in-middleware
-        response.background = BackgroundTask(
-            accessLog.newAccessLog,
-            ip,
-            request.url._url,
-            response.status_code,
-        )
+        task = access_log_task(request, response.status_code)
+        if task is not None:
+            response.background = task
         return response
 
     app.add_middleware(
@@ -53,5 +104,14 @@ def register_middleware(app: FastAPI):
         allow_credentials=True,
     )
 
-    # https://fastapi.tiangolo.com/advanced/middleware/#gzipmiddleware
-    app.add_middleware(GZipMiddleware, minimum_size=200)
+    # br/zstd/gzip by accept-encoding, the webproxy responses are already compressed
+    if settings.COMPRESSION:
+        app.add_middleware(
+            CompressionMiddleware,
+            minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+            levels=GlobalCompressionLevels,
+        )
+
+    # the last added is the outermost
+    if settings.FAST_FILE_ROUTE:
+        app.add_middleware(FastPathMiddleware, routes={"/file/": file_proxy_app})
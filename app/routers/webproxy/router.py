@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Request, Response, Query
+from fastapi import APIRouter, Request, Response, Query, WebSocket
 from loguru import logger
+from starlette.types import Receive, Scope, Send
+from typing import Any, Dict, Optional
 from typing_extensions import Annotated
 
+from app.config import settings
+from app.core.schema import BaseResp
 from app.core.webproxy_func import (
+    get_proxy_stats,
     is_valid_domain,
     proxy_stream_file,
     proxy_web_content,
 )
+from app.core.websocket_proxy import proxy_websocket
 
 
 router = APIRouter()
@@ -28,6 +34,36 @@ async def largeFileProxy(
     return await proxy_stream_file(request, url)
 
 
+async def file_proxy_app(scope: Scope, receive: Receive, send: Send) -> None:
+    """raw ASGI app of /file/, no FastAPI routing, validation and middlewares
+
+    Dispatched by `FastPathMiddleware`, `largeFileProxy` is the same route
+    when it is disabled.
+    """
+    request = Request(scope, receive, send)
+    url = request.query_params.get("url")
+    if request.method not in ("GET", "POST"):
+        response = Response(
+            content="Method Not Allowed",
+            status_code=405,
+            headers={"allow": "GET, POST"},
+        )
+    elif not url or not is_valid_domain(url):
+        logger.error(f"Invalid URL {url}")
+        response = Response(content=f"Error: Invalid URL {url}", status_code=400)
+    else:
+        response = await proxy_stream_file(request, url)
+
+    # same as CORSMiddleware allow every origin with credentials,
+    # the response depend on the origin even without it
+    origin = request.headers.get("origin")
+    if origin is not None:
+        response.headers["access-control-allow-origin"] = origin
+        response.headers["access-control-allow-credentials"] = "true"
+    response.headers.add_vary_header("Origin")
+    await response(scope, receive, send)
+
+
 @router.post(path="/proxy/")
 @router.get(path="/proxy/")
 async def webProxy(
@@ -41,3 +77,30 @@ async def webProxy(
         )
 
     return await proxy_web_content(request, url)
+
+
+@router.websocket(path="/ws/")
+async def webSocketProxy(
+    websocket: WebSocket,
+    url: Annotated[str, Query(title="URL", description="URL address")],
+):
+    # http(s) is mapped to ws(s)
+    if not (is_valid_domain(url) or url.startswith(("ws://", "wss://"))):
+        logger.error(f"Invalid URL {url}")
+        await websocket.close(code=1008, reason=f"Invalid URL {url}")
+        return
+
+    await proxy_websocket(websocket, url)
+
+
+@router.get(path="/proxy/stats/")
+async def webProxyStats(
+    key: Annotated[str, Query(title="password", description="proxy stats password")],
+) -> BaseResp[Optional[Dict[str, Any]]]:
+    """connection pool, cache and coalescing counters
+
+    upstream hosts and their addresses are exposed, password is required
+    """
+    if key == settings.PASSWORD:
+        return BaseResp[Optional[Dict[str, Any]]](msg="success", data=get_proxy_stats())
+    return BaseResp[Optional[Dict[str, Any]]](code=0, msg="password error", data=None)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   bench_file_route.py
+@Time    :   2024/06/02 16:12:53
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   per request overhead of /file/, FastAPI route vs raw ASGI app
+
+The apps are called in process with a minimal ASGI server, the upstream is
+`benchmarks.upstream` in a subprocess, so the difference is the routing,
+validation and middleware cost.
+
+Usage: python -m benchmarks.bench_file_route [-n 3000] [--size 16]
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List
+
+from starlette.types import ASGIApp, Message
+
+from benchmarks.bench_proxy import free_port, percentile, start_server
+from benchmarks.proxy_app import app as fast_app
+from benchmarks.proxy_app import route_app
+
+
+async def call(app: ASGIApp, query_string: bytes) -> int:
+    """one GET /file/, return the status"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/file/",
+        "raw_path": b"/file/",
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [(b"host", b"bench"), (b"accept-encoding", b"gzip, br")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+        "extensions": {},
+    }
+    done = asyncio.Event()
+    request_sent = False
+    status = 0
+
+    async def receive() -> Message:
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Message) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif not message.get("more_body", False):
+            done.set()
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run(app: ASGIApp, query_string: bytes, number: int) -> Dict[str, Any]:
+    for _ in range(min(200, number)):
+        await call(app, query_string)
+    latencies: List[float] = []
+    for _ in range(number):
+        start = time.perf_counter()
+        status = await call(app, query_string)
+        latencies.append(time.perf_counter() - start)
+        assert status == 200, status
+    latencies.sort()
+    return {
+        "mean_us": sum(latencies) / number * 1e6,
+        "p50_us": percentile(latencies, 50) * 1e6,
+        "p99_us": percentile(latencies, 99) * 1e6,
+    }
+
+
+async def bench(upstream: str, number: int, size: int) -> None:
+    query_string = f"url={upstream}/static/{size}".encode()
+    # interleave the rounds, the upstream and the pool are equally warm
+    results: Dict[str, List[Dict[str, Any]]] = {"route": [], "raw asgi": []}
+    for _ in range(3):
+        results["route"].append(await run(route_app, query_string, number))
+        results["raw asgi"].append(await run(fast_app, query_string, number))
+
+    best = {}
+    for name, rounds in results.items():
+        best[name] = min(rounds, key=lambda r: r["mean_us"])
+        print(
+            f"{name:<9} mean {best[name]['mean_us']:8.1f} us"
+            f"  p50 {best[name]['p50_us']:8.1f} us  p99 {best[name]['p99_us']:8.1f} us"
+        )
+    saved = best["route"]["mean_us"] - best["raw asgi"]["mean_us"]
+    print(f"saved     {saved:8.1f} us/request")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=3000)
+    parser.add_argument("--size", type=int, default=16, help="upstream body size")
+    args = parser.parse_args()
+
+    port = free_port()
+    upstream_process = start_server("benchmarks.upstream:app", port)
+    try:
+        asyncio.run(bench(f"http://127.0.0.1:{port}", args.number, args.size))
+    finally:
+        upstream_process.terminate()
+        upstream_process.wait(10)
+
+
+if __name__ == "__main__":
+    main()
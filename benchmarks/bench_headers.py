@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   bench_headers.py
+@Time    :   2024/05/24 20:31:05
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   per request overhead of the proxy header transform, before and after
+
+Usage: python -m benchmarks.bench_headers [-n 20000]
+"""
+
+import argparse
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx
+from starlette.datastructures import Headers as StarletteHeaders
+
+from app.core.webproxy_func import change_client_header, change_server_header
+
+# a typical browser request and upstream response
+CLIENT_RAW = [
+    (b"host", b"proxy.example.com"),
+    (b"connection", b"keep-alive"),
+    (b"sec-ch-ua", b'"Chromium";v="124", "Google Chrome";v="124"'),
+    (b"sec-ch-ua-mobile", b"?0"),
+    (b"user-agent", b"Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/124.0"),
+    (b"accept", b"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"),
+    (b"sec-fetch-site", b"none"),
+    (b"sec-fetch-mode", b"navigate"),
+    (b"sec-fetch-dest", b"document"),
+    (b"accept-encoding", b"gzip, deflate, br, zstd"),
+    (b"accept-language", b"zh-CN,zh;q=0.9,en;q=0.8"),
+    (b"cookie", b"a=1; b=2"),
+]
+SERVER_RAW = [
+    (b"Date", b"Fri, 24 May 2024 12:00:00 GMT"),
+    (b"Content-Type", b"text/html; charset=utf-8"),
+    (b"Transfer-Encoding", b"chunked"),
+    (b"Connection", b"keep-alive"),
+    (b"Keep-Alive", b"timeout=5"),
+    (b"Cache-Control", b"private, max-age=0"),
+    (b"Set-Cookie", b"sid=1; Path=/"),
+    (b"Set-Cookie", b"lang=zh; Path=/"),
+    (b"Vary", b"Accept-Encoding"),
+    (b"Content-Encoding", b"gzip"),
+    (b"Server", b"nginx"),
+]
+TARGET_URL = httpx.URL("https://www.example.com/index.html")
+
+
+def legacy_change_client_header(headers: StarletteHeaders, target_url: httpx.URL):
+    """the str based implementation before the raw header fast path"""
+    new_headers = headers.mutablecopy()
+    new_headers["host"] = target_url.netloc.decode("ascii")
+    if "Cookie" not in new_headers:
+        new_headers["Cookie"] = ""
+    tokens = [v.strip() for v in new_headers.get("connection", "").lower().split(",")]
+    require_close = "close" in tokens
+    if require_close:
+        tokens.remove("close")
+    if "keep-alive" not in tokens:
+        tokens.insert(0, "keep-alive")
+    new_headers["connection"] = ",".join(tokens)
+    if "keep-alive" in new_headers:
+        del new_headers["keep-alive"]
+    return require_close, new_headers
+
+
+def legacy_change_server_header(headers: httpx.Headers, require_close: bool):
+    tokens: List[str] = [
+        v.strip() for v in headers.get("connection", "").lower().split(",")
+    ]
+    if require_close:
+        if "close" not in tokens:
+            tokens.insert(0, "close")
+    elif "close" in tokens:
+        tokens.remove("close")
+    if tokens:
+        headers["connection"] = ",".join(tokens)
+    elif "connection" in headers:
+        del headers["connection"]
+    if "keep-alive" in headers:
+        del headers["keep-alive"]
+    return headers
+
+
+def legacy_request() -> None:
+    """request headers to httpx, response headers to starlette"""
+    _, proxy_header = legacy_change_client_header(
+        StarletteHeaders(raw=CLIENT_RAW), TARGET_URL
+    )
+    httpx.Headers(proxy_header)
+    response_headers = legacy_change_server_header(
+        httpx.Headers(SERVER_RAW), require_close=False
+    )
+    [
+        (k.lower().encode("latin-1"), v.encode("latin-1"))
+        for k, v in response_headers.items()
+    ]
+
+
+def raw_request() -> None:
+    _, proxy_header = change_client_header(
+        headers=StarletteHeaders(raw=CLIENT_RAW), target_url=TARGET_URL
+    )
+    httpx.Headers(proxy_header.raw)
+    response_headers = change_server_header(
+        headers=httpx.Headers(SERVER_RAW), require_close=False
+    )
+    response_headers.raw
+
+
+def bench(name: str, func: Callable[[], None], number: int) -> float:
+    # best of several runs, less noise from the other processes
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<8} {best * 1e6:8.2f} us/request")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    before = bench("before", legacy_request, args.number)
+    after = bench("after", raw_request, args.number)
+    print(f"speedup  {before / after:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   bench_proxy.py
+@Time    :   2024/05/28 21:03:58
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   load test of /file/ and /proxy/ against a local upstream
+
+Start the stand-in upstream and the proxy in uvicorn subprocesses, send
+every scenario at a fixed concurrency, and write requests/s, latency
+percentiles, bytes/s and the proxy RSS to a json file.
+
+    python -m benchmarks.bench_proxy -o result.json
+    python -m benchmarks.bench_proxy -s file_1m,proxy_html -c 32
+    # exit 1 if a scenario is slower than the baseline
+    python -m benchmarks.bench_proxy --compare baseline.json --threshold 0.15
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import httpx
+
+ROOTPATH = Path(__file__).resolve().parent.parent
+
+
+class Scenario(NamedTuple):
+    name: str
+    # proxy route and upstream path
+    route: str
+    upstream_path: str
+    requests: int
+    concurrency: Optional[int] = None
+    headers: Optional[Dict[str, str]] = None
+
+
+SCENARIOS: List[Scenario] = [
+    Scenario("file_1k", "/file/", "/static/1024", 4000),
+    Scenario("file_1m", "/file/", "/static/1048576", 400),
+    Scenario("file_10m", "/file/", "/static/10485760", 40, concurrency=8),
+    Scenario("file_chunked_1m", "/file/", "/chunked/1048576", 400),
+    Scenario(
+        "file_gzip_256k",
+        "/file/",
+        "/gzip/262144",
+        1000,
+        headers={"accept-encoding": "gzip"},
+    ),
+    Scenario(
+        "proxy_html",
+        "/proxy/",
+        "/page",
+        1000,
+        headers={"accept-encoding": "gzip", "accept": "text/html"},
+    ),
+    Scenario("proxy_cached_16k", "/proxy/", "/static/16384?cache=1", 4000),
+    Scenario("proxy_slow_100ms", "/proxy/", "/slow/100", 1000, concurrency=100),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app: str, port: int, env: Optional[Dict[str, str]] = None) -> Any:
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            app,
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        cwd=ROOTPATH,
+        env={**os.environ, **(env or {})},
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{app} exit with {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{app} not started in 30s")
+
+
+def read_rss(pid: int) -> Dict[str, Optional[int]]:
+    """current and peak resident memory in KiB, linux only without psutil"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {
+            "rss_kb": int(fields["VmRSS"].split()[0]),
+            "rss_peak_kb": int(fields["VmHWM"].split()[0]),
+        }
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+
+        rss = psutil.Process(pid).memory_info().rss // 1024
+        return {"rss_kb": rss, "rss_peak_kb": None}
+    except Exception:
+        return {"rss_kb": None, "rss_peak_kb": None}
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """nearest rank"""
+    if not values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+async def run_scenario(
+    scenario: Scenario, proxy: str, upstream: str, concurrency: int, warmup: int
+) -> Dict[str, Any]:
+    url = f"{proxy}{scenario.route}"
+    params = {"url": f"{upstream}{scenario.upstream_path}"}
+    headers = scenario.headers or {"accept-encoding": "identity"}
+    latencies: List[float] = []
+    errors = 0
+    received = 0
+    next_index = 0
+
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+
+        async def one() -> None:
+            nonlocal errors, received
+            start = time.perf_counter()
+            try:
+                async with client.stream(
+                    "GET", url, params=params, headers=headers
+                ) as response:
+                    size = 0
+                    async for chunk in response.aiter_raw():
+                        size += len(chunk)
+                    if response.status_code >= 400:
+                        errors += 1
+                        return
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+            received += size
+
+        async def worker(total: int) -> None:
+            nonlocal next_index
+            while next_index < total:
+                next_index += 1
+                await one()
+
+        # connections and caches are warm before measuring
+        await asyncio.gather(*(worker(warmup) for _ in range(concurrency)))
+        latencies.clear()
+        errors = received = next_index = 0
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(scenario.requests) for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    latencies.sort()
+    done = len(latencies)
+    return {
+        "name": scenario.name,
+        "concurrency": concurrency,
+        "requests": done,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "rps": round(done / duration, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round((latencies[-1] if latencies else 0) * 1000, 3),
+        "bytes": received,
+        "bytes_per_s": round(received / duration),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOTPATH, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def compare(result: Dict[str, Any], baseline_path: str, threshold: float) -> List[str]:
+    """scenarios whose rps drop or p99 grow more than `threshold`"""
+    with open(baseline_path) as f:
+        baseline = {s["name"]: s for s in json.load(f)["scenarios"]}
+    regressions = []
+    for current in result["scenarios"]:
+        base = baseline.get(current["name"])
+        if base is None:
+            continue
+        if current["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(
+                f"{current['name']}: rps {base['rps']} -> {current['rps']}"
+            )
+        if current["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append(
+                f"{current['name']}: p99 {base['p99_ms']}ms -> {current['p99_ms']}ms"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-s", "--scenarios", help="comma separated names, default all")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument(
+        "-n", "--scale", type=float, default=1.0, help="multiply the request counts"
+    )
+    parser.add_argument("-o", "--output", default="bench_proxy.json")
+    parser.add_argument(
+        "--app", default="benchmarks.proxy_app:app", help="proxy ASGI app for uvicorn"
+    )
+    parser.add_argument("--compare", help="baseline json of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        names = set(args.scenarios.split(","))
+        scenarios = [s for s in SCENARIOS if s.name in names]
+        unknown = names - {s.name for s in scenarios}
+        if unknown:
+            parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    upstream_port, proxy_port = free_port(), free_port()
+    upstream_process = start_server("benchmarks.upstream:app", upstream_port)
+    proxy_process = start_server(args.app, proxy_port)
+    upstream = f"http://127.0.0.1:{upstream_port}"
+    proxy = f"http://127.0.0.1:{proxy_port}"
+
+    results: List[Dict[str, Any]] = []
+    try:
+        for scenario in scenarios:
+            requests = max(1, int(scenario.requests * args.scale))
+            concurrency = scenario.concurrency or args.concurrency
+            item = asyncio.run(
+                run_scenario(
+                    scenario._replace(requests=requests),
+                    proxy,
+                    upstream,
+                    concurrency,
+                    warmup=min(requests, concurrency * 2),
+                )
+            )
+            item.update(read_rss(proxy_process.pid))
+            results.append(item)
+            print(
+                f"{item['name']:<18} {item['rps']:>9.1f} req/s"
+                f"  p50 {item['p50_ms']:>8.2f}ms  p99 {item['p99_ms']:>8.2f}ms"
+                f"  {item['bytes_per_s'] / 1024 / 1024:>8.1f} MiB/s"
+                f"  rss {item['rss_kb']}KiB  errors {item['errors']}"
+            )
+    finally:
+        for process in (proxy_process, upstream_process):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    result = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "app": args.app,
+            "scale": args.scale,
+        },
+        "scenarios": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"result is written to {args.output}")
+
+    if args.compare:
+        regressions = compare(result, args.compare, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   proxy_app.py
+@Time    :   2024/05/28 20:40:02
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   the webproxy router with the middleware of app.main, without mongodb
+
+`app.main:app` write the access log to mongodb and update the ip database
+at startup, which is not part of the proxy cost. The proxy routes are put
+in `NOT_RECORD_PATH` here, the middlewares are the same.
+
+- `app`        /file/ served by the raw ASGI app (default)
+- `route_app`  /file/ served by the FastAPI route
+"""
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import FastAPI
+
+# NOTE: import app.main first, the routers import it back
+import app.main as _main  # noqa: F401
+from app.config import settings
+from app.core.webproxy_func import GlobalHttpxClientRegistry
+from app.register.middleware import register_middleware
+from app.routers.webproxy.router import router
+
+settings.NOT_RECORD_PATH = [*settings.NOT_RECORD_PATH, "/file/", "/proxy/"]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    yield
+    await GlobalHttpxClientRegistry.aclose()
+
+
+def create_app(fast_file_route: bool = True) -> FastAPI:
+    # read by `register_middleware`
+    settings.FAST_FILE_ROUTE = fast_file_route
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    register_middleware(app)
+    return app
+
+
+route_app = create_app(fast_file_route=False)
+app = create_app()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   upstream.py
+@Time    :   2024/05/28 20:11:36
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   local stand-in upstream of the benchmark, deterministic bodies
+
+uvicorn benchmarks.upstream:app --port 18080
+
+- /static/{size}   fixed bytes with content-length, `?cache=1` make it cacheable
+- /chunked/{size}  same bytes, chunked transfer-encoding
+- /gzip/{size}     gzip encoded json, `size` is the decoded size
+- /page            gzip encoded html document with many links
+- /slow/{ms}       small body after `ms` milliseconds
+"""
+
+import asyncio
+import gzip
+import random
+from functools import lru_cache
+from typing import AsyncIterator, Dict
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+_CHUNK_SIZE = 64 * 1024
+_NO_STORE = {"cache-control": "no-store"}
+
+
+@lru_cache(maxsize=32)
+def payload(size: int) -> bytes:
+    """the same bytes for the same size in every run"""
+    return random.Random(size).randbytes(size)
+
+
+@lru_cache(maxsize=32)
+def gzip_json(size: int) -> bytes:
+    rng = random.Random(size)
+    item = b'{"id":%d,"name":"item","tags":["a","b"]},'
+    body = bytearray(b"[")
+    while len(body) < size:
+        body += item % rng.randrange(1 << 30)
+    return gzip.compress(bytes(body[:size]), compresslevel=6, mtime=0)
+
+
+@lru_cache(maxsize=1)
+def gzip_page() -> bytes:
+    rows = []
+    for i in range(400):
+        rows.append(
+            f'<li><a href="/article/{i}?ref=list&amp;p=1">article {i}</a>'
+            f'<img src="img/{i}.png" srcset="img/{i}.png 1x, img/{i}@2x.png 2x"></li>'
+        )
+    html = (
+        '<!DOCTYPE html><html><head><link rel="stylesheet" href="/static/site.css">'
+        '<script src="https://cdn.example.com/app.js"></script>'
+        "<style>body{background:url(bg.png)}</style></head><body><ul>"
+        + "".join(rows)
+        + "</ul></body></html>"
+    )
+    return gzip.compress(html.encode(), compresslevel=6, mtime=0)
+
+
+async def static(request: Request) -> Response:
+    size = request.path_params["size"]
+    headers: Dict[str, str] = dict(_NO_STORE)
+    if request.query_params.get("cache"):
+        headers = {"cache-control": "max-age=3600", "etag": f'"{size}"'}
+    return Response(
+        payload(size), media_type="application/octet-stream", headers=headers
+    )
+
+
+async def chunked(request: Request) -> Response:
+    body = payload(request.path_params["size"])
+
+    async def iterate() -> AsyncIterator[bytes]:
+        for i in range(0, len(body), _CHUNK_SIZE):
+            yield body[i : i + _CHUNK_SIZE]
+
+    return StreamingResponse(
+        iterate(), media_type="application/octet-stream", headers=_NO_STORE
+    )
+
+
+async def gzip_body(request: Request) -> Response:
+    headers = {"content-encoding": "gzip", **_NO_STORE}
+    return Response(
+        gzip_json(request.path_params["size"]),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+async def page(request: Request) -> Response:
+    headers = {"content-encoding": "gzip", **_NO_STORE}
+    return Response(gzip_page(), media_type="text/html", headers=headers)
+
+
+async def slow(request: Request) -> Response:
+    await asyncio.sleep(request.path_params["ms"] / 1000)
+    return Response(b"slow", media_type="text/plain", headers=_NO_STORE)
+
+
+app = Starlette(
+    routes=[
+        Route("/static/{size:int}", static),
+        Route("/chunked/{size:int}", chunked),
+        Route("/gzip/{size:int}", gzip_body),
+        Route("/page", page),
+        Route("/slow/{ms:int}", slow),
+    ]
+)
@@ -0,0 +1,105 @@
+import inspect
+from typing import Awaitable, Callable, List, Union
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+import app.main  # noqa: F401, the routers import the app, as uvicorn load it
+from app.config import settings
+from app.core import webproxy_func
+from app.core.admission import AdmissionController
+from app.core.circuit_breaker import CircuitBreaker
+from app.core.early_hints import PreloadHints, Prefetcher
+from app.core.proxy_cache import ResponseCache
+from app.core.range_cache import ChunkStore
+from app.core.redirect_cache import RedirectResolver
+from app.core.singleflight import SingleFlight
+from app.routers.webproxy.router import router
+
+Handler = Callable[[httpx.Request], Union[httpx.Response, Awaitable[httpx.Response]]]
+
+
+@pytest.fixture
+def anyio_backend():
+    # the proxy run on uvicorn, asyncio only
+    return "asyncio"
+
+
+@pytest.fixture
+def webproxy_app() -> FastAPI:
+    """the webproxy routes only, without the middlewares"""
+    webproxy_app = FastAPI()
+    webproxy_app.include_router(router)
+    return webproxy_app
+
+
+class MockUpstream(object):
+    """Upstream answered in process by `handler`, the proxy requests are kept.
+
+    The body of the response is streamed as a real upstream one.
+    """
+
+    def __init__(self) -> None:
+        self.handler: Handler = lambda request: httpx.Response(404)
+        self.requests: List[httpx.Request] = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        response = self.handler(request)
+        if inspect.isawaitable(response):
+            response = await response
+        body = await response.aread()
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=httpx.ByteStream(body),
+        )
+
+
+class _MockClientRegistry(webproxy_func.HttpxClientRegistry):
+    def __init__(self, upstream: MockUpstream) -> None:
+        super().__init__(http2=False)
+        self.transport = httpx.MockTransport(upstream.handle)
+
+    def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            transport=self.transport,
+            cookies=webproxy_func._NullCookieJar(),
+            timeout=self.timeout,
+        )
+
+
+@pytest.fixture
+def upstream(monkeypatch, tmp_path) -> MockUpstream:
+    """fresh proxy state, every upstream request is answered by the mock"""
+    mock = MockUpstream()
+    fresh = {
+        "GlobalHttpxClientRegistry": _MockClientRegistry(mock),
+        "GlobalResponseCache": ResponseCache(
+            directory=str(tmp_path),
+            stale_while_revalidate=settings.PROXY_STALE_WHILE_REVALIDATE,
+            stale_if_error=settings.PROXY_STALE_IF_ERROR,
+            memory_budget=webproxy_func.GlobalMemoryBudget,
+        ),
+        "GlobalChunkStore": ChunkStore(
+            block_size=settings.PROXY_RANGE_BLOCK_SIZE, directory=str(tmp_path)
+        ),
+        "GlobalSingleFlight": SingleFlight(
+            memory_budget=webproxy_func.GlobalMemoryBudget
+        ),
+        "GlobalCircuitBreaker": CircuitBreaker(
+            failure_threshold=settings.PROXY_BREAKER_FAILURES,
+            recovery_time=settings.PROXY_BREAKER_RECOVERY,
+        ),
+        "GlobalAdmissionController": AdmissionController(),
+        "GlobalRedirectResolver": RedirectResolver(),
+        "GlobalPreloadHints": PreloadHints(),
+        "GlobalPrefetcher": Prefetcher(),
+        "GlobalRevalidator": Prefetcher(),
+    }
+    for name, value in fresh.items():
+        monkeypatch.setattr(webproxy_func, name, value)
+    yield mock
+    fresh["GlobalResponseCache"].close()
+    fresh["GlobalChunkStore"].close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_admission.py
+@Time    :   2024/06/15 19:05:27
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   admission queue of the proxy requests, shed with 503
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.core import webproxy_func
+from app.core.admission import AdmissionController, AdmissionRejected
+
+
+async def settle() -> None:
+    # the waiter task take a few loop iterations to wake
+    await asyncio.sleep(0.01)
+
+
+async def queued(controller: AdmissionController, host: str) -> "asyncio.Task":
+    task = asyncio.ensure_future(controller.acquire(host))
+    await settle()
+    return task
+
+
+@pytest.mark.anyio
+async def test_waiters_are_admitted_in_order_per_host():
+    controller = AdmissionController(max_active=2, max_active_per_host=1)
+    release_a = await controller.acquire("a")
+    release_b = await controller.acquire("b")
+    second_a = await queued(controller, "a")
+    first_c = await queued(controller, "c")
+    second_c = await queued(controller, "c")
+    assert controller.stats()["queued"] == 3
+
+    # host `a` is still busy, its waiter does not block `c`
+    release_b()
+    await settle()
+    assert first_c.done() and not second_a.done() and not second_c.done()
+
+    release_a()
+    await settle()
+    assert second_a.done() and not second_c.done()
+    # released once only
+    release_a()
+    assert controller.stats()["active"] == 2
+
+    (await first_c)()
+    await settle()
+    assert second_c.done()
+    stats = controller.stats()
+    assert stats["hosts"] == {"a": 1, "c": 1}
+    assert (stats["admitted"], stats["waited"], stats["max_queue_depth"]) == (5, 3, 3)
+
+
+@pytest.mark.anyio
+async def test_shed_when_queue_is_full():
+    controller = AdmissionController(max_active=1, max_queue=1, queue_timeout=7)
+    await controller.acquire("a")
+    await queued(controller, "a")
+    with pytest.raises(AdmissionRejected) as info:
+        await controller.acquire("b")
+    assert info.value.retry_after == 7
+    assert controller.stats()["shed_full"] == 1
+
+
+@pytest.mark.anyio
+async def test_shed_after_queue_timeout():
+    controller = AdmissionController(max_active=1, queue_timeout=0.01)
+    await controller.acquire("a")
+    with pytest.raises(AdmissionRejected, match="waited"):
+        await controller.acquire("a")
+    stats = controller.stats()
+    assert (stats["shed_timeout"], stats["queued"]) == (1, 0)
+
+
+@pytest.mark.anyio
+async def test_cancelled_waiter_give_back_its_slot():
+    controller = AdmissionController(max_active=1)
+    release = await controller.acquire("a")
+    waiter = await queued(controller, "a")
+    waiter.cancel()
+    await settle()
+    assert controller.stats()["queued"] == 0
+
+    # cancelled after the slot was handed to it
+    waiter = await queued(controller, "a")
+    release()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert controller.stats()["active"] == 0
+    (await controller.acquire("a"))()
+
+
+@pytest.mark.anyio
+async def test_overloaded_proxy_answer_503(webproxy_app, upstream, monkeypatch):
+    controller = AdmissionController(max_active=1, max_queue=0, queue_timeout=2.5)
+    monkeypatch.setattr(webproxy_func, "GlobalAdmissionController", controller)
+    upstream.handler = lambda request: httpx.Response(200, content=b"hello")
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": "http://upstream.test/a"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        release = await controller.acquire("http://other.test")
+        response = await client.get("/file/", params=params)
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "3"
+        assert upstream.requests == []
+
+        release()
+        response = await client.get("/file/", params=params)
+        assert response.text == "hello"
+    # the slot is held until the response is sent
+    stats = controller.stats()
+    assert (stats["active"], stats["admitted"], stats["shed_full"]) == (0, 2, 1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_bandwidth.py
+@Time    :   2024/06/13 20:26:41
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   every kind of /file/ response is paced by the shaper
+"""
+
+import time
+from typing import Any, Dict, List
+
+import anyio
+import pytest
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response, StreamingResponse
+
+from app.core.bandwidth import BandwidthScheduler
+from app.core.file_response import FileSliceResponse
+
+RATE = 1024 * 1024
+SIZE = 512 * 1024
+
+
+def make_scope() -> Dict[str, Any]:
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": "/file/",
+        "headers": [],
+        "extensions": {"http.response.zerocopysend": {}},
+    }
+
+
+async def run(response: Response) -> List[Dict[str, Any]]:
+    messages: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        # the client stay connected
+        await anyio.sleep_forever()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        messages.append(message)
+
+    await response(make_scope(), receive, send)
+    return messages
+
+
+def in_memory(path) -> Response:
+    return Response(content=b"x" * SIZE)
+
+
+def streamed(path) -> Response:
+    async def stream():
+        for _ in range(4):
+            yield b"x" * (SIZE // 4)
+
+    return StreamingResponse(stream())
+
+
+def file_slice(path) -> Response:
+    path.write_bytes(b"x" * SIZE)
+    return FileSliceResponse(open(path, "rb"), 0, SIZE, 200, MutableHeaders())
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("build", [in_memory, streamed, file_slice])
+async def test_every_response_is_paced(tmp_path, build):
+    scheduler = BandwidthScheduler(per_ip_rate=RATE)
+    response = scheduler.shape(build(tmp_path / "body"), ip="1.2.3.4", host="a.test")
+
+    started = time.monotonic()
+    messages = await run(response)
+    elapsed = time.monotonic() - started
+
+    bodies = [m for m in messages if m["type"] == "http.response.body"]
+    assert all(m["type"] != "http.response.zerocopysend" for m in messages)
+    assert sum(len(m.get("body", b"")) for m in bodies) == SIZE
+    assert not bodies[-1].get("more_body", False)
+    # the burst is a quarter of a second of rate, the rest wait for tokens
+    assert elapsed >= (SIZE - RATE * 0.25) / RATE * 0.8
+    stats = scheduler.stats()
+    assert stats["total_bytes"] == SIZE and stats["active_flows"] == 0
+
+
+@pytest.mark.anyio
+async def test_headers_are_shared_with_the_wrapped_response():
+    scheduler = BandwidthScheduler(per_ip_rate=RATE)
+    inner = Response(content=b"x")
+    response = scheduler.shape(inner, ip="1.2.3.4", host="a.test")
+    response.headers["access-control-allow-origin"] = "*"
+    assert inner.headers["access-control-allow-origin"] == "*"
+    assert response.status_code == inner.status_code
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_circuit_breaker.py
+@Time    :   2024/06/15 10:24:51
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   circuit states of upstream hosts, fail fast and hedged requests
+"""
+
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+import httpx
+import pytest
+
+from app.core import circuit_breaker, webproxy_func
+from app.core.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    UpstreamUnavailable,
+)
+
+HOST = "http://upstream.test"
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    # not the `time` module itself, the event loop use it
+    monkeypatch.setattr(circuit_breaker, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def answer(status_code: int):
+    async def send() -> httpx.Response:
+        return httpx.Response(status_code)
+
+    return send
+
+
+async def refused() -> httpx.Response:
+    raise httpx.ConnectError("refused")
+
+
+def state(breaker: CircuitBreaker) -> str:
+    return breaker._hosts[HOST].state
+
+
+@pytest.mark.anyio
+async def test_circuit_states(clock):
+    breaker = CircuitBreaker(failure_threshold=3, recovery_time=30)
+    await breaker.call(HOST, answer(503))
+    await breaker.call(HOST, answer(200))
+    # only consecutive failures count
+    await breaker.call(HOST, answer(502))
+    with pytest.raises(httpx.ConnectError):
+        await breaker.call(HOST, refused)
+    assert state(breaker) == CLOSED
+    await breaker.call(HOST, answer(500))
+    assert state(breaker) == OPEN
+
+    # fail fast, upstream is not touched
+    sent: List[str] = []
+
+    async def send() -> httpx.Response:
+        sent.append("sent")
+        return httpx.Response(200)
+
+    clock.now += 10
+    with pytest.raises(UpstreamUnavailable) as info:
+        await breaker.call(HOST, send)
+    assert info.value.retry_after == 20
+    assert sent == []
+
+    # one probe in half open, concurrent requests are rejected
+    clock.now += 20
+    release = asyncio.Event()
+
+    async def slow() -> httpx.Response:
+        await release.wait()
+        return httpx.Response(200)
+
+    probe = asyncio.ensure_future(breaker.call(HOST, slow))
+    await asyncio.sleep(0)
+    assert state(breaker) == HALF_OPEN
+    with pytest.raises(UpstreamUnavailable):
+        await breaker.call(HOST, send)
+    release.set()
+    assert (await probe).status_code == 200
+    assert state(breaker) == CLOSED
+    assert (await breaker.call(HOST, send)).status_code == 200
+    assert breaker.stats()["rejected"] == 2
+
+
+@pytest.mark.anyio
+async def test_failed_probe_open_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=30)
+    await breaker.call(HOST, answer(504))
+    clock.now += 30
+    with pytest.raises(httpx.ConnectError):
+        await breaker.call(HOST, refused)
+    assert state(breaker) == OPEN
+    with pytest.raises(UpstreamUnavailable):
+        await breaker.call(HOST, answer(200))
+    assert breaker.stats()["hosts"] == {HOST: OPEN}
+
+
+@pytest.mark.anyio
+async def test_cancelled_probe_is_released(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=30)
+    await breaker.call(HOST, answer(500))
+    clock.now += 30
+    probe = asyncio.ensure_future(breaker.call(HOST, asyncio.Event().wait))
+    await asyncio.sleep(0)
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    # nothing is learnt, the next request is the probe
+    assert (await breaker.call(HOST, answer(200))).status_code == 200
+    assert state(breaker) == CLOSED
+
+
+@pytest.mark.anyio
+async def test_open_circuit_fail_fast_with_503(webproxy_app, upstream):
+    upstream.handler = lambda request: httpx.Response(502)
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": "http://upstream.test/down"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        threshold = webproxy_func.GlobalCircuitBreaker.failure_threshold
+        for _ in range(threshold):
+            response = await client.post("/file/", params=params, content=b"x")
+            assert response.status_code == 502
+        response = await client.post("/file/", params=params, content=b"x")
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) > 0
+    assert len(upstream.requests) == threshold
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    def __init__(self) -> None:
+        self.closed = False
+
+    async def __aiter__(self):
+        yield b""
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+async def warm_up(breaker: CircuitBreaker) -> None:
+    # enough latency samples and requests to allow a hedge
+    for _ in range(40):
+        await breaker.call(HOST, answer(200))
+
+
+@pytest.mark.anyio
+async def test_hedge_loser_is_closed_when_both_answer():
+    breaker = CircuitBreaker()
+    await warm_up(breaker)
+    streams: List[TrackedStream] = []
+    first_answer = asyncio.Event()
+
+    async def send() -> httpx.Response:
+        stream = TrackedStream()
+        streams.append(stream)
+        if len(streams) == 1:
+            await first_answer.wait()
+        else:
+            # the copy and the first request answer in the same round
+            first_answer.set()
+        return httpx.Response(200, stream=stream)
+
+    response = await breaker.call(HOST, send, hedge_percentile=50, min_hedge_delay=0.01)
+    # either may win, the other is closed
+    assert [stream.closed for stream in streams].count(True) == 1
+    assert not response.stream.closed
+    assert breaker.stats()["hedged"] == 1
+
+
+@pytest.mark.anyio
+async def test_hedge_loser_is_closed_when_cancelled_late():
+    breaker = CircuitBreaker()
+    await warm_up(breaker)
+    streams: List[TrackedStream] = []
+
+    async def send() -> httpx.Response:
+        stream = TrackedStream()
+        streams.append(stream)
+        if len(streams) == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                # the headers arrived while it was cancelled
+                pass
+        return httpx.Response(200, stream=stream)
+
+    response = await breaker.call(HOST, send, hedge_percentile=50, min_hedge_delay=0.01)
+    assert response.stream is streams[1]
+    assert (streams[0].closed, streams[1].closed) == (True, False)
+    assert breaker.stats()["hedged"] == 1
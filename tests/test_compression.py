@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_compression.py
+@Time    :   2024/06/14 20:48:25
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   what the compress middleware encode and what it leave alone
+"""
+
+import gzip
+from typing import AsyncIterator, Dict
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app.core.compression import CompressionMiddleware
+from app.core.webproxy_func import encoded_response, response_encoding
+
+TEXT = b"<p>hello proxy</p>" * 100
+GZIPPED = gzip.compress(TEXT)
+
+
+async def html(request: Request) -> Response:
+    return Response(TEXT, media_type="text/html", headers={"etag": '"v1"'})
+
+
+async def streamed(request: Request) -> Response:
+    async def body() -> AsyncIterator[bytes]:
+        yield TEXT[:500]
+        yield TEXT[500:]
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+async def encoded(request: Request) -> Response:
+    # raw upstream body, already gzip
+    return Response(
+        GZIPPED, media_type="text/html", headers={"content-encoding": "gzip"}
+    )
+
+
+async def image(request: Request) -> Response:
+    return Response(TEXT, media_type="image/png")
+
+
+async def partial(request: Request) -> Response:
+    return Response(
+        TEXT[:300],
+        status_code=206,
+        media_type="text/plain",
+        headers={"content-range": f"bytes 0-299/{len(TEXT)}"},
+    )
+
+
+async def small(request: Request) -> Response:
+    return Response(b"tiny", media_type="text/plain")
+
+
+@pytest.fixture
+def client() -> httpx.AsyncClient:
+    app = Starlette(
+        routes=[
+            Route("/html", html),
+            Route("/streamed", streamed),
+            Route("/encoded", encoded),
+            Route("/image", image),
+            Route("/partial", partial),
+            Route("/small", small),
+        ]
+    )
+    app.add_middleware(CompressionMiddleware, minimum_size=200)
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://proxy.test"
+    )
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/html", "/streamed"])
+async def test_text_is_compressed(client, path):
+    response = await client.get(path, headers={"accept-encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert response.content == TEXT
+
+
+@pytest.mark.anyio
+async def test_compressed_etag_is_weak(client):
+    response = await client.get("/html", headers={"accept-encoding": "gzip"})
+    assert response.headers["etag"] == 'W/"v1"'
+
+
+@pytest.mark.anyio
+async def test_encoded_body_is_passed_through(client):
+    async with client.stream(
+        "GET", "/encoded", headers={"accept-encoding": "br, gzip"}
+    ) as response:
+        raw = b"".join([chunk async for chunk in response.aiter_raw()])
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-length"] == str(len(GZIPPED))
+    assert raw == GZIPPED
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/image", "/partial", "/small"])
+async def test_response_is_left_alone(client, path):
+    response = await client.get(path, headers={"accept-encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-length"] == str(len(response.content))
+
+
+@pytest.mark.anyio
+async def test_client_without_accept_encoding(client):
+    response = await client.get("/html", headers={"accept-encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-length"] == str(len(TEXT))
+
+
+def make_request(headers: Dict[str, str]) -> Request:
+    raw = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+    return Request({"type": "http", "method": "GET", "headers": raw})
+
+
+async def iterate(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+@pytest.mark.anyio
+async def test_proxy_raw_passthrough_keep_the_upstream_headers():
+    headers = MutableHeaders(
+        raw=[
+            (b"content-type", b"text/html"),
+            (b"content-encoding", b"gzip"),
+            (b"content-length", str(len(GZIPPED)).encode()),
+        ]
+    )
+    request = make_request({"accept-encoding": "br, gzip"})
+    encoding = response_encoding(request, headers, 200)
+    assert encoding is None
+    response = encoded_response(iterate(GZIPPED), 200, headers, encoding)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-length"] == str(len(GZIPPED))
+    assert "vary" not in response.headers
+
+
+@pytest.mark.anyio
+async def test_proxy_vary_is_set_even_when_not_encoded():
+    headers = MutableHeaders(
+        raw=[(b"content-type", b"text/html"), (b"content-length", b"1800")]
+    )
+    # the client does not accept any coding, another client may
+    encoding = response_encoding(make_request({}), headers, 200)
+    assert encoding is None
+    assert headers["vary"].lower() == "accept-encoding"
+
+    encoding = response_encoding(
+        make_request({"accept-encoding": "gzip"}), headers, 200
+    )
+    assert encoding == "gzip"
+    response = encoded_response(iterate(TEXT), 200, headers, encoding)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    assert gzip.decompress(body) == TEXT
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_content_coding.py
+@Time    :   2024/06/13 22:11:37
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   every encoder round trip through its decoder
+"""
+
+import pytest
+
+from app.core.content_coding import (
+    SUPPORTED_ENCODERS,
+    ContentEncoder,
+    get_decoder,
+    get_encoder,
+)
+
+BODY = b"<p>hello proxy</p>" * 1000
+
+
+def test_encoder_is_abstract():
+    with pytest.raises(TypeError):
+        ContentEncoder()  # type: ignore
+
+    class HalfEncoder(ContentEncoder):
+        def compress(self, data: bytes) -> bytes:
+            return data
+
+    with pytest.raises(TypeError):
+        HalfEncoder()  # type: ignore
+
+
+@pytest.mark.parametrize("encoding", list(SUPPORTED_ENCODERS))
+def test_every_piece_can_be_decoded(encoding):
+    encoder = get_encoder(encoding)
+    decoder = get_decoder(encoding)
+    assert decoder is not None
+    # each piece is flushed, the client render it before the end
+    first = encoder.compress(BODY[:100])
+    assert decoder.decompress(first) == BODY[:100]
+    rest = encoder.compress(BODY[100:]) + encoder.finish()
+    assert decoder.decompress(rest) + decoder.flush() == BODY[100:]
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_dns_cache.py
+@Time    :   2024/06/14 20:12:37
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   dns ttl and negative cache, happy eyeballs connect order
+"""
+
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import httpcore
+import pytest
+
+from app.core import dns_cache
+from app.core.dns_cache import (
+    CachingNetworkBackend,
+    DNSCache,
+    DNSResolveError,
+    interleave_families,
+)
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    # not the `time` module itself, the event loop use it
+    monkeypatch.setattr(dns_cache, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+class FakeResolver(object):
+    """answer of the system resolver, the queries are counted"""
+
+    def __init__(self, cache: DNSCache, addresses: List[str]) -> None:
+        self.addresses = addresses
+        self.error: Optional[Exception] = None
+        self.queries = 0
+        cache._query_system = self.query
+
+    async def query(self, host: str) -> Tuple[List[str], float]:
+        self.queries += 1
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        return list(self.addresses), 60
+
+
+@pytest.fixture
+def cache(monkeypatch) -> DNSCache:
+    # `getaddrinfo` path, aiodns may be installed or not
+    monkeypatch.setattr(dns_cache, "aiodns", None)
+    return DNSCache(default_ttl=60, min_ttl=10, negative_ttl=5)
+
+
+@pytest.mark.anyio
+async def test_address_is_cached_for_ttl(cache, clock):
+    resolver = FakeResolver(cache, ["1.1.1.1"])
+    assert await cache.resolve("example.com") == ["1.1.1.1"]
+    clock.now += 59
+    assert await cache.resolve("example.com") == ["1.1.1.1"]
+    assert resolver.queries == 1
+
+    clock.now += 2
+    resolver.addresses = ["2.2.2.2"]
+    assert await cache.resolve("example.com") == ["2.2.2.2"]
+    assert resolver.queries == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+@pytest.mark.anyio
+async def test_ip_is_not_resolved(cache):
+    resolver = FakeResolver(cache, [])
+    assert await cache.resolve("::1") == ["::1"]
+    assert await cache.resolve("127.0.0.1") == ["127.0.0.1"]
+    assert resolver.queries == 0
+
+
+@pytest.mark.anyio
+async def test_concurrent_lookups_share_one_query(cache, clock):
+    resolver = FakeResolver(cache, ["1.1.1.1"])
+    results = await asyncio.gather(*(cache.resolve("example.com") for _ in range(5)))
+    assert results == [["1.1.1.1"]] * 5
+    assert resolver.queries == 1
+
+
+@pytest.mark.anyio
+async def test_failure_is_cached_negative_ttl(cache, clock):
+    resolver = FakeResolver(cache, [])
+    resolver.error = OSError("no such host")
+    with pytest.raises(DNSResolveError):
+        await cache.resolve("nx.example.com")
+    clock.now += 4
+    with pytest.raises(DNSResolveError):
+        await cache.resolve("nx.example.com")
+    assert resolver.queries == 1
+
+    clock.now += 2
+    resolver.error = None
+    resolver.addresses = ["1.1.1.1"]
+    assert await cache.resolve("nx.example.com") == ["1.1.1.1"]
+    assert resolver.queries == 2
+
+
+@pytest.mark.anyio
+async def test_empty_answer_is_negative(cache, clock):
+    resolver = FakeResolver(cache, [])
+    with pytest.raises(DNSResolveError, match="no address"):
+        await cache.resolve("example.com")
+    with pytest.raises(DNSResolveError):
+        await cache.resolve("example.com")
+    assert resolver.queries == 1
+
+
+@pytest.mark.anyio
+async def test_hot_entry_refreshed_in_background(cache, clock):
+    resolver = FakeResolver(cache, ["1.1.1.1"])
+    await cache.resolve("example.com")
+    await cache.resolve("example.com")
+    clock.now += 50
+    resolver.addresses = ["2.2.2.2"]
+    # the cached address is answered, the refresh does not block
+    assert await cache.resolve("example.com") == ["1.1.1.1"]
+    await asyncio.sleep(0.01)
+    assert resolver.queries == 2
+    assert cache.stats()["refreshes"] == 1
+    assert await cache.resolve("example.com") == ["2.2.2.2"]
+
+
+@pytest.mark.anyio
+async def test_failed_refresh_keep_good_addresses(cache, clock):
+    resolver = FakeResolver(cache, ["1.1.1.1"])
+    await cache.resolve("example.com")
+    await cache.resolve("example.com")
+    clock.now += 50
+    resolver.error = OSError("resolver down")
+    assert await cache.resolve("example.com") == ["1.1.1.1"]
+    await asyncio.sleep(0.01)
+    assert await cache.resolve("example.com") == ["1.1.1.1"]
+
+
+def test_families_are_interleaved():
+    addresses = ["1.1.1.1", "2.2.2.2", "3.3.3.3", "::1", "::2"]
+    assert interleave_families(addresses) == [
+        "::1",
+        "1.1.1.1",
+        "::2",
+        "2.2.2.2",
+        "3.3.3.3",
+    ]
+    assert interleave_families(addresses, first_ipv6=False)[:3] == [
+        "1.1.1.1",
+        "::1",
+        "2.2.2.2",
+    ]
+
+
+class FakeStream(httpcore.AsyncNetworkStream):
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.closed = False
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+class FakeBackend(httpcore.AsyncNetworkBackend):
+    """connect after `delays[address]` seconds, fail if the delay is None"""
+
+    def __init__(self, delays: Dict[str, Optional[float]]) -> None:
+        self.delays = delays
+        self.attempts: List[str] = []
+        self.streams: List[FakeStream] = []
+        self.connect_on_cancel = False
+
+    async def connect_tcp(self, host, port, timeout=None, **kwargs) -> FakeStream:
+        self.attempts.append(host)
+        delay = self.delays[host]
+        if delay is None:
+            raise httpcore.ConnectError(f"refused {host}")
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # connected while the attempt was cancelled
+            if not self.connect_on_cancel:
+                raise
+        stream = FakeStream(host)
+        self.streams.append(stream)
+        return stream
+
+
+def eyeballs(cache: DNSCache, delays: Dict[str, Optional[float]]):
+    FakeResolver(cache, list(delays))
+    backend = FakeBackend(delays)
+    return backend, CachingNetworkBackend(cache, backend, attempt_delay=0.05)
+
+
+@pytest.mark.anyio
+async def test_refused_ipv6_fall_back_to_ipv4_at_once(cache):
+    backend, network = eyeballs(cache, {"::1": None, "1.1.1.1": 0})
+    stream = await network.connect_tcp("example.com", 443)
+    assert stream.address == "1.1.1.1"
+    assert backend.attempts == ["::1", "1.1.1.1"]
+
+
+@pytest.mark.anyio
+async def test_slow_ipv6_race_ipv4_after_attempt_delay(cache):
+    backend, network = eyeballs(cache, {"::1": 10, "1.1.1.1": 0})
+    loop = asyncio.get_running_loop()
+    begin = loop.time()
+    stream = await network.connect_tcp("example.com", 443)
+    assert stream.address == "1.1.1.1"
+    assert backend.attempts == ["::1", "1.1.1.1"]
+    assert 0.05 <= loop.time() - begin < 1
+    # the family that connected is tried first next time
+    assert await cache.resolve("example.com") == ["1.1.1.1", "::1"]
+
+
+@pytest.mark.anyio
+async def test_loser_connection_is_closed(cache):
+    backend, network = eyeballs(cache, {"::1": 10, "::2": 0})
+    backend.connect_on_cancel = True
+    stream = await network.connect_tcp("example.com", 443)
+    assert stream.address == "::2"
+    assert {s.address: s.closed for s in backend.streams} == {
+        "::1": True,
+        "::2": False,
+    }
+
+
+@pytest.mark.anyio
+async def test_every_address_fail(cache):
+    backend, network = eyeballs(cache, {"::1": None, "1.1.1.1": None})
+    with pytest.raises(httpcore.ConnectError):
+        await network.connect_tcp("example.com", 443)
+    assert backend.attempts == ["::1", "1.1.1.1"]
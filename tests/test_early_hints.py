@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_early_hints.py
+@Time    :   2024/06/14 21:30:08
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   critical subresources of pages, preload links and background fetches
+"""
+
+import asyncio
+from typing import List, Tuple
+
+import httpx
+import pytest
+
+from app.core import webproxy_func
+from app.core.early_hints import PreloadHints, Prefetcher, preload_link
+from app.core.html_rewrite import StreamingHTMLRewriter
+from app.core.url_rewrite import proxy_url_mapper
+
+PAGE = """<html><head>
+<base href="https://cdn.example.com/assets/">
+<link rel="stylesheet" href="main.css">
+<link rel="preload" href="/font.woff2" as="Font" type="font/woff2">
+<link rel="icon" href="favicon.ico">
+<link rel="preload" href="no-as.js">
+<script src="app.js"></script>
+<script>var inline = 1;</script>
+<script src="data:text/javascript,1"></script>
+</head><body><img src="a.png"></body></html>"""
+
+
+def extract(document: str) -> List[Tuple[str, str]]:
+    found: List[Tuple[str, str]] = []
+    rewriter = StreamingHTMLRewriter(
+        "https://example.com/page",
+        proxy_url_mapper("/proxy/"),
+        on_resource=lambda url, destination: found.append((url, destination)),
+    )
+    rewriter.feed(document)
+    rewriter.flush()
+    return found
+
+
+def test_critical_resources_are_extracted():
+    assert extract(PAGE) == [
+        ("https://cdn.example.com/assets/main.css", "style"),
+        ("https://cdn.example.com/font.woff2", "font"),
+        ("https://cdn.example.com/assets/app.js", "script"),
+    ]
+
+
+def test_preload_link():
+    assert preload_link("/a.css", "style") == "</a.css>; rel=preload; as=style"
+    assert preload_link("/a.woff2", "font") == (
+        "</a.woff2>; rel=preload; as=font; crossorigin"
+    )
+
+
+def test_hints_of_the_last_response():
+    hints = PreloadHints(max_pages=2, max_resources=2)
+    new: List[str] = []
+    collect = hints.collector("https://a/", on_new=lambda url, _: new.append(url))
+    for url in ("https://a/1.css", "https://a/1.css", "https://a/2.js", "https://a/3"):
+        collect(url, "style")
+    assert hints.get("https://a/") == [
+        ("https://a/1.css", "style"),
+        ("https://a/2.js", "style"),
+    ]
+    # deduplicated and bounded, only the new ones are fetched
+    assert new == ["https://a/1.css", "https://a/2.js"]
+
+    # the next response of the page replace the hints
+    hints.collector("https://a/")("https://a/4.css", "style")
+    assert hints.get("https://a/") == [("https://a/4.css", "style")]
+    assert hints.get("https://unknown/") == []
+
+    hints.collector("https://b/")("https://b/1.css", "style")
+    hints.collector("https://c/")("https://c/1.css", "style")
+    # least recently used page is dropped
+    assert hints.get("https://a/") == []
+    assert hints.stats() == {"pages": 2, "hinted": 2}
+
+
+@pytest.mark.anyio
+async def test_prefetcher_deduplicate_and_bound():
+    prefetcher = Prefetcher(concurrency=2, max_pending=3)
+    release = asyncio.Event()
+    running = 0
+    peak = 0
+
+    async def fetch() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await release.wait()
+        running -= 1
+
+    for url in ("a", "a", "b", "c", "d"):
+        prefetcher.schedule(url, fetch)
+    # `a` is pending already, `d` is over `max_pending`
+    assert prefetcher.stats()["skipped"] == 2
+    assert prefetcher.stats()["pending"] == 3
+    await asyncio.sleep(0.01)
+    assert peak == 2
+
+    release.set()
+    await asyncio.sleep(0.01)
+    assert prefetcher.stats() == {
+        "pending": 0,
+        "prefetched": 3,
+        "failed": 0,
+        "skipped": 2,
+    }
+    # done, it can be scheduled again
+    prefetcher.schedule("a", fetch)
+    await asyncio.sleep(0.01)
+    assert prefetcher.stats()["prefetched"] == 4
+
+
+@pytest.mark.anyio
+async def test_prefetcher_count_failure():
+    prefetcher = Prefetcher()
+
+    async def fetch() -> None:
+        raise httpx.ConnectError("down")
+
+    prefetcher.schedule("a", fetch)
+    await asyncio.sleep(0.01)
+    assert prefetcher.stats()["failed"] == 1
+    assert prefetcher.stats()["pending"] == 0
+
+
+@pytest.mark.anyio
+async def test_next_page_load_is_hinted_and_warmed(webproxy_app, upstream, monkeypatch):
+    monkeypatch.setattr(webproxy_func.settings, "PROXY_PREFETCH", True)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/style.css":
+            return httpx.Response(
+                200,
+                headers={"content-type": "text/css", "cache-control": "max-age=600"},
+                content=b"body { color: red; }",
+            )
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/html", "cache-control": "no-store"},
+            content=b'<link rel="stylesheet" href="/style.css"><p>hello</p>',
+        )
+
+    upstream.handler = handler
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": "http://upstream.test/"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        first = await client.get("/proxy/", params=params)
+        assert "link" not in first.headers
+        await asyncio.sleep(0.05)
+        # the stylesheet is fetched into the cache in background
+        assert [r.url.path for r in upstream.requests] == ["/", "/style.css"]
+
+        second = await client.get("/proxy/", params=params)
+        assert second.headers["link"] == (
+            "</proxy/?url=http://upstream.test/style.css>; rel=preload; as=style"
+        )
+        style = await client.get(
+            "/proxy/", params={"url": "http://upstream.test/style.css"}
+        )
+        assert style.headers["x-proxy-cache"] == "HIT"
+    assert [r.url.path for r in upstream.requests] == ["/", "/style.css", "/"]
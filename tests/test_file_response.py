@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_file_response.py
+@Time    :   2024/06/15 14:02:36
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   slice of local file sent zero-copy or read by chunks, cached ranges
+"""
+
+from typing import Any, Dict, List
+
+import anyio
+import httpx
+import pytest
+from starlette.datastructures import MutableHeaders
+
+from app.core import file_response, webproxy_func
+from app.core.file_response import FileSliceResponse, open_file
+
+DATA = bytes(range(256)) * 64
+
+
+@pytest.fixture
+def data_file(tmp_path) -> str:
+    path = tmp_path / "body"
+    path.write_bytes(DATA)
+    return str(path)
+
+
+async def run(
+    response: FileSliceResponse, scope: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    sent: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        await anyio.sleep_forever()
+        return {}
+
+    async def send(message: Dict[str, Any]) -> None:
+        sent.append(message)
+
+    await response(scope, receive, send)
+    return sent
+
+
+def slice_response(path: str, offset: int, count: int) -> FileSliceResponse:
+    file = open_file(path)
+    assert file is not None
+    headers = MutableHeaders({"content-type": "application/octet-stream"})
+    return FileSliceResponse(file, offset, count, 206, headers)
+
+
+@pytest.mark.anyio
+async def test_slice_is_read_by_chunks(data_file, monkeypatch):
+    monkeypatch.setattr(file_response, "_READ_CHUNK_SIZE", 1000)
+    response = slice_response(data_file, 100, 2500)
+    sent = await run(response, {"type": "http", "method": "GET"})
+
+    assert sent[0]["status"] == 206
+    assert (b"content-length", b"2500") in sent[0]["headers"]
+    bodies = sent[1:]
+    assert [len(m["body"]) for m in bodies] == [1000, 1000, 500]
+    assert [m["more_body"] for m in bodies] == [True, True, False]
+    assert b"".join(m["body"] for m in bodies) == DATA[100:2600]
+    assert response.file.closed
+
+
+@pytest.mark.anyio
+async def test_pread_fallback_without_os_pread(data_file, monkeypatch):
+    monkeypatch.delattr(file_response.os, "pread")
+    response = slice_response(data_file, 4000, 300)
+    sent = await run(response, {"type": "http", "method": "GET"})
+    assert b"".join(m.get("body", b"") for m in sent[1:]) == DATA[4000:4300]
+
+
+@pytest.mark.anyio
+async def test_zero_copy_send(data_file):
+    response = slice_response(data_file, 10, 20)
+    file = response.file
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "extensions": {"http.response.zerocopysend": {}},
+    }
+    sent = await run(response, scope)
+    assert sent[1] == {
+        "type": "http.response.zerocopysend",
+        "file": file,
+        "offset": 10,
+        "count": 20,
+        "more_body": False,
+    }
+    assert file.closed
+
+
+@pytest.mark.anyio
+async def test_head_and_empty_slice(data_file):
+    sent = await run(
+        slice_response(data_file, 0, 10), {"type": "http", "method": "HEAD"}
+    )
+    assert sent[1] == {"type": "http.response.body", "body": b""}
+
+    sent = await run(slice_response(data_file, 0, 0), {"type": "http", "method": "GET"})
+    assert sent[1] == {"type": "http.response.body", "body": b""}
+
+
+@pytest.mark.anyio
+async def test_truncated_file(data_file):
+    response = slice_response(data_file, len(DATA) - 10, 20)
+    with pytest.raises(Exception) as info:
+        await run(response, {"type": "http", "method": "GET"})
+    # may be grouped by the task group
+    assert "file is truncated" in repr(info.value)
+    assert response.file.closed
+
+
+def test_gone_file_is_none(tmp_path):
+    assert open_file(str(tmp_path / "gone")) is None
+    assert open_file(None) is None
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("memory_object_size", [0, 1024 * 1024], ids=["disk", "memory"])
+async def test_cached_body_is_sliced(webproxy_app, upstream, memory_object_size):
+    webproxy_func.GlobalResponseCache.memory_object_size = memory_object_size
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={
+            "content-type": "application/octet-stream",
+            "etag": '"v1"',
+            "cache-control": "max-age=600",
+        },
+        content=DATA,
+    )
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": "http://upstream.test/data.bin"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        response = await client.get("/file/", params=params)
+        assert response.content == DATA
+        assert response.headers["x-proxy-cache"] == "MISS"
+
+        response = await client.get(
+            "/file/", params=params, headers={"range": "bytes=100-199"}
+        )
+        assert response.status_code == 206
+        assert response.headers["x-proxy-cache"] == "HIT"
+        assert response.headers["content-range"] == f"bytes 100-199/{len(DATA)}"
+        assert response.content == DATA[100:200]
+
+        response = await client.get(
+            "/file/", params=params, headers={"range": "bytes=-10"}
+        )
+        assert response.content == DATA[-10:]
+
+        response = await client.get(
+            "/file/", params=params, headers={"range": f"bytes={len(DATA)}-"}
+        )
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(DATA)}"
+
+        # another version, the whole file
+        response = await client.get(
+            "/file/",
+            params=params,
+            headers={"range": "bytes=0-9", "if-range": '"v0"'},
+        )
+        assert response.status_code == 200
+        assert response.content == DATA
+    assert len(upstream.requests) == 1
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_html_rewrite.py
+@Time    :   2024/06/14 20:12:08
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   html rewritten chunk by chunk is the same as rewritten at once
+"""
+
+from typing import AsyncIterator, List
+
+import pytest
+from starlette.datastructures import MutableHeaders
+
+from app.core.html_rewrite import StreamingHTMLRewriter
+from app.core.url_rewrite import proxy_url_mapper
+from app.core.webproxy_func import transform_web_content
+
+BASE = "https://example.com/dir/page.html"
+mapper = proxy_url_mapper("/proxy/")
+
+DOCUMENT = (
+    "<!DOCTYPE html><html><head>"
+    "<!-- <img src='/in-comment.png'> -->"
+    '<link rel="stylesheet" href="/a.css" integrity="sha384-x">'
+    "<style>body { background: url('/bg.png') }</style>"
+    '<script>var api = "https://api.example.com/v1"; if (a < b) {}</script>'
+    '<script type="text/template"><img src="https://t.example.com/x"></script>'
+    "<title>1 < 2 <b></title>"
+    "</head><body>"
+    "<a href='next.html?a=1&amp;b=2'>next</a>"
+    '<img srcset="/s.png 1x, /l.png 2x" alt="a > b">'
+    '<div style="background: url(/d.png)">text < more</div>'
+    "</body></html>"
+)
+
+
+def rewrite_in_pieces(pieces: List[str]) -> str:
+    rewriter = StreamingHTMLRewriter(BASE, mapper)
+    return "".join(rewriter.feed(piece) for piece in pieces) + rewriter.flush()
+
+
+def test_rewrite_document():
+    result = rewrite_in_pieces([DOCUMENT])
+    assert 'href="/proxy/?url=https://example.com/a.css"' in result
+    # the rewritten stylesheet can not match the hash
+    assert "integrity" not in result
+    assert "url('/proxy/?url=https://example.com/bg.png')" in result
+    assert '"/proxy/?url=https://api.example.com/v1"' in result
+    assert "href='/proxy/?url=https://example.com/dir/next.html%3Fa%3D1%26b%3D2'" in (
+        result
+    )
+    assert (
+        'srcset="/proxy/?url=https://example.com/s.png 1x, '
+        '/proxy/?url=https://example.com/l.png 2x"'
+    ) in result
+    assert "url(/proxy/?url=https://example.com/d.png)" in result
+    # comments, templates and raw text are not tags
+    assert "<img src='/in-comment.png'>" in result
+    assert '<img src="https://t.example.com/x">' in result
+    assert "<title>1 < 2 <b></title>" in result
+    assert "text < more" in result
+
+
+def test_split_at_every_position():
+    expected = rewrite_in_pieces([DOCUMENT])
+    for i in range(1, len(DOCUMENT)):
+        assert rewrite_in_pieces([DOCUMENT[:i], DOCUMENT[i:]]) == expected, i
+
+
+def test_feed_char_by_char():
+    expected = rewrite_in_pieces([DOCUMENT])
+    assert rewrite_in_pieces(list(DOCUMENT)) == expected
+
+
+def test_base_href_change_the_following_urls():
+    result = rewrite_in_pieces(
+        ['<base href="https://cdn.example.com/s/">', '<img src="a.png">']
+    )
+    assert '<img src="/proxy/?url=https://cdn.example.com/s/a.png">' in result
+
+
+def test_unfinished_document_is_flushed():
+    rewriter = StreamingHTMLRewriter(BASE, mapper)
+    out = rewriter.feed("<p>text</p><img src='/a.png' alt=")
+    assert out == "<p>text</p>"
+    assert rewriter.flush() == "<img src='/a.png' alt="
+
+
+async def iterate(chunks: List[bytes]) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_non_html_is_forwarded_untouched():
+    headers = MutableHeaders(
+        raw=[
+            (b"content-type", b"image/png"),
+            (b"content-encoding", b"gzip"),
+            (b"content-length", b"6"),
+        ]
+    )
+    chunks = [b"\x89PNG", b"<a>"]
+    stream = transform_web_content(headers, iterate(chunks), BASE, mapper)
+    assert [chunk async for chunk in stream] == chunks
+    assert headers["content-length"] == "6"
+    assert headers["content-encoding"] == "gzip"
+
+
+@pytest.mark.anyio
+async def test_html_body_is_rewritten():
+    headers = MutableHeaders(
+        raw=[(b"content-type", b"text/html"), (b"content-length", b"22")]
+    )
+    chunks = [b"<img sr", b'c="/a.png">']
+    stream = transform_web_content(headers, iterate(chunks), BASE, mapper)
+    body = b"".join([chunk async for chunk in stream])
+    assert body == b'<img src="/proxy/?url=https://example.com/a.png">'
+    assert "content-length" not in headers
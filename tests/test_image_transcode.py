@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_image_transcode.py
+@Time    :   2024/06/16 10:12:09
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   images of /proxy/ in the format the client accept
+"""
+
+from io import BytesIO
+from typing import Dict, List
+
+import httpx
+import pytest
+from PIL import Image
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from app.core import webproxy_func
+from app.core.image_transcode import ImageTranscoder, transcode_image
+
+PNG = b"\x89PNG" + bytes(4 * 1024)
+WEBP = b"RIFF-webp"
+ACCEPT = "image/avif,image/webp,image/png,*/*;q=0.8"
+
+
+@pytest.fixture
+def transcoded(monkeypatch) -> List[str]:
+    """keys of the images sent to the worker, which answer `WEBP`"""
+    transcoder = ImageTranscoder(formats=["webp"], max_input_size=64 * 1024)
+    keys: List[str] = []
+
+    async def transcode(key: str, data: bytes, image_format: str) -> bytes:
+        assert data == PNG
+        keys.append(key)
+        return WEBP
+
+    monkeypatch.setattr(transcoder, "transcode", transcode)
+    monkeypatch.setattr(webproxy_func, "GlobalImageTranscoder", transcoder)
+    return keys
+
+
+def image_handler(headers: Dict[str, str], content: bytes = PNG):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200,
+            headers={"content-type": "image/png", "etag": '"v1"', **headers},
+            content=content,
+        )
+
+    return handler
+
+
+async def get(webproxy_app, path: str, accept: str) -> httpx.Response:
+    transport = httpx.ASGITransport(app=webproxy_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        return await client.get(
+            path,
+            params={"url": "http://upstream.test/a.png"},
+            headers={"accept": accept},
+        )
+
+
+@pytest.mark.anyio
+async def test_accepted_format_is_sent(webproxy_app, upstream, transcoded):
+    upstream.handler = image_handler({"cache-control": "no-store"})
+    response = await get(webproxy_app, "/proxy/", ACCEPT)
+    assert response.content == WEBP
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["content-length"] == str(len(WEBP))
+    assert response.headers["etag"] == '"v1-webp"'
+    assert "accept" in response.headers["vary"]
+    assert transcoded == ['http://upstream.test/a.png|"v1"|webp']
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "accept", ["image/png,*/*;q=0.8", "image/*", "image/webp;q=0", ""]
+)
+async def test_original_when_not_accepted(webproxy_app, upstream, transcoded, accept):
+    upstream.handler = image_handler({"cache-control": "no-store"})
+    response = await get(webproxy_app, "/proxy/", accept)
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    # a cache must still tell the clients apart
+    assert "accept" in response.headers["vary"]
+    assert transcoded == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"cache-control": "no-store, no-transform"},
+        {"cache-control": "no-store", "content-disposition": "attachment"},
+    ],
+)
+async def test_original_is_kept(webproxy_app, upstream, transcoded, headers):
+    upstream.handler = image_handler(headers)
+    response = await get(webproxy_app, "/proxy/", ACCEPT)
+    assert response.content == PNG
+    assert "accept" not in response.headers.get("vary", "")
+    assert transcoded == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("size", [100, 64 * 1024 + 1])
+async def test_size_cap(webproxy_app, upstream, transcoded, size):
+    upstream.handler = image_handler({"cache-control": "no-store"}, bytes(size))
+    response = await get(webproxy_app, "/proxy/", ACCEPT)
+    assert len(response.content) == size
+    assert response.headers["content-type"] == "image/png"
+    assert transcoded == []
+
+
+@pytest.mark.anyio
+async def test_download_is_untouched(webproxy_app, upstream, transcoded):
+    upstream.handler = image_handler({"cache-control": "no-store"})
+    response = await get(webproxy_app, "/file/", ACCEPT)
+    assert response.content == PNG
+    assert transcoded == []
+
+
+@pytest.mark.anyio
+async def test_upstream_is_closed_when_transcoding_fail(monkeypatch):
+    transcoder = ImageTranscoder(formats=["webp"])
+
+    async def transcode(key: str, data: bytes, image_format: str) -> bytes:
+        raise RuntimeError("worker crashed")
+
+    monkeypatch.setattr(transcoder, "transcode", transcode)
+    monkeypatch.setattr(webproxy_func, "GlobalImageTranscoder", transcoder)
+    closed: List[bool] = []
+
+    async def close() -> None:
+        closed.append(True)
+
+    async def body():
+        yield PNG
+
+    response = StreamingResponse(
+        body(),
+        headers={"content-type": "image/png", "content-length": str(len(PNG))},
+        background=BackgroundTask(close),
+    )
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/proxy/",
+            "query_string": b"",
+            "headers": [(b"accept", ACCEPT.encode())],
+        }
+    )
+    with pytest.raises(RuntimeError):
+        await webproxy_func.transcode_image_response(
+            request, "http://upstream.test/a.png", response
+        )
+    assert closed == [True]
+    assert webproxy_func.GlobalMemoryBudget.stats()["used"] == 0
+
+
+def test_transcode_image():
+    image = Image.new("RGB", (256, 256), (200, 30, 30))
+    output = BytesIO()
+    image.save(output, "PNG")
+    data = transcode_image(output.getvalue(), "webp", 40 * 1000 * 1000)
+    with Image.open(BytesIO(data)) as result:
+        assert (result.format, result.size) == ("WEBP", (256, 256))
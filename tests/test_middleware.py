@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_middleware.py
+@Time    :   2024/06/15 16:40:12
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   raw ASGI fast path of /file/ against the routed one, access log
+"""
+
+from typing import List, Tuple
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request
+
+from app.register import middleware
+from app.routers.webproxy.router import router
+
+Logged = List[Tuple[str, int]]
+
+
+@pytest.fixture
+def logged(monkeypatch) -> Logged:
+    """access logs which would be written, no database"""
+    logged: Logged = []
+
+    def access_log_task(request: Request, status_code: int):
+        logged.append((request.url.path, status_code))
+        return None
+
+    monkeypatch.setattr(middleware, "access_log_task", access_log_task)
+    return logged
+
+
+def create_app(monkeypatch, fast: bool) -> FastAPI:
+    monkeypatch.setattr(middleware.settings, "FAST_FILE_ROUTE", fast)
+    app = FastAPI()
+    app.include_router(router)
+    middleware.register_middleware(app)
+    return app
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "method, headers",
+    [
+        ("GET", {}),
+        ("GET", {"origin": "https://site.test", "accept-encoding": "gzip"}),
+        ("GET", {"range": "bytes=10-19", "origin": "https://site.test"}),
+        ("POST", {"origin": "https://site.test"}),
+    ],
+)
+async def test_fast_path_match_routed_file(
+    monkeypatch, upstream, logged, method, headers
+):
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        headers={"content-type": "text/plain", "cache-control": "no-store"},
+        content=b"hello world " * 1000,
+    )
+    responses = []
+    for fast in (True, False):
+        transport = httpx.ASGITransport(app=create_app(monkeypatch, fast))
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://t"
+        ) as client:
+            responses.append(
+                await client.request(
+                    method,
+                    "/file/",
+                    params={"url": "http://upstream.test/a.txt"},
+                    headers=headers,
+                )
+            )
+    fast_response, routed = responses
+    assert fast_response.status_code == routed.status_code
+    assert fast_response.content == routed.content
+    # documented, the fast path skip the http middleware wrapper
+    assert "x-process-time" not in fast_response.headers
+    del routed.headers["x-process-time"]
+    assert sorted(fast_response.headers.multi_items()) == sorted(
+        routed.headers.multi_items()
+    )
+    if "origin" in headers:
+        assert (
+            fast_response.headers["access-control-allow-origin"] == "https://site.test"
+        )
+    assert logged == [("/file/", routed.status_code)] * 2
+
+
+@pytest.mark.anyio
+async def test_failed_fast_route_is_logged(logged):
+    async def broken(scope, receive, send) -> None:
+        raise RuntimeError("broken")
+
+    async def app(scope, receive, send) -> None:
+        raise AssertionError("not the fast path")
+
+    fast_path = middleware.FastPathMiddleware(app, routes={"/file/": broken})
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/file/",
+        "query_string": b"",
+        "headers": [],
+    }
+    with pytest.raises(RuntimeError):
+        await fast_path(scope, None, None)
+    assert logged == [("/file/", 500)]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_proxy_cache.py
+@Time    :   2024/06/12 20:14:36
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   shared response cache, what is stored and the index of it
+"""
+
+import os
+from typing import Dict, Optional
+
+import httpx
+import pytest
+from starlette.datastructures import Headers as StarletteHeaders
+
+from app.core.proxy_cache import ResponseCache
+
+URL = "http://upstream.test/file"
+
+
+def make_response(headers: Dict[str, str], status_code: int = 200) -> httpx.Response:
+    return httpx.Response(
+        status_code, headers=headers, request=httpx.Request("GET", URL)
+    )
+
+
+def request_headers(headers: Optional[Dict[str, str]] = None) -> StarletteHeaders:
+    return StarletteHeaders(headers=headers or {})
+
+
+async def store(
+    cache: ResponseCache,
+    url: str,
+    body: bytes,
+    headers: Dict[str, str],
+    request: Optional[Dict[str, str]] = None,
+) -> None:
+    writer = cache.create_writer(
+        "GET", url, make_response(headers), request_headers(request)
+    )
+    await writer.write(body)
+    await writer.commit()
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"cache-control": "private, max-age=600"},
+        {"cache-control": "no-store"},
+        {"cache-control": "max-age=600", "set-cookie": "session=alice"},
+        {"cache-control": "max-age=600", "vary": "*"},
+        {},
+    ],
+)
+def test_response_is_not_cacheable(headers):
+    cache = ResponseCache()
+    assert not cache.response_is_cacheable(make_response(headers), request_headers())
+
+
+def test_response_is_cacheable():
+    cache = ResponseCache()
+    response = make_response({"cache-control": "max-age=600"})
+    assert cache.response_is_cacheable(response, request_headers())
+
+
+def test_authorized_request_need_public_response():
+    cache = ResponseCache()
+    authorized = request_headers({"authorization": "Bearer alice"})
+    response = make_response({"cache-control": "max-age=600"})
+    assert not cache.response_is_cacheable(response, authorized)
+    response = make_response({"cache-control": "public, max-age=600"})
+    assert cache.response_is_cacheable(response, authorized)
+
+
+@pytest.mark.anyio
+async def test_vary_variants_are_separated():
+    cache = ResponseCache()
+    headers = {"cache-control": "max-age=600", "vary": "accept-language"}
+    await store(cache, URL, b"en", headers, {"accept-language": "en"})
+    await store(cache, URL, b"de", headers, {"accept-language": "de"})
+
+    entry = cache.lookup("GET", URL, request_headers({"accept-language": "de"}))
+    assert entry is not None and entry.body == b"de"
+    assert cache.lookup("GET", URL, request_headers({"accept-language": "fr"})) is None
+
+
+@pytest.mark.anyio
+async def test_vary_index_is_pruned_on_eviction():
+    cache = ResponseCache(memory_size=10 * 100)
+    for i in range(500):
+        await store(cache, f"{URL}/{i}", b"x" * 100, {"cache-control": "max-age=600"})
+    assert cache.stats()["memory_entries"] == 10
+    assert len(cache._vary) == 10
+
+    for i in range(490, 500):
+        cache.remove(ResponseCache.primary_key("GET", f"{URL}/{i}"))
+    assert not cache._vary
+
+
+@pytest.mark.anyio
+async def test_vary_index_is_kept_while_a_variant_is_left():
+    cache = ResponseCache()
+    headers = {"cache-control": "max-age=600", "vary": "accept-language"}
+    await store(cache, URL, b"en", headers, {"accept-language": "en"})
+    await store(cache, URL, b"de", headers, {"accept-language": "de"})
+
+    entry = cache.lookup("GET", URL, request_headers({"accept-language": "en"}))
+    assert entry is not None
+    cache.remove(entry.key)
+    assert cache.lookup("GET", URL, request_headers({"accept-language": "de"}))
+    assert len(cache._vary) == 1
+
+
+@pytest.mark.anyio
+async def test_each_process_has_its_own_directory(tmp_path):
+    first = ResponseCache(memory_object_size=10, directory=str(tmp_path))
+    second = ResponseCache(memory_object_size=10, directory=str(tmp_path))
+    headers = {"cache-control": "max-age=600"}
+    await store(first, URL, b"1" * 100, headers)
+    await store(second, URL, b"2" * 100, headers)
+
+    first_entry = first.lookup("GET", URL, request_headers())
+    second_entry = second.lookup("GET", URL, request_headers())
+    assert first_entry is not None and first_entry.path is not None
+    assert second_entry is not None and second_entry.path is not None
+    assert os.path.dirname(first_entry.path) != os.path.dirname(second_entry.path)
+
+    first.close()
+    assert not os.path.exists(first_entry.path)
+    assert os.path.exists(second_entry.path)
+    assert os.listdir(tmp_path) == [os.path.basename(second._path)]
+
+
+@pytest.mark.parametrize(
+    "request_headers_",
+    [{"cookie": "session=alice"}, {"authorization": "Bearer alice"}],
+)
+def test_request_with_credentials_need_public_response(request_headers_):
+    cache = ResponseCache()
+    private = request_headers(request_headers_)
+    response = make_response({"cache-control": "max-age=600", "etag": '"v1"'})
+    assert not cache.response_is_cacheable(response, private)
+    for shared in ("public, max-age=600", "s-maxage=600"):
+        response = make_response({"cache-control": shared})
+        assert cache.response_is_cacheable(response, private)
+
+
+def test_empty_cookie_is_not_a_credential():
+    cache = ResponseCache()
+    response = make_response({"cache-control": "max-age=600"})
+    assert cache.response_is_cacheable(response, request_headers({"cookie": ""}))
+
+
+@pytest.mark.anyio
+async def test_request_with_credentials_only_get_public_entry():
+    cache = ResponseCache()
+    await store(cache, URL, b"anonymous", {"cache-control": "max-age=600"})
+    await store(
+        cache, f"{URL}/public", b"public", {"cache-control": "public, max-age=600"}
+    )
+
+    alice = request_headers({"cookie": "session=alice"})
+    assert cache.lookup("GET", URL, alice) is None
+    assert cache.lookup("GET", URL, request_headers({"cookie": ""})) is not None
+    entry = cache.lookup("GET", f"{URL}/public", alice)
+    assert entry is not None and entry.body == b"public"
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_range_cache.py
+@Time    :   2024/06/12 21:02:18
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   block store of range requests, what is shared and for how long
+"""
+
+import os
+from typing import Dict
+
+import httpx
+import pytest
+from starlette.datastructures import Headers as StarletteHeaders
+
+from app.core.range_cache import (
+    ChunkStore,
+    block_request_is_cacheable,
+    open_block_file,
+    parse_range,
+    resolve_range,
+)
+
+URL = "http://upstream.test/video.mp4"
+SIZE = 10 * 1024
+
+
+def range_response(headers: Dict[str, str]) -> httpx.Response:
+    headers = {
+        "etag": '"v1"',
+        "content-range": f"bytes 0-1023/{SIZE}",
+        **headers,
+    }
+    return httpx.Response(206, headers=headers, request=httpx.Request("GET", URL))
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"range": "bytes=0-", "cookie": "session=alice"},
+        {"range": "bytes=0-", "authorization": "Bearer alice"},
+        {"range": "bytes=0-", "cache-control": "no-store"},
+    ],
+)
+def test_request_with_credentials_bypass_the_store(headers):
+    assert not block_request_is_cacheable(StarletteHeaders(headers=headers))
+
+
+def test_anonymous_request_use_the_store():
+    assert block_request_is_cacheable(StarletteHeaders(headers={"range": "bytes=0-"}))
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {"cache-control": "private, no-store"},
+        {"cache-control": "private, max-age=600"},
+        {"cache-control": "no-store"},
+        {"set-cookie": "session=alice"},
+        {"vary": "cookie"},
+        {"vary": "*"},
+    ],
+)
+def test_private_response_is_not_stored(headers):
+    response = range_response(headers)
+    assert not ChunkStore.response_is_cacheable(response, StarletteHeaders())
+
+
+def test_shared_response_is_stored():
+    response = range_response(
+        {"cache-control": "max-age=60", "vary": "Accept-Encoding"}
+    )
+    assert ChunkStore.response_is_cacheable(response, StarletteHeaders())
+
+
+def test_object_freshness(tmp_path):
+    store = ChunkStore(block_size=1024, directory=str(tmp_path))
+    obj = store.put(URL, '"v1"', SIZE, httpx.Headers({"cache-control": "max-age=60"}))
+    assert obj is not None and obj.is_fresh()
+
+    # no lifetime and no last-modified, revalidate every time
+    obj = store.put(URL, '"v2"', SIZE, httpx.Headers({"etag": '"v2"'}))
+    assert obj is not None and not obj.is_fresh()
+    assert obj.conditional_headers() == {"if-none-match": '"v2"'}
+
+    obj.freshen(httpx.Headers({"cache-control": "max-age=60"}))
+    assert obj.is_fresh()
+    assert ("cache-control", "max-age=60") in obj.headers
+
+
+def test_evicted_block_file_is_not_created_again(tmp_path):
+    store = ChunkStore(block_size=1024, directory=str(tmp_path))
+    obj = store.put(URL, '"v1"', SIZE, httpx.Headers({"cache-control": "max-age=60"}))
+    assert obj is not None
+    fd = open_block_file(obj)
+    assert fd is not None
+    os.close(fd)
+
+    store.invalidate(URL)
+    assert open_block_file(obj) is None
+    assert not os.path.exists(obj.path)
+
+
+def test_each_process_has_its_own_directory(tmp_path):
+    first = ChunkStore(directory=str(tmp_path))
+    second = ChunkStore(directory=str(tmp_path))
+    headers = httpx.Headers({"cache-control": "max-age=60"})
+    first_obj = first.put(URL, '"v1"', SIZE, headers)
+    second_obj = second.put(URL, '"v1"', SIZE, headers)
+    assert first_obj is not None and second_obj is not None
+    assert first_obj.path != second_obj.path
+
+    first.close()
+    assert not os.path.exists(first_obj.path)
+    assert os.path.exists(second_obj.path)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, SIZE - 1)),
+        ("bytes=-5", (SIZE - 5, SIZE - 1)),
+        ("bytes=0-999999", (0, SIZE - 1)),
+    ],
+)
+def test_resolve_range(value, expected):
+    spec = parse_range(value)
+    assert spec is not None
+    assert tuple(resolve_range(spec, SIZE)) == expected
+
+
+def test_unsatisfiable_and_multiple_ranges():
+    assert parse_range("bytes=0-1,5-9") is None
+    spec = parse_range(f"bytes={SIZE}-")
+    assert spec is not None and resolve_range(spec, SIZE) is None
+
+
+def test_range_unsupported_url_is_remembered(monkeypatch):
+    store = ChunkStore(no_range_ttl=60, max_no_range=2)
+    now = 1000.0
+    monkeypatch.setattr("app.core.range_cache.time.monotonic", lambda: now)
+    store.mark_range_unsupported(URL)
+    assert store.range_unsupported(URL)
+    assert not store.range_unsupported(f"{URL}?other")
+
+    now += 61
+    assert not store.range_unsupported(URL)
+
+    for i in range(3):
+        store.mark_range_unsupported(f"{URL}?{i}")
+    assert store.stats()["no_range_urls"] == 2
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_redirect_cache.py
+@Time    :   2024/06/12 22:31:07
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   which redirect hops are shared by every client
+"""
+
+from typing import Dict
+
+import httpx
+import pytest
+
+from app.core.redirect_cache import RedirectResolver
+
+URL = "http://upstream.test/login"
+LANDING = "http://upstream.test/landing?u=alice"
+
+
+def followed(
+    status_code: int,
+    headers: Dict[str, str],
+    request_headers: Dict[str, str],
+) -> httpx.Response:
+    """the final response of `URL` redirected once to `LANDING`"""
+    hop = httpx.Response(
+        status_code,
+        headers={"location": LANDING, **headers},
+        request=httpx.Request("GET", URL, headers=request_headers),
+    )
+    response = httpx.Response(200, request=httpx.Request("GET", LANDING))
+    response.history = [hop]
+    return response
+
+
+def resolved(resolver: RedirectResolver) -> str:
+    return str(resolver.resolve(httpx.URL(URL)))
+
+
+@pytest.mark.parametrize(
+    "status_code, headers, request_headers",
+    [
+        (302, {"cache-control": "private, max-age=600"}, {"cookie": ""}),
+        (301, {"cache-control": "private"}, {"cookie": ""}),
+        (301, {"cache-control": "no-store"}, {"cookie": ""}),
+        (302, {"cache-control": "max-age=600", "vary": "cookie"}, {"cookie": ""}),
+        (302, {"cache-control": "max-age=600", "set-cookie": "u=alice"}, {}),
+        (302, {"cache-control": "max-age=600"}, {"cookie": "session=alice"}),
+        (301, {}, {"authorization": "Bearer alice"}),
+        # temporary redirect without lifetime
+        (302, {}, {"cookie": ""}),
+    ],
+)
+def test_per_user_redirect_is_not_kept(status_code, headers, request_headers):
+    resolver = RedirectResolver()
+    resolver.record(followed(status_code, headers, request_headers))
+    assert resolved(resolver) == URL
+    assert resolver.stats()["hops"] == 0
+
+
+@pytest.mark.parametrize(
+    "status_code, headers",
+    [
+        (301, {}),
+        (308, {"cache-control": "public"}),
+        (302, {"cache-control": "max-age=600"}),
+    ],
+)
+def test_shared_redirect_is_kept(status_code, headers):
+    resolver = RedirectResolver()
+    # the proxy always send an empty cookie
+    resolver.record(followed(status_code, headers, {"cookie": ""}))
+    assert resolved(resolver) == LANDING
+    assert resolver.stats() == {"hops": 1, "skipped": 1}
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_request_body.py
+@Time    :   2024/06/14 22:03:51
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   upload body reach upstream intact and with its length
+"""
+
+from typing import AsyncIterator, Dict, List
+
+import httpx
+import pytest
+
+from app.config import settings
+
+MEMORY_LIMIT = 1024
+BODY = bytes(i % 251 for i in range(10 * MEMORY_LIMIT))
+
+
+async def chunked(data: bytes, size: int = 1000) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+@pytest.fixture
+def received(upstream, monkeypatch) -> List[Dict[str, object]]:
+    monkeypatch.setattr(settings, "PROXY_BODY_MEMORY_LIMIT", MEMORY_LIMIT)
+    uploads: List[Dict[str, object]] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        uploads.append({"headers": request.headers, "body": await request.aread()})
+        return httpx.Response(200, content=b"ok")
+
+    upstream.handler = handler
+    return uploads
+
+
+async def upload(webproxy_app, content, headers=None) -> httpx.Response:
+    transport = httpx.ASGITransport(app=webproxy_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        return await client.post(
+            "/file/",
+            params={"url": "http://upstream.test/upload"},
+            content=content,
+            headers=headers,
+        )
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "body", [BODY[:100], BODY], ids=["in-memory", "spooled-to-file"]
+)
+async def test_chunked_upload_is_sent_with_its_length(webproxy_app, received, body):
+    response = await upload(webproxy_app, chunked(body))
+    assert response.status_code == 200
+    (upload_,) = received
+    assert upload_["body"] == body
+    headers = upload_["headers"]
+    assert headers["content-length"] == str(len(body))
+    assert "transfer-encoding" not in headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("body", [BODY[:100], BODY], ids=["in-memory", "streamed"])
+async def test_upload_keep_the_client_length(webproxy_app, received, body):
+    response = await upload(
+        webproxy_app, chunked(body), headers={"content-length": str(len(body))}
+    )
+    assert response.status_code == 200
+    (upload_,) = received
+    assert upload_["body"] == body
+    headers = upload_["headers"]
+    assert headers["content-length"] == str(len(body))
+    assert "transfer-encoding" not in headers
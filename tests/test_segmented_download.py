@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_segmented_download.py
+@Time    :   2024/06/13 22:40:19
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   segments ahead of the client are charged to the memory budget
+"""
+
+from typing import AsyncIterator, Dict, List
+
+import httpx
+import pytest
+
+from app.core.memory_budget import MemoryBudget
+from app.core.segmented_download import SegmentedDownloader
+
+URL = "http://upstream.test/big.bin"
+CHUNK = 1024
+SEGMENT = 16 * CHUNK
+SIZE = 8 * SEGMENT
+BODY = bytes(i % 251 for i in range(SIZE))
+
+
+class ChunkedStream(httpx.AsyncByteStream):
+    def __init__(self, data: bytes, used: List[int], budget: MemoryBudget) -> None:
+        self.data = data
+        self.used = used
+        self.budget = budget
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for start in range(0, len(self.data), CHUNK):
+            self.used.append(self.budget.used)
+            yield self.data[start : start + CHUNK]
+
+
+def make_response(
+    status_code: int, headers: Dict[str, str], data: bytes, used, budget
+) -> httpx.Response:
+    headers = {"etag": '"v1"', "accept-ranges": "bytes", **headers}
+    return httpx.Response(
+        status_code,
+        headers=headers,
+        stream=ChunkedStream(data, used, budget),
+        request=httpx.Request("GET", URL),
+    )
+
+
+def downloader(budget: MemoryBudget) -> SegmentedDownloader:
+    return SegmentedDownloader(
+        segments=4, segment_size=SEGMENT, min_size=0, memory_budget=budget
+    )
+
+
+def first_and_opener(budget: MemoryBudget, used: List[int]):
+    first = make_response(200, {"content-length": str(SIZE)}, BODY, used, budget)
+
+    async def open_range(start: int, end: int) -> httpx.Response:
+        headers = {"content-range": f"bytes {start}-{end}/{SIZE}"}
+        return make_response(206, headers, BODY[start : end + 1], used, budget)
+
+    return first, open_range
+
+
+@pytest.mark.anyio
+async def test_buffered_segments_are_bounded_by_the_budget():
+    budget = MemoryBudget(limit=4 * CHUNK)
+    used: List[int] = []
+    first, open_range = first_and_opener(budget, used)
+    body = b""
+    async for chunk in downloader(budget).stream(first, SIZE, open_range):
+        body += chunk
+    assert body == BODY
+    assert budget.used == 0
+    # one chunk of each downloading segment is allowed over the limit
+    assert 0 < max(used) <= budget.limit + 4 * CHUNK
+    assert budget.refused > 0
+
+
+@pytest.mark.anyio
+async def test_budget_is_released_when_the_client_is_gone():
+    budget = MemoryBudget()
+    used: List[int] = []
+    first, open_range = first_and_opener(budget, used)
+    stream = downloader(budget).stream(first, SIZE, open_range)
+    async for _ in stream:
+        break
+    await stream.aclose()  # type: ignore
+    assert budget.used == 0
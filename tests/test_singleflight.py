@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_singleflight.py
+@Time    :   2024/06/12 21:37:50
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   which requests share one upstream response
+"""
+
+import asyncio
+from typing import AsyncIterator, List, Tuple
+
+import httpx
+import pytest
+
+from app.core.singleflight import SingleFlight, flight_key
+
+URL = "http://upstream.test/api"
+
+
+def build(headers: List[Tuple[str, str]], method: str = "GET") -> httpx.Request:
+    return httpx.Request(method, URL, headers=headers)
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "authorization",
+        "cookie",
+        "x-api-key",
+        "x-auth-token",
+        "user-agent",
+        "accept-language",
+        "range",
+    ],
+)
+def test_different_header_is_not_shared(name):
+    alice = flight_key(build([(name, "alice")]))
+    bob = flight_key(build([(name, "bob")]))
+    anonymous = flight_key(build([]))
+    assert alice is not None and bob is not None
+    assert len({alice, bob, anonymous}) == 3
+
+
+def test_ignored_headers_are_shared():
+    first = flight_key(build([("accept", "*/*"), ("cache-control", "no-cache")]))
+    second = flight_key(build([("priority", "u=1"), ("accept", "*/*")]))
+    assert first is not None and first == second
+
+
+def test_order_of_one_header_is_kept():
+    first = flight_key(build([("accept", "a"), ("accept", "b")]))
+    second = flight_key(build([("accept", "b"), ("accept", "a")]))
+    assert first != second
+
+
+def test_unsafe_method_is_not_shared():
+    assert flight_key(build([], method="POST")) is None
+
+
+@pytest.mark.anyio
+async def test_identical_requests_share_one_response():
+    calls = 0
+    release = asyncio.Event()
+
+    async def send() -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return httpx.Response(
+            200, stream=httpx.ByteStream(b"shared"), request=build([])
+        )
+
+    def open_stream(response: httpx.Response) -> AsyncIterator[bytes]:
+        return response.aiter_raw()
+
+    async def read() -> bytes:
+        response = await flight.fetch("key", send, open_stream)
+        return b"".join([chunk async for chunk in response.aiter_raw()])
+
+    flight = SingleFlight()
+    tasks = [asyncio.ensure_future(read()) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*tasks) == [b"shared"] * 3
+    assert calls == 1
+    assert flight.stats() == {"in_flight": 0, "coalesced": 2}
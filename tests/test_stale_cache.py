@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_stale_cache.py
+@Time    :   2024/06/15 21:18:44
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   expired entries served while revalidating and on upstream error
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.core import webproxy_func
+
+URL = "http://upstream.test/app.css"
+
+
+def stored(age: int, cache_control: str = "max-age=10") -> httpx.Response:
+    """already expired when it is stored, `age` seconds old"""
+    return httpx.Response(
+        200,
+        headers={
+            "content-type": "text/css",
+            "cache-control": cache_control,
+            "etag": '"v1"',
+            "age": str(age),
+        },
+        content=b"body { color: red; }",
+    )
+
+
+@pytest.mark.anyio
+async def test_stale_while_revalidate(webproxy_app, upstream):
+    release = asyncio.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if "if-none-match" not in request.headers:
+            return stored(15, "max-age=10, stale-while-revalidate=60")
+        # the revalidation is slow, the clients do not wait for it
+        await release.wait()
+        return httpx.Response(304, headers={"cache-control": "max-age=600"})
+
+    upstream.handler = handler
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": URL}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        response = await client.get("/file/", params=params)
+        assert response.headers["x-proxy-cache"] == "MISS"
+
+        for _ in range(3):
+            response = await client.get("/file/", params=params)
+            assert response.headers["x-proxy-cache"] == "STALE"
+            assert response.text == "body { color: red; }"
+        await asyncio.sleep(0.01)
+        # one background revalidation for every stale hit
+        revalidations = [r for r in upstream.requests if "if-none-match" in r.headers]
+        assert len(revalidations) == 1
+        assert revalidations[0].headers["if-none-match"] == '"v1"'
+
+        release.set()
+        await asyncio.sleep(0.01)
+        response = await client.get("/file/", params=params)
+        assert response.headers["x-proxy-cache"] == "HIT"
+    assert len(upstream.requests) == 2
+    assert webproxy_func.GlobalRevalidator.stats()["prefetched"] == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("failure", ["status", "transport"])
+async def test_stale_if_error(webproxy_app, upstream, failure):
+    upstream.handler = lambda request: stored(100)
+
+    def broken(request: httpx.Request) -> httpx.Response:
+        if failure == "transport":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(503)
+
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": URL}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        await client.get("/file/", params=params)
+        upstream.handler = broken
+        # past the stale-while-revalidate window, upstream is asked
+        response = await client.get("/file/", params=params)
+        assert response.status_code == 200
+        assert response.headers["x-proxy-cache"] == "STALE"
+        assert response.text == "body { color: red; }"
+    assert len(upstream.requests) == 2
+
+
+@pytest.mark.anyio
+async def test_error_is_forwarded_past_stale_if_error(webproxy_app, upstream):
+    upstream.handler = lambda request: stored(1000)
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": URL}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        await client.get("/file/", params=params)
+        upstream.handler = lambda request: httpx.Response(503)
+        response = await client.get("/file/", params=params)
+        assert response.status_code == 503
+
+
+@pytest.mark.anyio
+async def test_no_cache_request_is_not_served_stale(webproxy_app, upstream):
+    upstream.handler = lambda request: stored(15)
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": URL}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        await client.get("/file/", params=params)
+        upstream.handler = lambda request: httpx.Response(503)
+        response = await client.get(
+            "/file/", params=params, headers={"cache-control": "no-cache"}
+        )
+        assert response.status_code == 503
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_url_rewrite.py
+@Time    :   2024/06/13 21:44:02
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   urls of css and js routed back through the proxy, names are kept
+"""
+
+import pytest
+
+from app.core.url_rewrite import (
+    css_stream_rewriter,
+    js_stream_rewriter,
+    proxy_url_mapper,
+    rewrite_js,
+)
+
+BASE = "https://example.com/app.js"
+mapper = proxy_url_mapper("/proxy/")
+
+
+@pytest.mark.parametrize(
+    "namespace",
+    [
+        "http://www.w3.org/2000/svg",
+        "http://www.w3.org/1999/xhtml",
+        "http://www.w3.org/1999/xlink",
+        "http://www.w3.org/1998/Math/MathML",
+        "http://www.w3.org/XML/1998/namespace",
+        "http://www.w3.org/2000/xmlns/",
+    ],
+)
+def test_xml_namespace_is_kept(namespace):
+    text = f'document.createElementNS("{namespace}", "svg");'
+    assert rewrite_js(BASE, text, mapper) == text
+
+
+def test_url_literal_is_rewritten():
+    text = (
+        'fetch("https://api.example.com/x?a=1"); var ns = "http://www.w3.org/2000/svg";'
+    )
+    result = rewrite_js(BASE, text, mapper)
+    assert '"/proxy/?url=https' in result
+    assert '"http://www.w3.org/2000/svg"' in result
+
+
+def test_namespace_is_kept_in_stream():
+    rewriter = js_stream_rewriter(BASE, mapper)
+    text = 'var svg = "http://www.w3.org/2000/svg";\nfetch("//cdn.example.com/a.js");\n'
+    result = rewriter.feed(text[:20]) + rewriter.feed(text[20:]) + rewriter.flush()
+    assert '"http://www.w3.org/2000/svg"' in result
+    assert "/proxy/?url=" in result
+
+
+def rewrite_split(rewriter, text, at):
+    return rewriter.feed(text[:at]) + rewriter.feed(text[at:]) + rewriter.flush()
+
+
+@pytest.mark.parametrize(
+    "new_rewriter, text, url",
+    [
+        (
+            css_stream_rewriter,
+            'a { background: url("a.png;v=1") } b { color: red; }',
+            "/proxy/?url=https://example.com/a.png%3Bv%3D1",
+        ),
+        (
+            css_stream_rewriter,
+            "a { background: url(a.png;v=1) }\n",
+            "/proxy/?url=https://example.com/a.png%3Bv%3D1",
+        ),
+        (
+            js_stream_rewriter,
+            'var a = "https://x.example.com/y?a=1;b=2"; var b = 1;\n',
+            "/proxy/?url=https://x.example.com/y%3Fa%3D1%3Bb%3D2",
+        ),
+    ],
+)
+def test_url_with_separator_is_not_split(new_rewriter, text, url):
+    for at in range(1, len(text)):
+        result = rewrite_split(new_rewriter(BASE, mapper), text, at)
+        assert url in result, at
+
+
+def test_apostrophe_in_comment_does_not_hold_the_stream():
+    rewriter = js_stream_rewriter(BASE, mapper)
+    # the quote is closed by the end of line, the next statement is cut
+    assert rewriter.feed("// don't\nvar a = 1;") == "// don't\nvar a = 1;"
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_webproxy_router.py
+@Time    :   2024/06/12 22:05:41
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   routes of the webproxy, upstream is answered in process
+"""
+
+from typing import Dict
+
+import httpx
+import pytest
+
+from app.config import settings
+
+
+@pytest.mark.anyio
+async def test_stats_need_password(webproxy_app):
+    transport = httpx.ASGITransport(app=webproxy_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        response = await client.get("/proxy/stats/")
+        assert response.status_code == 422
+
+        response = await client.get("/proxy/stats/", params={"key": "wrong"})
+        assert response.json() == {"code": 0, "msg": "password error", "data": None}
+
+        response = await client.get("/proxy/stats/", params={"key": settings.PASSWORD})
+        body = response.json()
+        assert body["code"] == 1
+        assert "cache" in body["data"]
+
+
+@pytest.mark.anyio
+async def test_clients_with_different_cookies_do_not_share(webproxy_app, upstream):
+    def handler(request: httpx.Request) -> httpx.Response:
+        # the page of the logged in user, cacheable by the heuristic
+        return httpx.Response(
+            200,
+            headers={
+                "content-type": "text/plain",
+                "etag": f'"{request.headers["cookie"]}"',
+                "last-modified": "Mon, 01 Jan 2024 00:00:00 GMT",
+            },
+            content=f"hello {request.headers['cookie']}".encode(),
+        )
+
+    upstream.handler = handler
+    transport = httpx.ASGITransport(app=webproxy_app)
+    params = {"url": "http://upstream.test/account"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        for user in ("alice", "bob", "alice"):
+            response = await client.get(
+                "/file/", params=params, headers={"cookie": f"session={user}"}
+            )
+            assert response.text == f"hello session={user}"
+            assert response.headers["x-proxy-cache"] == "BYPASS"
+    assert len(upstream.requests) == 3
+
+
+FILE = bytes(i % 251 for i in range(3 * 1024 * 1024))
+FILE_URL = "http://upstream.test/video.mp4"
+FILE_HEADERS = {
+    "content-type": "video/mp4",
+    "etag": '"v1"',
+    "cache-control": "max-age=600",
+    "accept-ranges": "bytes",
+}
+
+
+def range_handler(request: httpx.Request) -> httpx.Response:
+    """an upstream which support range"""
+    spec = request.headers.get("range")
+    if spec is None:
+        return httpx.Response(200, headers=FILE_HEADERS, content=FILE)
+    start, _, end = spec[len("bytes=") :].partition("-")
+    last = min(int(end), len(FILE) - 1) if end else len(FILE) - 1
+    headers: Dict[str, str] = {
+        **FILE_HEADERS,
+        "content-range": f"bytes {start}-{last}/{len(FILE)}",
+    }
+    return httpx.Response(206, headers=headers, content=FILE[int(start) : last + 1])
+
+
+async def get_range(webproxy_app, start: int, end: int) -> httpx.Response:
+    transport = httpx.ASGITransport(app=webproxy_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+        return await client.get(
+            "/file/",
+            params={"url": FILE_URL},
+            headers={"range": f"bytes={start}-{end}"},
+        )
+
+
+@pytest.mark.anyio
+async def test_range_blocks_are_stored(webproxy_app, upstream):
+    upstream.handler = range_handler
+    for cache_status in ("MISS", "HIT"):
+        response = await get_range(webproxy_app, 100000, 199999)
+        assert response.status_code == 206
+        assert response.headers["x-proxy-cache"] == cache_status
+        assert response.content == FILE[100000:200000]
+    assert len(upstream.requests) == 1
+
+
+@pytest.mark.anyio
+async def test_origin_ignoring_range_is_asked_once(webproxy_app, upstream):
+    upstream.handler = lambda request: httpx.Response(
+        200, headers={"content-type": "video/mp4", "etag": '"v1"'}, content=FILE
+    )
+    response = await get_range(webproxy_app, 100000, 199999)
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100000-199999/{len(FILE)}"
+    assert response.content == FILE[100000:200000]
+    assert len(upstream.requests) == 1
+
+    # known to ignore range, the request is proxied as it is
+    response = await get_range(webproxy_app, 200000, 299999)
+    assert response.status_code == 200
+    assert len(upstream.requests) == 2
+    assert upstream.requests[-1].headers["range"] == "bytes=200000-299999"
+
+
+@pytest.mark.anyio
+async def test_tiny_range_does_not_fetch_a_block(webproxy_app, upstream):
+    upstream.handler = range_handler
+    response = await get_range(webproxy_app, 0, 1)
+    assert response.status_code == 206
+    assert response.content == FILE[:2]
+    assert [r.headers["range"] for r in upstream.requests] == ["bytes=0-1"]
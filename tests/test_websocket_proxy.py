@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+"""
+@File    :   test_websocket_proxy.py
+@Time    :   2024/06/13 21:08:15
+@Author  :   WhaleFall
+@License :   (C)Copyright 2020-2023, WhaleFall
+@Desc    :   frames and close codes relayed between client and upstream
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import pytest
+from starlette.websockets import WebSocket
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+
+import app.main  # noqa: F401, the routers import the app, as uvicorn load it
+from app.core import websocket_proxy
+from app.core.websocket_proxy import forward_close_code
+
+
+class FakeUpstream(object):
+    """upstream connection never sending a message"""
+
+    subprotocol = None
+    close_reason = ""
+
+    def __init__(self, close_error: Optional[Exception] = None) -> None:
+        self.close_error = close_error
+        self.close_code: Optional[int] = None
+        self.close_codes: List[int] = []
+
+    def __aiter__(self) -> "FakeUpstream":
+        return self
+
+    async def __anext__(self) -> Any:
+        await asyncio.Event().wait()
+
+    async def send(self, message: Any) -> None:
+        pass
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        self.close_codes.append(code)
+        error, self.close_error = self.close_error, None
+        if error is not None:
+            raise error
+
+
+def client_websocket(disconnect_code: int, sent: List[Dict[str, Any]]) -> WebSocket:
+    messages = [
+        {"type": "websocket.connect"},
+        {"type": "websocket.disconnect", "code": disconnect_code},
+    ]
+
+    async def receive() -> Dict[str, Any]:
+        return messages.pop(0)
+
+    async def send(message: Dict[str, Any]) -> None:
+        sent.append(message)
+
+    scope = {
+        "type": "websocket",
+        "path": "/proxy/ws/",
+        "query_string": b"",
+        "headers": [(b"host", b"proxy.test")],
+    }
+    return WebSocket(scope, receive, send)
+
+
+@pytest.mark.parametrize(
+    "code, abnormal, expected",
+    [
+        (None, 1001, 1000),
+        (1005, 1001, 1000),
+        (1006, 1001, 1001),
+        (1015, 1001, 1001),
+        (1004, 1001, 1001),
+        (999, 1001, 1001),
+        (2000, 1001, 1001),
+        (1006, 1011, 1011),
+        (1000, 1001, 1000),
+        (1008, 1001, 1008),
+        (4000, 1001, 4000),
+    ],
+)
+def test_forward_close_code(code, abnormal, expected):
+    assert forward_close_code(code, abnormal) == expected
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("code, expected", [(1006, 1001), (1005, 1000), (4001, 4001)])
+async def test_client_close_is_forwarded(monkeypatch, code, expected):
+    upstream = FakeUpstream()
+
+    async def connect(url: str, **kwargs: Any) -> FakeUpstream:
+        return upstream
+
+    monkeypatch.setattr(websocket_proxy, "ws_connect", connect)
+    sent: List[Dict[str, Any]] = []
+    await websocket_proxy.proxy_websocket(
+        client_websocket(code, sent), "http://upstream.test/ws"
+    )
+    assert upstream.close_codes[0] == expected
+    assert [m["type"] for m in sent] == ["websocket.accept"]
+
+
+@pytest.mark.anyio
+async def test_gone_client_is_not_closed_again(monkeypatch):
+    upstream = FakeUpstream(close_error=RuntimeError("upstream is broken"))
+
+    async def connect(url: str, **kwargs: Any) -> FakeUpstream:
+        return upstream
+
+    monkeypatch.setattr(websocket_proxy, "ws_connect", connect)
+    sent: List[Dict[str, Any]] = []
+    await websocket_proxy.proxy_websocket(
+        client_websocket(1006, sent), "http://upstream.test/ws"
+    )
+    assert [m["type"] for m in sent] == ["websocket.accept"]
+
+
+class ClientQueue(object):
+    """the ASGI side of a client, messages are pushed by the test"""
+
+    def __init__(self) -> None:
+        self.incoming: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.outgoing: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.incoming.put_nowait({"type": "websocket.connect"})
+        scope = {
+            "type": "websocket",
+            "path": "/proxy/ws/",
+            "query_string": b"",
+            "headers": [(b"host", b"proxy.test"), (b"user-agent", b"test")],
+        }
+        self.websocket = WebSocket(scope, self.incoming.get, self.outgoing.put)
+
+    async def next_sent(self) -> Dict[str, Any]:
+        return await asyncio.wait_for(self.outgoing.get(), 5)
+
+
+@pytest.fixture
+async def echo_server():
+    """real websocket upstream, echo every frame, `close <code>` close it"""
+    closed: "asyncio.Future[Optional[int]]" = asyncio.Future()
+
+    async def handler(connection: ServerConnection) -> None:
+        try:
+            async for message in connection:
+                if isinstance(message, str) and message.startswith("close "):
+                    await connection.close(code=int(message[6:]), reason="bye")
+                    break
+                await connection.send(message)
+        except ConnectionClosed:
+            pass
+        await connection.wait_closed()
+        if not closed.done():
+            closed.set_result(connection.close_code)
+
+    async with serve(handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        yield f"http://127.0.0.1:{port}/echo", closed
+
+
+@pytest.mark.anyio
+async def test_frames_are_relayed_both_ways(echo_server):
+    url, _ = echo_server
+    client = ClientQueue()
+    task = asyncio.ensure_future(websocket_proxy.proxy_websocket(client.websocket, url))
+    assert (await client.next_sent())["type"] == "websocket.accept"
+
+    client.incoming.put_nowait({"type": "websocket.receive", "text": "hello"})
+    assert (await client.next_sent()) == {"type": "websocket.send", "text": "hello"}
+    client.incoming.put_nowait({"type": "websocket.receive", "bytes": b"\x00\xff"})
+    assert (await client.next_sent()) == {
+        "type": "websocket.send",
+        "bytes": b"\x00\xff",
+    }
+
+    client.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+    await asyncio.wait_for(task, 5)
+
+
+@pytest.mark.anyio
+async def test_upstream_close_code_reach_the_client(echo_server):
+    url, _ = echo_server
+    client = ClientQueue()
+    task = asyncio.ensure_future(websocket_proxy.proxy_websocket(client.websocket, url))
+    assert (await client.next_sent())["type"] == "websocket.accept"
+
+    client.incoming.put_nowait({"type": "websocket.receive", "text": "close 4001"})
+    message = await client.next_sent()
+    assert message["type"] == "websocket.close"
+    assert (message["code"], message["reason"]) == (4001, "bye")
+    client.incoming.put_nowait({"type": "websocket.disconnect", "code": 4001})
+    await asyncio.wait_for(task, 5)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("code, expected", [(1006, 1001), (1005, 1000), (4002, 4002)])
+async def test_client_close_code_reach_upstream(echo_server, code, expected):
+    url, closed = echo_server
+    client = ClientQueue()
+    task = asyncio.ensure_future(websocket_proxy.proxy_websocket(client.websocket, url))
+    assert (await client.next_sent())["type"] == "websocket.accept"
+
+    client.incoming.put_nowait({"type": "websocket.disconnect", "code": code})
+    await asyncio.wait_for(task, 5)
+    assert await asyncio.wait_for(closed, 5) == expected
+    # the client is gone, nothing more is sent to it
+    assert client.outgoing.empty()